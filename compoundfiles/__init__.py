@@ -52,6 +52,13 @@ CompoundFileEntity
     :members:
 
 
+CompoundFileBudget
+==================
+
+.. autoclass:: CompoundFileBudget
+    :members:
+
+
 Exceptions
 ==========
 
@@ -87,6 +94,7 @@ from compoundfiles.errors import (
     CompoundFileDirLoopError,
     CompoundFileNotFoundError,
     CompoundFileNotStreamError,
+    CompoundFileBudgetError,
     CompoundFileWarning,
     CompoundFileHeaderWarning,
     CompoundFileMasterFatWarning,
@@ -109,4 +117,5 @@ from compoundfiles.errors import (
 from compoundfiles.streams import CompoundFileStream
 from compoundfiles.entities import CompoundFileEntity
 from compoundfiles.reader import CompoundFileReader
+from compoundfiles.budget import CompoundFileBudget
 
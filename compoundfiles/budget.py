@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# A library for reading Microsoft's OLE Compound Document format
+# Copyright (c) 2014 Dave Jones <dave@waveform.org.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+native_str = str
+str = type('')
+
+
+try:
+    from time import monotonic as _clock
+except ImportError:
+    from time import time as _clock
+
+from compoundfiles.errors import CompoundFileBudgetError
+
+
+class CompoundFileBudget(object):
+    """
+    Limits the resources that a :class:`CompoundFileReader` may consume while
+    reading a document.
+
+    This is intended for reading documents from untrusted sources where the
+    cost of reading each document must be predictable. The budget can be
+    passed as the *budget* parameter of :class:`CompoundFileReader`, and each
+    limit that is exceeded causes :exc:`CompoundFileBudgetError` to be raised.
+    All limits default to ``None`` (unlimited):
+
+    *sector_reads* limits the number of sectors (and mini sectors) read,
+    whether by the reader when loading the FATs and directory, or by streams.
+    Each read counts every sector it touches, so a sector that is read
+    piecemeal (as the directory is) is counted several times.
+
+    *table_memory* limits the number of bytes used by the decoded DIFAT,
+    normal-FAT, and mini-FAT (and their analyses if *analyze_fat* is
+    specified). The limit is checked before each table is read, so an
+    excessive table is never allocated.
+
+    *dir_entries* limits the number of entries in the directory.
+
+    *chain_length* limits the number of sectors in any chain followed by a
+    stream (including the directory and mini-FAT).
+
+    *time* limits the number of seconds that may elapse from the construction
+    of the reader. This is checked whenever sectors are read, and after each
+    stage of opening the document, so it may be exceeded by the duration of
+    a single stage.
+
+    A single budget may be used with several readers; each reader tracks its
+    usage with a copy (see :meth:`start`) available from its
+    :attr:`~CompoundFileReader.budget` attribute.
+
+    .. attribute:: sector_reads_used
+
+        The number of sectors read so far.
+
+    .. attribute:: table_memory_used
+
+        The number of bytes used by decoded tables so far.
+    """
+
+    def __init__(
+            self, sector_reads=None, table_memory=None, dir_entries=None,
+            chain_length=None, time=None):
+        self.sector_reads = sector_reads
+        self.table_memory = table_memory
+        self.dir_entries = dir_entries
+        self.chain_length = chain_length
+        self.time = time
+        self.sector_reads_used = 0
+        self.table_memory_used = 0
+        self._deadline = None
+
+    def __repr__(self):
+        return (
+            '<CompoundFileBudget sector_reads=%r table_memory=%r '
+            'dir_entries=%r chain_length=%r time=%r>' % (
+                self.sector_reads, self.table_memory, self.dir_entries,
+                self.chain_length, self.time))
+
+    def start(self):
+        """
+        Returns a copy of the budget with no resources used, and with its
+        time limit starting from now.
+        """
+        result = CompoundFileBudget(
+            self.sector_reads, self.table_memory, self.dir_entries,
+            self.chain_length, self.time)
+        if self.time is not None:
+            result._deadline = _clock() + self.time
+        return result
+
+    # Note that usage is updated without locking, so when streams are read
+    # concurrently the counts (and hence the point at which limits are
+    # enforced) may be slightly off
+
+    def _check_time(self):
+        if self._deadline is not None and _clock() > self._deadline:
+            raise CompoundFileBudgetError(
+                'time budget exceeded (%gs)' % self.time)
+
+    def _charge_reads(self, count):
+        self.sector_reads_used += count
+        if (
+                self.sector_reads is not None and
+                self.sector_reads_used > self.sector_reads):
+            raise CompoundFileBudgetError(
+                'sector read budget exceeded (%d sectors)' % self.sector_reads)
+        self._check_time()
+
+    def _charge_memory(self, size):
+        self.table_memory_used += size
+        if (
+                self.table_memory is not None and
+                self.table_memory_used > self.table_memory):
+            raise CompoundFileBudgetError(
+                'table memory budget exceeded (%d bytes)' % self.table_memory)
+
+    def _check_dir_entries(self, count):
+        if self.dir_entries is not None and count > self.dir_entries:
+            raise CompoundFileBudgetError(
+                'directory entry budget exceeded (%d entries, limit '
+                '%d)' % (count, self.dir_entries))
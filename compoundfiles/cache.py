@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# A library for reading Microsoft's OLE Compound Document format
+# Copyright (c) 2014 Dave Jones <dave@waveform.org.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+native_str = str
+str = type('')
+
+
+import io
+import os
+import sys
+import hashlib
+import tempfile
+import struct as st
+from array import array
+
+from compoundfiles.errors import CompoundFileError
+from compoundfiles.fat import FAT_TYPECODE, fat_array
+from compoundfiles.entities import CompoundFileEntity
+
+
+# The index cache is a "sidecar" file which stores the decoded tables and
+# directory of a compound document so that subsequent opens of the same
+# document can skip reading them. The layout of the file is:
+#
+#   CACHE_HEADER                  magic, and the key of the document
+#   CACHE_STATE                   reader state, and the length of each section
+#   master-FAT                    little-endian 32-bit values
+#   normal-FAT                    little-endian 32-bit values
+#   mini-FAT                      little-endian 32-bit values
+#   CACHE_ENTRY * entries         reachable directory entries
+#   tree                          little-endian 32-bit values
+#   SHA1 digest                   of everything preceding it
+#
+# The tree section consists of the child count of each storage entry (in the
+# order the entries are stored) followed by the indexes of its children. The
+# key of a document consists of its offset within the file, its size and
+# modification time, and a hash of its header and of every sector of its
+# normal-FAT, mini-FAT and directory.
+
+CACHE_MAGIC = b'CFIDX\x00\x03\n'
+
+CACHE_HEADER = st.Struct(native_str(''.join((
+    native_str('<'),    # little-endian format
+    native_str('8s'),   # magic string (includes format version)
+    native_str('Q'),    # offset of the compound document within the file
+    native_str('Q'),    # size of the compound document
+    native_str('q'),    # modification time of the document (nanoseconds)
+    native_str('20s'),  # SHA1 digest of header, FAT and directory sectors
+    ))))
+
+CACHE_STATE = st.Struct(native_str(''.join((
+    native_str('<'),    # little-endian format
+    native_str('L'),    # normal-FAT sector count
+    native_str('L'),    # master-FAT sector count
+    native_str('L'),    # mini-FAT first sector
+    native_str('L'),    # master-FAT length
+    native_str('L'),    # normal-FAT length
+    native_str('L'),    # mini-FAT length
+    native_str('L'),    # directory entry count
+    native_str('L'),    # tree length
+    ))))
+
+CACHE_ENTRY = st.Struct(native_str(''.join((
+    native_str('<'),    # little-endian format
+    native_str('L'),    # index of the entry in the directory
+    native_str('128s'), # validated directory entry (see DIR_HEADER)
+    ))))
+
+
+def cache_path(filename, offset=0):
+    """
+    Returns the default location of the index cache for *filename*. If
+    *offset* is non-zero (for a document embedded within *filename*), it is
+    included in the name so that each embedded document has its own cache.
+    """
+    suffix = '.cfidx' if offset == 0 else '.%d.cfidx' % offset
+    if not isinstance(filename, str):
+        suffix = suffix.encode('ascii')
+    return filename + suffix
+
+
+def _file_time(reader):
+    try:
+        stat = os.fstat(reader._file.fileno())
+    except (IOError, OSError, AttributeError):
+        return 0
+    try:
+        return stat.st_mtime_ns
+    except AttributeError:
+        return int(stat.st_mtime * 1000000000)
+
+
+def _chain(normal_fat, start):
+    # Yields the sectors of the chain beginning at start in normal_fat,
+    # stopping at the end of the chain, or after as many sectors as the table
+    # holds in case the chain loops
+    sector = start
+    for i in range(len(normal_fat)):
+        if not 0 <= sector < len(normal_fat):
+            break
+        yield sector
+        sector = normal_fat[sector]
+
+
+def _file_key(reader, master_fat, normal_fat, mini_first_sector):
+    # Hashes the header and every sector of the normal-FAT (listed by
+    # master_fat), the mini-FAT, and the directory; documents without a
+    # modification time (file-likes without a descriptor) must be told apart
+    # by content alone
+    h = hashlib.sha1()
+    h.update(reader._mmap[reader._base:reader._base + reader._header_size])
+    for data in reader._read_sectors(master_fat):
+        h.update(data)
+    for start in (reader._dir_first_sector, mini_first_sector):
+        for data in reader._read_sectors(_chain(normal_fat, start)):
+            h.update(data)
+    return h.digest()
+
+
+def _to_bytes(table):
+    if not isinstance(table, array):
+        table = table.to_array()
+    if sys.byteorder != 'little':
+        table = array(FAT_TYPECODE, table)
+        table.byteswap()
+    try:
+        return table.tobytes()
+    except AttributeError:
+        # Python 2.x
+        return table.tostring()
+
+
+def load_index(reader, path):
+    """
+    Attempts to restore the tables and directory of *reader* from the index
+    cache at *path*. Returns ``True`` if the cache was valid for the document
+    and has been loaded, or ``False`` if the cache is missing, stale, or
+    corrupt, in which case *reader* is left untouched.
+    """
+    try:
+        with io.open(path, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return False
+    try:
+        if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+            return False
+        magic, doc_offset, size, mtime, key = CACHE_HEADER.unpack_from(data, 0)
+        if (
+                magic != CACHE_MAGIC or
+                doc_offset != reader._offset or
+                size != reader._file_size or
+                mtime != _file_time(reader)):
+            return False
+        offset = CACHE_HEADER.size
+        (
+            normal_sector_count,
+            master_sector_count,
+            mini_first_sector,
+            master_len,
+            normal_len,
+            mini_len,
+            entry_count,
+            tree_len,
+        ) = CACHE_STATE.unpack_from(data, offset)
+        offset += CACHE_STATE.size
+        tables = []
+        for length in (master_len, normal_len, mini_len):
+            tables.append(fat_array(data[offset:offset + length * 4]))
+            offset += length * 4
+        master_fat, normal_fat, mini_fat = tables
+        if (
+                len(master_fat) != master_len or
+                len(normal_fat) != normal_len or
+                len(mini_fat) != mini_len):
+            return False
+        if key != _file_key(
+                reader, master_fat, normal_fat, mini_first_sector):
+            return False
+        entries = {}
+        order = []
+        for i in range(entry_count):
+            index, record = CACHE_ENTRY.unpack_from(data, offset)
+            offset += CACHE_ENTRY.size
+            entries[index] = CompoundFileEntity._from_cache(index, record)
+            order.append(index)
+        tree = fat_array(data[offset:offset + tree_len * 4])
+        offset += tree_len * 4
+        if len(tree) != tree_len or offset != len(data) - 20:
+            return False
+        i = 0
+        for index in order:
+            entity = entries[index]
+            if entity.isdir:
+                count = tree[i]
+                entity._children = [
+                    entries[child] for child in tree[i + 1:i + 1 + count]]
+                i += count + 1
+        if i != tree_len or 0 not in entries:
+            return False
+    except (
+            IOError, ValueError, KeyError, IndexError, UnicodeError,
+            st.error, CompoundFileError):
+        return False
+    reader._normal_sector_count = normal_sector_count
+    reader._master_sector_count = master_sector_count
+    reader._mini_first_sector = mini_first_sector
+    reader._master_fat = master_fat
+    reader._normal_fat = normal_fat
+    reader._mini_fat = mini_fat
+    reader.root = entries[0]
+    return True
+
+
+def save_index(reader, path):
+    """
+    Writes the tables and directory of *reader* to an index cache at *path*.
+    The cache is written to a temporary file which then replaces *path* so
+    concurrent readers never observe a partially written cache. Failure to
+    write the cache (e.g. due to permissions) is silently ignored, as are
+    truncated documents (which can't be keyed).
+    """
+    try:
+        key = _file_key(
+            reader, reader._master_fat, reader._normal_fat,
+            reader._mini_first_sector)
+        tables = [
+            _to_bytes(table) for table in
+            (reader._master_fat, reader._normal_fat, reader._mini_fat)
+            ]
+    except CompoundFileError:
+        return
+    entries = []
+    tree = []
+    stack = [reader.root]
+    while stack:
+        entity = stack.pop()
+        entries.append(CACHE_ENTRY.pack(entity._index, entity._record))
+        if entity.isdir:
+            children = list(entity)
+            tree.append(len(children))
+            tree.extend(child._index for child in children)
+            stack.extend(reversed(children))
+    data = b''.join([
+        CACHE_HEADER.pack(
+            CACHE_MAGIC,
+            reader._offset,
+            reader._file_size,
+            _file_time(reader),
+            key),
+        CACHE_STATE.pack(
+            reader._normal_sector_count,
+            reader._master_sector_count,
+            reader._mini_first_sector,
+            len(reader._master_fat),
+            len(reader._normal_fat),
+            len(reader._mini_fat),
+            len(entries),
+            len(tree)),
+        ] + tables + entries + [
+        st.pack(native_str('<%dL' % len(tree)), *tree),
+        ])
+    data += hashlib.sha1(data).digest()
+    try:
+        fd, temp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            getattr(os, 'replace', os.rename)(temp, path)
+        except Exception:
+            os.unlink(temp)
+            raise
+    except (IOError, OSError):
+        pass
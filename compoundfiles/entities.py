@@ -28,10 +28,12 @@ from __future__ import (
     print_function,
     division,
     )
+native_str = str
 str = type('')
 
 
-import warnings
+import threading
+import struct as st
 import datetime as dt
 from pprint import pformat
 
@@ -56,6 +58,57 @@ from compoundfiles.const import (
     )
 
 
+# Offsets of fields within a DIR_HEADER record, and structures for decoding
+# individual fields from it
+DIR_NAME_LEN_OFFSET = 64
+DIR_TYPE_OFFSET = 66
+DIR_LEFT_OFFSET = 68
+DIR_RIGHT_OFFSET = 72
+DIR_CHILD_OFFSET = 76
+DIR_UUID_OFFSET = 80
+DIR_CREATED_OFFSET = 100
+DIR_MODIFIED_OFFSET = 108
+DIR_START_OFFSET = 116
+DIR_SIZE_OFFSET = 120
+
+DIR_INDEX = st.Struct(native_str('<L'))
+DIR_TIMESTAMP = st.Struct(native_str('<Q'))
+DIR_SIZE = st.Struct(native_str('<LL'))
+
+EPOCH = dt.datetime(1601, 1, 1)
+
+# Actions and fields used by CompoundFileEntity._build_tree
+_WALK, _APPEND, _BUILD = range(3)
+_LEFT, _RIGHT, _CHILD = 'left', 'right', 'child'
+
+
+def _name_end(record):
+    # Returns the offset of the NULL terminator of the UTF-16 encoded name at
+    # the start of record, or -1 if the name is unterminated
+    end = record.find(b'\0\0', 0, DIR_NAME_LEN_OFFSET)
+    while end != -1 and end % 2:
+        end = record.find(b'\0\0', end + 1, DIR_NAME_LEN_OFFSET)
+    return end
+
+
+def _decode_name(record):
+    end = _name_end(record)
+    if end == -1:
+        # Unterminated name; fall back on the declared length
+        name_len, = st.unpack_from(
+            native_str('<H'), record, DIR_NAME_LEN_OFFSET)
+        name = record[:DIR_NAME_LEN_OFFSET].decode('utf-16le')
+        return name[:(name_len // 2) - 1]
+    return record[:end].decode('utf-16le')
+
+
+def _decode_timestamp(record, offset):
+    value, = DIR_TIMESTAMP.unpack_from(record, offset)
+    if value == 0:
+        return None
+    return EPOCH + dt.timedelta(microseconds=value // 10)
+
+
 class CompoundFileEntity(object):
     """
     Represents an entity in an OLE Compound Document.
@@ -105,121 +158,224 @@ class CompoundFileEntity(object):
         entities.
     """
 
+    __slots__ = (
+        '_index',
+        '_record',
+        '_name',
+        '_entry_type',
+        '_children',
+        '_entries',
+        '_names',
+        )
+
     def __init__(self, parent, stream, index):
         super(CompoundFileEntity, self).__init__()
         self._index = index
         self._children = None
+        self._entries = None
+        self._names = None
+        self._name = None
+        self._record = stream.read(DIR_HEADER.size)
+        if parent._validation == 'trusted':
+            # Skip the checks below which merely warn; the loop and bounds
+            # checks performed when building the tree and opening streams are
+            # sufficient to read the document safely. However, the entry type
+            # and (in small sector files) the size still need decoding as
+            # below, or streams could be misclassified or mis-sized
+            entry_type = ord(self._record[DIR_TYPE_OFFSET:DIR_TYPE_OFFSET + 1])
+            if index == 0:
+                entry_type = DIR_ROOT
+            elif not entry_type in (DIR_STREAM, DIR_STORAGE, DIR_INVALID):
+                entry_type = DIR_INVALID
+            record = self._record
+            if entry_type != ord(record[DIR_TYPE_OFFSET:DIR_TYPE_OFFSET + 1]):
+                record = (
+                    record[:DIR_TYPE_OFFSET] + bytes(bytearray([entry_type])) +
+                    record[DIR_TYPE_OFFSET + 1:])
+            if parent._normal_sector_size == 512:
+                size_low, size_high = DIR_SIZE.unpack_from(
+                    record, DIR_SIZE_OFFSET)
+                if size_high != 0:
+                    record = (
+                        record[:DIR_SIZE_OFFSET] +
+                        DIR_SIZE.pack(size_low, 0) +
+                        record[DIR_SIZE_OFFSET + DIR_SIZE.size:])
+            self._record = record
+            self._entry_type = entry_type
+            return
+        def warn(warning):
+            parent._warn(warning, 'entry', index)
         (
             name,
             name_len,
-            self._entry_type,
-            self._entry_color,
-            self._left_index,
-            self._right_index,
-            self._child_index,
-            self.uuid,
+            entry_type,
+            entry_color,
+            left_index,
+            right_index,
+            child_index,
+            uuid,
             user_flags,
             created,
             modified,
-            self._start_sector,
+            start_sector,
             size_low,
             size_high,
-        ) = DIR_HEADER.unpack(stream.read(DIR_HEADER.size))
-        self.name = name.decode('utf-16le')
-        try:
-            self.name = self.name[:self.name.index('\0')]
-        except ValueError:
-            warnings.warn(
+        ) = values = DIR_HEADER.unpack(self._record)
+        # The name is only decoded when first required, but we need its
+        # length to validate the entry
+        name_end = _name_end(self._record)
+        if name_end == -1:
+            warn(
                 CompoundFileDirNameWarning(
                     'missing NULL terminator in name'))
-            self.name = self.name[:(name_len // 2) - 1]
+            name_chars = len(_decode_name(self._record))
+        else:
+            name_chars = name_end // 2
         if index == 0:
-            if self._entry_type != DIR_ROOT:
-                warnings.warn(
+            if entry_type != DIR_ROOT:
+                warn(
                     CompoundFileDirTypeWarning('invalid type'))
-            self._entry_type = DIR_ROOT
-        elif not self._entry_type in (DIR_STREAM, DIR_STORAGE, DIR_INVALID):
-            warnings.warn(
+            entry_type = DIR_ROOT
+        elif not entry_type in (DIR_STREAM, DIR_STORAGE, DIR_INVALID):
+            warn(
                 CompoundFileDirTypeWarning('invalid type'))
-            self._entry_type = DIR_INVALID
-        if self._entry_type == DIR_INVALID:
-            if self.name != '':
-                warnings.warn(
+            entry_type = DIR_INVALID
+        if entry_type == DIR_INVALID:
+            if name_chars != 0:
+                warn(
                     CompoundFileDirNameWarning('non-empty name'))
             if name_len != 0:
-                warnings.warn(
+                warn(
                     CompoundFileDirNameWarning('non-zero name length'))
             if user_flags != 0:
-                warnings.warn(
+                warn(
                     CompoundFileDirEntryWarning('non-zero user flags'))
         else:
             # Name length is in bytes, including NULL terminator ... for a
             # unicode encoded name ... *headdesk*
-            if (len(self.name) + 1) * 2 != name_len:
-                warnings.warn(
+            if (name_chars + 1) * 2 != name_len:
+                warn(
                     CompoundFileDirNameWarning('invalid name length (%d)' % name_len))
-        if self._entry_type in (DIR_INVALID, DIR_ROOT):
-            if self._left_index != NO_STREAM:
-                warnings.warn(
+        if entry_type in (DIR_INVALID, DIR_ROOT):
+            if left_index != NO_STREAM:
+                warn(
                     CompoundFileDirIndexWarning('invalid left sibling'))
-            if self._right_index != NO_STREAM:
-                warnings.warn(
+            if right_index != NO_STREAM:
+                warn(
                     CompoundFileDirIndexWarning('invalid right sibling'))
-            self._left_index = NO_STREAM
-            self._right_index = NO_STREAM
-        if self._entry_type in (DIR_INVALID, DIR_STREAM):
-            if self._child_index != NO_STREAM:
-                warnings.warn(
+            left_index = NO_STREAM
+            right_index = NO_STREAM
+        if entry_type in (DIR_INVALID, DIR_STREAM):
+            if child_index != NO_STREAM:
+                warn(
                     CompoundFileDirIndexWarning('invalid child index'))
-            if self.uuid != b'\0' * 16:
-                warnings.warn(
+            if uuid != b'\0' * 16:
+                warn(
                     CompoundFileDirEntryWarning('non-zero UUID'))
             if created != 0:
-                warnings.warn(
+                warn(
                     CompoundFileDirTimeWarning('non-zero creation timestamp'))
             if modified != 0:
-                warnings.warn(
+                warn(
                     CompoundFileDirTimeWarning('non-zero modification timestamp'))
-            self._child_index = NO_STREAM
-            self.uuid = b'\0' * 16
+            child_index = NO_STREAM
+            uuid = b'\0' * 16
             created = 0
             modified = 0
-        if self._entry_type in (DIR_INVALID, DIR_STORAGE):
-            if self._start_sector != 0:
-                warnings.warn(
+        if entry_type in (DIR_INVALID, DIR_STORAGE):
+            if start_sector != 0:
+                warn(
                     CompoundFileDirSectorWarning(
-                        'non-zero start sector (%d)' % self._start_sector))
+                        'non-zero start sector (%d)' % start_sector))
             if size_low != 0:
-                warnings.warn(
+                warn(
                     CompoundFileDirSizeWarning(
                         'non-zero size low-bits (%d)' % size_low))
             if size_high != 0:
-                warnings.warn(
+                warn(
                     CompoundFileDirSizeWarning(
                         'non-zero size high-bits (%d)' % size_high))
-            self._start_sector = 0
+            start_sector = 0
             size_low = 0
             size_high = 0
         if parent._normal_sector_size == 512:
             # Surely this should be checking DLL version instead of sector
             # size?! But the spec does state sector size ...
             if size_high != 0:
-                warnings.warn(
+                warn(
                     CompoundFileDirSizeWarning(
                         'invalid size in small sector file'))
                 size_high = 0
             if size_low >= 1<<31:
-                warnings.warn(
+                warn(
                     CompoundFileDirSizeWarning(
                         'size too large for small sector file'))
-        self.size = (size_high << 32) | size_low
-        epoch = dt.datetime(1601, 1, 1)
-        self.created = (
-                epoch + dt.timedelta(microseconds=created // 10)
-                if created != 0 else None)
-        self.modified = (
-                epoch + dt.timedelta(microseconds=created // 10)
-                if modified != 0 else None)
+        # If any fields were corrected above, re-write the record so the
+        # lazily decoded attributes reflect the corrections
+        corrected = (
+            name, name_len, entry_type, entry_color, left_index, right_index,
+            child_index, uuid, user_flags, created, modified, start_sector,
+            size_low, size_high)
+        if corrected != values:
+            self._record = DIR_HEADER.pack(*corrected)
+        self._entry_type = entry_type
+
+    @classmethod
+    def _from_cache(cls, index, record):
+        # Construct an entity from a record previously validated (and
+        # corrected) by __init__ and stored in an index cache, bypassing the
+        # checks in __init__
+        self = cls.__new__(cls)
+        self._index = index
+        self._children = None
+        self._entries = None
+        self._names = None
+        self._name = None
+        self._record = record
+        self._entry_type = ord(record[DIR_TYPE_OFFSET:DIR_TYPE_OFFSET + 1])
+        return self
+
+    @property
+    def name(self):
+        if self._name is None:
+            self._name = _decode_name(self._record)
+        return self._name
+
+    @property
+    def created(self):
+        return _decode_timestamp(self._record, DIR_CREATED_OFFSET)
+
+    @property
+    def modified(self):
+        return _decode_timestamp(self._record, DIR_MODIFIED_OFFSET)
+
+    @property
+    def uuid(self):
+        return self._record[DIR_UUID_OFFSET:DIR_UUID_OFFSET + 16]
+
+    @property
+    def size(self):
+        low, high = DIR_SIZE.unpack_from(self._record, DIR_SIZE_OFFSET)
+        return (high << 32) | low
+
+    # The following are decoded from the (corrected) record on demand; they're
+    # only used when building the directory tree and opening streams
+
+    @property
+    def _left_index(self):
+        return DIR_INDEX.unpack_from(self._record, DIR_LEFT_OFFSET)[0]
+
+    @property
+    def _right_index(self):
+        return DIR_INDEX.unpack_from(self._record, DIR_RIGHT_OFFSET)[0]
+
+    @property
+    def _child_index(self):
+        return DIR_INDEX.unpack_from(self._record, DIR_CHILD_OFFSET)[0]
+
+    @property
+    def _start_sector(self):
+        return DIR_INDEX.unpack_from(self._record, DIR_START_OFFSET)[0]
 
     @property
     def isfile(self):
@@ -229,48 +385,134 @@ class CompoundFileEntity(object):
     def isdir(self):
         return self._entry_type in (DIR_STORAGE, DIR_ROOT)
 
-    def _build_tree(self, entries):
-
-        def walk(index):
-            node = entries[index]
-            entries[index] = None
-            if node is None:
-                raise CompoundFileDirLoopError(
-                    'loop detected in directory hierarchy '
-                    '(points to index %d)' % index)
-            if node._left_index != NO_STREAM:
-                try:
-                    walk(node._left_index)
-                except IndexError:
-                    warnings.warn(
-                        CompoundFileDirIndexWarning(
-                            'invalid left index (%d) in entry at '
-                            'index %d' % (node._left_index, index)))
-            self._children.append(node)
-            if node._right_index != NO_STREAM:
+    def _build_tree(self, entries, warn):
+        # Builds the tree of children beneath this storage (and, unless
+        # entries are lazily loaded, beneath all storages it contains).
+        # Sibling chains can be extremely long (some implementations don't
+        # bother balancing the red-black tree) so rather than recursing we
+        # use an explicit stack of actions. The actions are ordered so the
+        # result (and the order of warnings and errors) is identical to an
+        # in-order walk of each sibling tree, with each storage's own tree
+        # built after the subtree to its right.
+        #
+        # Each walk action also records the entry that referenced the index
+        # being walked, and in which field, for the sake of warnings (which
+        # are issued via warn, normally the reader's _warn method).
+        #
+        # The lists of children are only assigned to their storages once the
+        # build is complete, so other threads never see a partial list
+        if not self.isdir:
+            return
+        built = [(self, [])]
+        children = {self._index: built[0][1]}
+        stack = [(_WALK, self, self._child_index, None, _CHILD)]
+        while stack:
+            action, owner, index, referrer, field = stack.pop()
+            if action == _APPEND:
+                children[owner._index].append(index)
+            elif action == _BUILD:
+                # Lazily loaded entities build their trees on first access
+                if index._entries is None and index.isdir:
+                    built.append((index, []))
+                    children[index._index] = built[-1][1]
+                    stack.append(
+                        (_WALK, index, index._child_index, None, _CHILD))
+            else:
                 try:
-                    walk(node._right_index)
+                    node = entries[index]
                 except IndexError:
-                    warnings.warn(
-                        CompoundFileDirIndexWarning(
-                            'invalid right index (%d) in entry at '
-                            'index %d' % (node._right_index, index)))
-            node._build_tree(entries)
-
-        if self.isdir:
-            self._children = []
+                    if field == _CHILD:
+                        if owner._child_index != NO_STREAM:
+                            warn(
+                                CompoundFileDirIndexWarning(
+                                    'invalid child index'),
+                                'entry', owner._index)
+                    else:
+                        warn(
+                            CompoundFileDirIndexWarning(
+                                'invalid %s index (%d) in entry at '
+                                'index %d' % (field, index, referrer)),
+                            'entry', referrer)
+                    continue
+                entries[index] = None
+                if node is None:
+                    raise CompoundFileDirLoopError(
+                        'loop detected in directory hierarchy '
+                        '(points to index %d)' % index)
+                # Pushed in reverse order of execution
+                stack.append((_BUILD, owner, node, None, None))
+                if node._right_index != NO_STREAM:
+                    stack.append(
+                        (_WALK, owner, node._right_index, index, _RIGHT))
+                stack.append((_APPEND, owner, node, None, None))
+                if node._left_index != NO_STREAM:
+                    stack.append(
+                        (_WALK, owner, node._left_index, index, _LEFT))
+        for entity, items in built:
+            entity._children = items
+
+    def _search(self, name):
+        # Siblings are stored in a red-black tree ordered by name length, then
+        # by upper-cased name. Search the tree for name, decoding only the
+        # entries along the search path. As some implementations don't bother
+        # writing a correctly ordered tree we check that each node lies within
+        # the bounds set by its ancestors. If the search fails, or we find the
+        # tree is out of order (or contains loops, or entries that belong to
+        # another storage) we return None and let the caller fall back to a
+        # full scan of the storage
+        key = (len(name), name.upper())
+        lower = upper = None
+        index = self._child_index
+        visited = set()
+        while index != NO_STREAM:
+            if index in visited or index in self._entries._claimed:
+                return None
+            visited.add(index)
             try:
-                walk(self._child_index)
+                node = self._entries.entity(index)
             except IndexError:
-                if self._child_index != NO_STREAM:
-                    warnings.warn(
-                        CompoundFileDirIndexWarning('invalid child index'))
+                return None
+            node_key = (len(node.name), node.name.upper())
+            if (
+                    (lower is not None and node_key <= lower) or
+                    (upper is not None and node_key >= upper)):
+                return None
+            if key == node_key:
+                if node.name.lower() == name.lower():
+                    return node
+                return None
+            elif key < node_key:
+                upper = node_key
+                index = node._left_index
+            else:
+                lower = node_key
+                index = node._right_index
+        return None
+
+    def _get_children(self):
+        if self._children is None and self._entries is not None:
+            with self._entries._build_lock:
+                if self._children is None:
+                    self._build_tree(
+                        self._entries, self._entries._reader._warn)
+        return self._children
+
+    def _get_names(self):
+        # Build a case-folded index of children on the first lookup by name.
+        # Where several children share a name, the first takes precedence (as
+        # it would with a scan of the children)
+        if self._names is None:
+            names = {}
+            for item in self._get_children():
+                names.setdefault(item.name.lower(), item)
+            self._names = names
+        return self._names
 
     def __len__(self):
-        return len(self._children)
+        return len(self._get_children())
 
     def __iter__(self):
-        return iter(self._children)
+        return iter(self._get_children())
 
     def __contains__(self, name_or_obj):
         if isinstance(name_or_obj, bytes):
@@ -282,19 +524,22 @@ class CompoundFileEntity(object):
             except KeyError:
                 return False
         else:
-            return name_or_obj in self._children
+            return name_or_obj in self._get_children()
 
     def __getitem__(self, index_or_name):
         if isinstance(index_or_name, bytes):
             index_or_name = index_or_name.decode(FILENAME_ENCODING)
         if isinstance(index_or_name, str):
-            name = index_or_name.lower()
-            for item in self._children:
-                if item.name.lower() == name:
+            if self._children is None and self._entries is not None:
+                item = self._search(index_or_name)
+                if item is not None:
                     return item
-            raise KeyError(index_or_name)
+            try:
+                return self._get_names()[index_or_name.lower()]
+            except KeyError:
+                raise KeyError(index_or_name)
         else:
-            return self._children[index_or_name]
+            return self._get_children()[index_or_name]
 
     def __repr__(self):
         return (
@@ -304,9 +549,65 @@ class CompoundFileEntity(object):
                 "<CompoundFileEntity dir='%s'>" % c.name
                 if c.isdir else
                 repr(c)
-                for c in self._children
+                for c in self._get_children()
                 ])
             if self.isdir else
             "<CompoundFileEntry ???>"
             )
 
+
+
+class LazyDirectory(object):
+    """
+    Provides a list-like sequence of directory entries which are only decoded
+    when first accessed.
+
+    The :class:`LazyDirectory` class is used in place of the list of entities
+    normally constructed from the directory of a compound document. Indexing
+    the sequence decodes (and validates) the requested entry, caching the
+    resulting :class:`CompoundFileEntity`. Like the list it replaces, an entry
+    can be "blanked out" by assigning ``None`` to it (subsequent accesses
+    return ``None``) which is how the tree builder detects loops. Storages
+    decoded from a :class:`LazyDirectory` only build their list of children
+    when they are first iterated or indexed.
+    """
+
+    def __init__(self, reader, stream):
+        self._lock = threading.Lock()
+        # Serializes the building of storages' lists of children
+        self._build_lock = threading.Lock()
+        self._reader = reader
+        self._stream = stream
+        self._length = stream._length // DIR_HEADER.size
+        self._entities = {}
+        self._claimed = set()
+
+    def __len__(self):
+        return self._length
+
+    def entity(self, index):
+        """
+        Returns the entity at *index* regardless of whether it has been
+        blanked out.
+        """
+        with self._lock:
+            try:
+                return self._entities[index]
+            except KeyError:
+                if not 0 <= index < self._length:
+                    raise IndexError('directory index out of range')
+                self._stream.seek(index * DIR_HEADER.size)
+                entity = CompoundFileEntity(self._reader, self._stream, index)
+                entity._entries = self
+                self._entities[index] = entity
+                return entity
+
+    def __getitem__(self, index):
+        if index in self._claimed:
+            return None
+        return self.entity(index)
+
+    def __setitem__(self, index, value):
+        if value is not None:
+            raise ValueError('directory entries can only be blanked out')
+        self._claimed.add(index)
@@ -112,6 +112,12 @@ class CompoundFileNotStreamError(CompoundFileError):
     Error raised when an attempt is made to open a storage.
     """
 
+class CompoundFileBudgetError(CompoundFileError):
+    """
+    Error raised when reading a document exceeds one of the limits of its
+    :class:`~compoundfiles.CompoundFileBudget`.
+    """
+
 
 class CompoundFileWarning(Warning):
     """
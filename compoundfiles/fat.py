@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# A library for reading Microsoft's OLE Compound Document format
+# Copyright (c) 2014 Dave Jones <dave@waveform.org.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+native_str = str
+str = type('')
+
+
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+
+from compoundfiles.errors import (
+    CompoundFileNormalLoopError,
+    CompoundFileBudgetError,
+    CompoundFileMasterSectorWarning,
+    CompoundFileNormalSectorWarning,
+    )
+from compoundfiles.const import (
+    FREE_SECTOR,
+    END_OF_CHAIN,
+    NORMAL_FAT_SECTOR,
+    MASTER_FAT_SECTOR,
+    )
+
+
+# The array typecode used for FAT tables. This must be exactly 32-bits wide
+# (which "L" isn't on most 64-bit platforms) so that the content of FAT sectors
+# can be loaded straight into a table
+FAT_TYPECODE = (
+        native_str('L') if array(native_str('L')).itemsize == 4 else
+        native_str('I'))
+assert array(FAT_TYPECODE).itemsize == 4
+
+
+def fat_array(data=b''):
+    """
+    Returns a new FAT table (an :class:`~array.array` of unsigned 32-bit
+    integers) containing the little-endian values in *data*.
+    """
+    result = array(FAT_TYPECODE)
+    extend_fat(result, data)
+    return result
+
+
+def extend_fat(table, data):
+    """
+    Appends the little-endian 32-bit values in *data* (which must be a
+    multiple of 4 bytes long) to the FAT *table*. This is a single copy from
+    the source buffer into the table, rather than an unpack into a tuple of
+    integers followed by an extend.
+    """
+    if sys.byteorder == 'little':
+        try:
+            table.frombytes(data)
+        except AttributeError:
+            # Python 2.x
+            table.fromstring(bytes(data))
+    else:
+        temp = array(FAT_TYPECODE)
+        try:
+            temp.frombytes(data)
+        except AttributeError:
+            temp.fromstring(bytes(data))
+        temp.byteswap()
+        table.extend(temp)
+
+
+class LazyFatTable(object):
+    """
+    Provides a read-only, lazily loaded view of the normal-FAT.
+
+    The :class:`LazyFatTable` class can be used in place of the array normally
+    holding the normal-FAT of a compound document. Each "page" of the table
+    (the entries held in a single FAT sector, as listed by one entry of the
+    master-FAT) is only decoded the first time a lookup touches it. Decoded
+    pages are kept in a page table which is limited to *max_pages* entries;
+    when the limit is exceeded the least recently used page is evicted.
+
+    The checks that master-FAT and normal-FAT sectors are marked correctly in
+    the normal-FAT are performed as each page is decoded. Warnings about
+    mis-marked sectors are only issued the first time a page is decoded,
+    although the correction is applied every time.
+    """
+
+    def __init__(self, reader, master_sectors, max_pages=1024):
+        self._lock = threading.Lock()
+        self._reader = reader
+        self._master_fat = reader._master_fat
+        self._page_size = reader._normal_sector_size // 4
+        self._max_pages = max_pages
+        self._pages = OrderedDict()
+        self._checked = set()
+        # Pre-calculate which pages contain the master-FAT and normal-FAT
+        # sector markers, so each page can be verified as it's decoded
+        # (unless the reader trusts the document, in which case no pages are
+        # verified)
+        self._marks = {}
+        checks = () if reader._validation == 'trusted' else (
+                (master_sectors, MASTER_FAT_SECTOR),
+                (self._master_fat, NORMAL_FAT_SECTOR),
+                )
+        for sectors, marker in checks:
+            for sector in sectors:
+                page, offset = divmod(sector, self._page_size)
+                self._marks.setdefault(page, []).append(
+                        (sector, offset, marker))
+
+    def __len__(self):
+        return len(self._master_fat) * self._page_size
+
+    def __getitem__(self, index):
+        page, offset = divmod(index, self._page_size)
+        with self._lock:
+            try:
+                # Re-insert the page to mark it as most recently used
+                data = self._pages.pop(page)
+            except KeyError:
+                data = self._load_page(page)
+            self._pages[page] = data
+            return data[offset]
+
+    def __setitem__(self, index, value):
+        raise TypeError('lazy FAT is read-only')
+
+    def _load_page(self, page):
+        if not 0 <= page < len(self._master_fat):
+            raise IndexError('FAT index out of range')
+        data = fat_array(self._reader._read_sector(self._master_fat[page]))
+        warn = page not in self._checked
+        for sector, offset, marker in self._marks.get(page, ()):
+            if data[offset] != marker:
+                if warn:
+                    self._reader._warn(
+                        (
+                            CompoundFileMasterSectorWarning
+                            if marker == MASTER_FAT_SECTOR else
+                            CompoundFileNormalSectorWarning
+                        )(
+                            '%s sector %d marked incorrectly in FAT '
+                            '(%d != %d)' % (
+                                'DIFAT' if marker == MASTER_FAT_SECTOR else
+                                'FAT',
+                                sector,
+                                data[offset],
+                                marker,
+                                )
+                            ),
+                        'sector', sector)
+                data[offset] = marker
+        # Only mark the page checked once its warnings have been issued;
+        # under strict validation _warn raises, so the page must be checked
+        # again if it's re-read
+        self._checked.add(page)
+        while len(self._pages) >= self._max_pages:
+            self._pages.popitem(last=False)
+        return data
+
+    def to_array(self):
+        """
+        Returns the entire table as an :class:`~array.array`. This reads every
+        page of the table, but does not add them to the page table.
+        """
+        result = fat_array()
+        for page in range(len(self._master_fat)):
+            with self._lock:
+                data = self._pages.get(page)
+                if data is None:
+                    data = self._load_page(page)
+            result.extend(data)
+        return result
+
+    @property
+    def loaded_pages(self):
+        """
+        Returns the number of pages currently held in the page table.
+        """
+        return len(self._pages)
+
+
+class SectorChain(object):
+    """
+    Represents the chain of sectors beginning at *start* in *fat* (either the
+    normal-FAT or the mini-FAT of a document).
+
+    The chain is stored as a sequence of extents (runs of physically
+    contiguous sectors). The :attr:`sectors` array holds the first sector of
+    each extent, and the :attr:`offsets` array holds the number of sectors in
+    the chain preceding each extent, plus a final element holding the number
+    of sectors followed so far. Hence extent ``i`` covers sectors
+    ``offsets[i]`` to ``offsets[i + 1]`` of the chain, and the extent
+    containing any sector of the chain can be found by bisection.
+
+    If *acyclic* is ``True`` the chain is known not to loop (e.g. from a
+    :class:`FatAnalysis`) and no cycle detection is performed while following
+    it.
+
+    If *max_length* is specified, :exc:`CompoundFileBudgetError` is raised if
+    the chain is found to be longer than *max_length* sectors.
+
+    The chain is only followed when :meth:`resolve` is called, which permits
+    it to be followed incrementally. As chains are shared between all streams
+    opened on the same chain (see :meth:`CompoundFileReader.chain_cache_info`)
+    :meth:`resolve` may be safely called from multiple threads.
+    """
+
+    def __init__(self, fat, start, acyclic=False, max_length=None):
+        self._lock = threading.Lock()
+        self._fat = fat
+        self._acyclic = acyclic
+        self._max_length = max_length
+        self.start = start
+        self.sectors = array(FAT_TYPECODE)
+        self.offsets = array(FAT_TYPECODE, [0])
+        self.next_sector = start
+        # State for Brent's cycle detection algorithm; this works with a
+        # single pass over the chain, so (unlike tortoise'n'hare) it can be
+        # performed incrementally as the chain is followed
+        self._tortoise = None
+        self._power = self._steps = 1
+
+    def resolve(self, index=None):
+        """
+        Follows the chain until it covers sector *index* of the chain, or to
+        the end of the chain if *index* is ``None``.
+        """
+        # To guard against cyclic FAT chains, at every power of two steps we
+        # remember the current sector as the "tortoise". If we ever encounter
+        # the tortoise again the chain must loop, so we raise an error
+        with self._lock:
+            sectors = self.sectors
+            offsets = self.offsets
+            fat = self._fat
+            sector = self.next_sector
+            while sector != END_OF_CHAIN and (
+                    index is None or offsets[-1] <= index):
+                if offsets[-1] == self._max_length:
+                    raise CompoundFileBudgetError(
+                            'chain starting at %d exceeds budget (%d '
+                            'sectors)' % (self.start, self._max_length))
+                if self._acyclic:
+                    pass
+                elif sector == self._tortoise:
+                    raise CompoundFileNormalLoopError(
+                            'cyclic FAT chain found starting at %d' %
+                            self.start)
+                elif self._steps == self._power:
+                    self._tortoise = sector
+                    self._power *= 2
+                    self._steps = 0
+                self._steps += 1
+                if sectors and sector == (
+                        sectors[-1] + offsets[-1] - offsets[-2]):
+                    offsets[-1] += 1
+                else:
+                    # Extend offsets first so that threads reading the chain
+                    # never see an extent without a corresponding end
+                    offsets.append(offsets[-1] + 1)
+                    sectors.append(sector)
+                sector = fat[sector]
+                self.next_sector = sector
+
+
+class FatAnalysis(object):
+    """
+    Analyzes every chain in *fat* (either the normal-FAT or the mini-FAT of a
+    document) in a single linear pass.
+
+    For every sector that is part of a chain (i.e. whose FAT entry is either
+    ``END_OF_CHAIN`` or the next sector of a chain), the analysis determines
+    the sector at the head of its chain, its position within that chain, and
+    whether the chain it's part of is cyclic (never reaches ``END_OF_CHAIN``),
+    or cross-linked (the sector is reachable from more than one chain head).
+
+    The results are available from the :attr:`heads` and :attr:`positions`
+    arrays, and the :attr:`flags` bytearray (each element of which is a
+    combination of :attr:`MEMBER`, :attr:`CYCLIC`, and :attr:`CROSS_LINKED`),
+    all of which are indexed by sector. Sectors which aren't part of a chain
+    have a head of ``FREE_SECTOR``. Sectors in cycles which have no head (a
+    chain which loops back to its start) are considered to be headed by the
+    lowest numbered sector in the cycle.
+    """
+
+    MEMBER = 1
+    CYCLIC = 2
+    CROSS_LINKED = 4
+
+    def __init__(self, fat):
+        if not isinstance(fat, array):
+            fat = fat.to_array()
+        count = len(fat)
+        self.heads = heads = array(FAT_TYPECODE, [FREE_SECTOR]) * count
+        self.positions = positions = array(FAT_TYPECODE, [0]) * count
+        self.flags = flags = bytearray(count)
+        # Determine which sectors are chain members, and which are referenced
+        # by another sector; members which aren't referenced are chain heads
+        referenced = bytearray(count)
+        for sector, value in enumerate(fat):
+            if value < count:
+                flags[sector] = self.MEMBER
+                referenced[value] = 1
+            elif value == END_OF_CHAIN:
+                flags[sector] = self.MEMBER
+        # Walk the chain from each head, marking each sector as visited (by
+        # assigning it a head). If a walk encounters a sector visited by a
+        # prior walk, the chains are cross-linked; if it encounters a sector
+        # visited by the same walk, the chain is cyclic. As each sector is
+        # only flagged once for each condition, the whole pass is linear
+        for head in range(count):
+            if referenced[head] or not flags[head]:
+                continue
+            sector = head
+            position = 0
+            while True:
+                heads[sector] = head
+                positions[sector] = position
+                value = fat[sector]
+                if value >= count:
+                    # END_OF_CHAIN (or an invalid sector, which we leave for
+                    # the stream following the chain to report)
+                    break
+                if heads[value] != FREE_SECTOR:
+                    if heads[value] == head:
+                        self._mark(fat, head, position + 1, self.CYCLIC)
+                    else:
+                        self._mark_cross_linked(fat, value)
+                        if flags[value] & self.CYCLIC:
+                            self._mark(fat, head, position + 1, self.CYCLIC)
+                    break
+                sector = value
+                position += 1
+        # Any members remaining unvisited are in cycles without a head
+        for start in range(count):
+            if flags[start] and heads[start] == FREE_SECTOR:
+                sector = start
+                position = 0
+                while heads[sector] == FREE_SECTOR:
+                    heads[sector] = start
+                    positions[sector] = position
+                    flags[sector] |= self.CYCLIC
+                    sector = fat[sector]
+                    position += 1
+
+    def _mark(self, fat, sector, count, flag):
+        # Marks count sectors from sector onwards in the chain with flag
+        flags = self.flags
+        for i in range(count):
+            flags[sector] |= flag
+            sector = fat[sector]
+
+    def _mark_cross_linked(self, fat, sector):
+        # Marks sector, and every sector following it in its chain, as
+        # cross-linked (stopping at any sector already marked, so a cyclic
+        # chain isn't followed forever)
+        flags = self.flags
+        count = len(flags)
+        while sector < count and not flags[sector] & self.CROSS_LINKED:
+            flags[sector] |= self.CROSS_LINKED
+            sector = fat[sector]
+
+    def __len__(self):
+        return len(self.flags)
+
+    def is_member(self, sector):
+        """
+        Returns ``True`` if *sector* is part of a chain.
+        """
+        return 0 <= sector < len(self.flags) and bool(
+            self.flags[sector] & self.MEMBER)
+
+    def is_cyclic(self, sector):
+        """
+        Returns ``True`` if the chain starting at *sector* never ends.
+        """
+        return 0 <= sector < len(self.flags) and bool(
+            self.flags[sector] & self.CYCLIC)
+
+    def is_cross_linked(self, sector):
+        """
+        Returns ``True`` if *sector* is reachable from more than one chain
+        head.
+        """
+        return 0 <= sector < len(self.flags) and bool(
+            self.flags[sector] & self.CROSS_LINKED)
@@ -35,99 +35,120 @@ except NameError:
     pass
 
 
+import os
 import sys
 PY2 = sys.version_info[0] == 2
 import io
+import mmap
 import threading
+from collections import namedtuple, OrderedDict
 
 
-class FakeMemoryMap(object):
-    """
-    Provides an mmap-style interface for streams without a file descriptor.
+BlockCacheInfo = namedtuple('BlockCacheInfo', (
+    'hits',
+    'misses',
+    'reads',
+    'bytes_read',
+    'maxsize',
+    'currsize',
+    ))
 
-    The :class:`FakeMemoryMap` class can be used to emulate a memory-mapped
-    file in cases where a seekable file-like object is provided that doesn't
-    have a file descriptor (e.g. in-memory streams), or where a file descriptor
-    exists but "real" mmap cannot be used for other reasons (e.g.
-    >2Gb files on a 32-bit OS).
 
-    The emulated mapping is thread-safe, read-only, but obviously will be
-    considerably slower than using a "real" mmap. All methods of a real
-    read-only mmap are emulated (:meth:`find`, :meth:`read_byte`,
-    :meth:`close`, etc.) so instances can be used as drop-in replacements.
+def _window_size(file_size, offset, length):
+    # Returns the size of a mapping of length bytes from offset in a file of
+    # file_size bytes (or of the remainder of the file if length is None),
+    # raising the same exceptions as real mmap for invalid windows
+    if offset < 0:
+        raise OverflowError('memory mapped offset must be positive')
+    if length is None:
+        if offset > file_size:
+            raise ValueError('mmap offset is greater than file size')
+        return file_size - offset
+    if length < 0:
+        raise OverflowError('memory mapped length must be positive')
+    if offset + length > file_size:
+        raise ValueError('mmap length is greater than file size')
+    return length
 
-    Currently the emulation only covers the entire file (it cannot be limited
-    to a sub-range of the file as with real mmap).
+
+class BaseMemoryMap(object):
     """
+    Abstract base class for emulations of a read-only memory-mapped file.
 
-    def __init__(self, f):
-        self._lock = threading.Lock()
-        self._file = f
-        with self._lock:
-            f.seek(0, io.SEEK_END)
-            self._size = f.tell()
-            f.seek(0)
+    All methods of a real read-only mmap are emulated (:meth:`find`,
+    :meth:`read_byte`, :meth:`close`, etc.) so instances can be used as
+    drop-in replacements. Like a real mmap, the emulation has its own position
+    (for :meth:`read`, :meth:`seek`, etc.) which is independent of the
+    position of any underlying file.
+
+    Descendants must set :attr:`_size` to the size of the mapping, and
+    implement :meth:`_read_range`, which must be safe to call from multiple
+    threads simultaneously.
+    """
+
+    # The size of the chunks read by find, rfind, and readline
+    _search_size = 256 * 1024
+
+    def __init__(self):
+        self._pos_lock = threading.Lock()
+        self._pos = 0
+        self._size = 0
 
     def _read_only(self):
         raise TypeError('fake mmap is read-only')
 
+    def _read_range(self, start, stop):
+        # Returns the content of the mapping from start to stop (which must
+        # lie within the mapping)
+        raise NotImplementedError
+
     def __len__(self):
         return self._size
 
     def __getitem__(self, key):
-        with self._lock:
-            save_pos = self._file.tell()
-            try:
-                if not isinstance(key, slice):
-                    if key < 0:
-                        key += self._size
-                    if not (0 <= key < self._size):
-                        raise IndexError('fake mmap index out of range')
-                    self._file.seek(key)
-                    if PY2:
-                        return self._file.read(1)
-                    return ord(self._file.read(1))
-                step = 1 if key.step is None else key.step
-                if step > 0:
-                    start = min(self._size, max(0, (
-                        0 if key.start is None else
-                        key.start + self._size if key.start < 0 else
-                        key.start
-                        )))
-                    stop = min(self._size, max(0, (
-                        self._size if key.stop is None else
-                        key.stop + self._size if key.stop < 0 else
-                        key.stop
-                        )))
-                    self._file.seek(start)
-                    if start >= stop:
-                        return b''
-                    return self._file.read(stop - start)[::step]
-                elif step < 0:
-                    start = min(self._size, max(0, (
-                        -1 if key.stop is None else
-                        key.stop + self._size if key.stop < 0 else
-                        key.stop
-                        ) + 1))
-                    stop = min(self._size, max(0, (
-                        self._size - 1 if key.start is None else
-                        key.start + self._size if key.start < 0 else
-                        key.start
-                        ) + 1))
-                    self._file.seek(start)
-                    if start >= stop:
-                        return b''
-                    return self._file.read(stop - start)[::-1][::-step]
-                else:
-                    raise ValueError('slice step cannot be zero')
-            finally:
-                self._file.seek(save_pos)
+        if not isinstance(key, slice):
+            if key < 0:
+                key += self._size
+            if not (0 <= key < self._size):
+                raise IndexError('fake mmap index out of range')
+            if PY2:
+                return self._read_range(key, key + 1)
+            return ord(self._read_range(key, key + 1))
+        step = 1 if key.step is None else key.step
+        if step > 0:
+            start = min(self._size, max(0, (
+                0 if key.start is None else
+                key.start + self._size if key.start < 0 else
+                key.start
+                )))
+            stop = min(self._size, max(0, (
+                self._size if key.stop is None else
+                key.stop + self._size if key.stop < 0 else
+                key.stop
+                )))
+            if step == 1:
+                return self._read_range(start, stop)
+            return self._read_range(start, stop)[::step]
+        elif step < 0:
+            start = min(self._size, max(0, (
+                -1 if key.stop is None else
+                key.stop + self._size if key.stop < 0 else
+                key.stop
+                ) + 1))
+            stop = min(self._size, max(0, (
+                self._size - 1 if key.start is None else
+                key.start + self._size if key.start < 0 else
+                key.start
+                ) + 1))
+            return self._read_range(start, stop)[::-1][::-step]
+        else:
+            raise ValueError('slice step cannot be zero')
 
     def __contains__(self, value):
         # This operates rather oddly with memory-maps; it returns a valid
         # answer if value is a single byte. Otherwise, it returns False
         if len(value) == 1:
-            return self.find(value) != 1
+            return self.find(value) != -1
         return False
 
     def __setitem__(self, index, value):
@@ -136,9 +157,9 @@ class FakeMemoryMap(object):
     def close(self):
         pass
 
-    def find(self, string, start=None, end=None):
-        # XXX Naive find; replace with Boyer-Moore?
-        l = len(string)
+    def _search_bounds(self, start, end):
+        # Clamps the start and end of a search in the same manner as a real
+        # mmap (and a slice)
         start = min(self._size, max(0,
             0 if start is None else
             self._size + start if start < 0 else
@@ -149,10 +170,25 @@ class FakeMemoryMap(object):
             self._size + end if end < 0 else
             end
             ))
-        for i in range(start, end - l + 1):
-            if self[i:i + l] == string:
-                return i
-        return -1
+        return start, end
+
+    def find(self, string, start=None, end=None):
+        # Search chunks of the range with bytes.find; successive chunks
+        # overlap by one byte less than the length of string so matches
+        # spanning chunks aren't missed
+        start, end = self._search_bounds(start, end)
+        l = len(string)
+        if start + l > end:
+            return -1
+        chunk = max(self._search_size, l * 2)
+        while True:
+            stop = min(end, start + chunk)
+            found = self._read_range(start, stop).find(string)
+            if found != -1:
+                return start + found
+            if stop == end:
+                return -1
+            start = stop - l + 1
 
     def flush(self, offset=None, size=None):
         # Seems like this should raise a read-only error, but real read-only
@@ -162,55 +198,80 @@ class FakeMemoryMap(object):
     def move(self, dest, src, count):
         self._read_only()
 
-    def read(self, num):
-        with self._lock:
-            return self._file.read(num)
+    def read(self, num=None):
+        with self._pos_lock:
+            start = self._pos
+            if num is None or num < 0:
+                stop = self._size
+            else:
+                stop = min(self._size, start + num)
+            self._pos = max(start, stop)
+            return self._read_range(start, stop)
 
     def read_byte(self):
-        # XXX Beyond EOF = ValueError
-        with self._lock:
+        with self._pos_lock:
+            if self._pos >= self._size:
+                raise ValueError('read byte out of range')
+            self._pos += 1
             if PY2:
-                return self._file.read(1)
-            return ord(self._file.read(1))
+                return self._read_range(self._pos - 1, self._pos)
+            return ord(self._read_range(self._pos - 1, self._pos))
 
     def readline(self):
-        with self._lock:
-            return self._file.readline()
+        with self._pos_lock:
+            start = self._pos
+            stop = start
+            while stop < self._size:
+                chunk = self._read_range(
+                    stop, min(self._size, stop + self._search_size))
+                found = chunk.find(b'\n')
+                if found != -1:
+                    stop += found + 1
+                    break
+                stop += len(chunk)
+            self._pos = stop
+            return self._read_range(start, stop)
 
     def resize(self, newsize):
         self._read_only()
 
     def rfind(self, string, start=None, end=None):
-        # XXX Naive find; replace with Boyer-Moore?
+        # As find, but search chunks from the end of the range backwards
+        start, end = self._search_bounds(start, end)
         l = len(string)
-        start = min(self._size, max(0,
-            0 if start is None else
-            self._size + start if start < 0 else
-            start
-            ))
-        end = min(self._size, max(0,
-            self._size if end is None else
-            self._size + end if end < 0 else
-            end
-            ))
-        print(start, end, l)
-        print(list(range(end - l, start - 1, -1)))
-        for i in range(end - l, start - 1, -1):
-            if self[i:i + l] == string:
-                return i
-        return -1
+        if start + l > end:
+            return -1
+        chunk = max(self._search_size, l * 2)
+        while True:
+            pos = max(start, end - chunk)
+            found = self._read_range(pos, end).rfind(string)
+            if found != -1:
+                return pos + found
+            if pos == start:
+                return -1
+            end = pos + l - 1
 
     def seek(self, pos, whence=io.SEEK_SET):
-        with self._lock:
-            self._file.seek(pos, whence)
-            return self._file.tell()
+        with self._pos_lock:
+            if whence == io.SEEK_SET:
+                new_pos = pos
+            elif whence == io.SEEK_CUR:
+                new_pos = self._pos + pos
+            elif whence == io.SEEK_END:
+                new_pos = self._size + pos
+            else:
+                raise ValueError('unknown seek type')
+            if not (0 <= new_pos <= self._size):
+                raise ValueError('seek out of range')
+            self._pos = new_pos
+            return new_pos
 
     def size(self):
         return self._size
 
     def tell(self):
-        with self._lock:
-            return self._file.tell()
+        with self._pos_lock:
+            return self._pos
 
     def write(self, string):
         self._read_only()
@@ -218,3 +279,349 @@ class FakeMemoryMap(object):
     def write_byte(self, byte):
         self._read_only()
 
+
+class FakeMemoryMap(BaseMemoryMap):
+    """
+    Provides an mmap-style interface for streams without a file descriptor.
+
+    The :class:`FakeMemoryMap` class can be used to emulate a memory-mapped
+    file in cases where a seekable file-like object is provided that doesn't
+    have a file descriptor (e.g. in-memory streams), or where a file descriptor
+    exists but "real" mmap cannot be used for other reasons (e.g.
+    >2Gb files on a 32-bit OS) and :class:`PreadMemoryMap` is unavailable.
+
+    The emulated mapping is thread-safe, read-only, but obviously will be
+    considerably slower than using a "real" mmap; all reads of the underlying
+    file-like object are serialized by a lock. The position of the underlying
+    file-like object is left undefined.
+
+    Content read from the underlying file is held in a cache of blocks of
+    *block_size* bytes (aligned to multiples of *block_size* within the
+    mapping, so as long as *block_size* is a multiple of the sector size, each
+    sector of a compound document lies within a single block). The cache holds
+    up to *cache_size* blocks, evicting the least recently used block when
+    full. When a block is missing from the cache, it is read along with up to
+    *readahead* following blocks in a single read. Slices spanning more than
+    *readahead* + 1 blocks bypass the cache, so large reads don't evict
+    everything else. Specify a *cache_size* of 0 to disable the cache. See
+    :meth:`cache_info` for statistics.
+
+    If *offset* is specified, the mapping starts *offset* bytes into the
+    file and covers *length* bytes (or the remainder of the file if *length*
+    is ``None``). Unlike real mmap, *offset* needn't be a multiple of the
+    page size.
+    """
+
+    def __init__(
+            self, f, block_size=4096, cache_size=256, readahead=4, offset=0,
+            length=None):
+        super(FakeMemoryMap, self).__init__()
+        if block_size < 1:
+            raise ValueError('block_size must be positive')
+        self._lock = threading.Lock()
+        self._file = f
+        self._offset = offset
+        self._block_size = block_size
+        self._blocks = OrderedDict()
+        self._cache_size = max(0, cache_size)
+        self._readahead = max(0, readahead)
+        self._hits = 0
+        self._misses = 0
+        self._reads = 0
+        self._bytes_read = 0
+        with self._lock:
+            f.seek(0, io.SEEK_END)
+            self._size = _window_size(f.tell(), offset, length)
+            f.seek(0)
+
+    def _read_file(self, offset, count):
+        # Reads count bytes from offset in the mapping. The caller must hold
+        # the lock
+        self._file.seek(self._offset + offset)
+        data = self._file.read(count)
+        # Raw streams are permitted to return less than requested
+        while len(data) < count:
+            chunk = self._file.read(count - len(data))
+            if not chunk:
+                break
+            data += chunk
+        self._reads += 1
+        self._bytes_read += len(data)
+        return data
+
+    def _get_block(self, index):
+        # Returns the content of the block at index, reading it (and the
+        # blocks that follow it, up to the readahead limit) if it isn't in
+        # the cache. The caller must hold the lock
+        try:
+            # Re-insert the block to mark it as most recently used
+            block = self._blocks.pop(index)
+        except KeyError:
+            self._misses += 1
+            size = self._block_size
+            count = min(
+                self._readahead + 1,
+                (self._size + size - 1) // size - index)
+            data = self._read_file(index * size, count * size)
+            block = data[:size]
+            for ahead in range(1, count):
+                if index + ahead not in self._blocks:
+                    self._blocks[index + ahead] = data[
+                        ahead * size:(ahead + 1) * size]
+        else:
+            self._hits += 1
+        self._blocks[index] = block
+        while len(self._blocks) > self._cache_size:
+            self._blocks.popitem(last=False)
+        return block
+
+    def _read_range(self, start, stop):
+        if start >= stop:
+            return b''
+        size = self._block_size
+        first = start // size
+        last = (stop - 1) // size
+        with self._lock:
+            if not self._cache_size or last - first > self._readahead:
+                return self._read_file(start, stop - start)
+            if first == last:
+                offset = first * size
+                return self._get_block(first)[start - offset:stop - offset]
+            data = b''.join(
+                self._get_block(index) for index in range(first, last + 1))
+        offset = first * size
+        return data[start - offset:stop - offset]
+
+    def cache_info(self):
+        """
+        Return statistics about the block cache.
+
+        The result is a :func:`~collections.namedtuple` with the fields
+        ``hits``, ``misses``, ``maxsize``, and ``currsize`` (in the same
+        manner as the ``cache_info`` method of :func:`functools.lru_cache`,
+        but counting blocks), along with ``reads`` and ``bytes_read`` which
+        count the reads made from the underlying file (including those which
+        bypassed the cache).
+        """
+        with self._lock:
+            return BlockCacheInfo(
+                self._hits, self._misses, self._reads, self._bytes_read,
+                self._cache_size, len(self._blocks))
+
+    def close(self):
+        with self._lock:
+            self._blocks.clear()
+
+
+class PreadMemoryMap(BaseMemoryMap):
+    """
+    Provides an mmap-style interface for a file descriptor using positional
+    reads.
+
+    The :class:`PreadMemoryMap` class emulates a memory-mapped file by
+    reading the file descriptor *fd* with :func:`os.pread`, which neither
+    uses nor changes the file position. It's used when a file descriptor
+    exists but "real" mmap cannot be used (e.g. >2Gb files on a 32-bit OS).
+    Unlike :class:`FakeMemoryMap`, there's no lock and no cache: each slice
+    is a single system call, so many threads can read from the mapping (e.g.
+    different streams of one document) simultaneously.
+
+    If *offset* is specified, the mapping starts *offset* bytes into the
+    file and covers *length* bytes (or the remainder of the file if *length*
+    is ``None``). Unlike real mmap, *offset* needn't be a multiple of the
+    page size.
+
+    The descriptor is not closed by :meth:`close`; it remains owned by the
+    caller. :func:`os.pread` is only available on Unix-like platforms (with
+    Python 3.3 or later); :exc:`NotImplementedError` is raised elsewhere.
+    """
+
+    def __init__(self, fd, offset=0, length=None):
+        super(PreadMemoryMap, self).__init__()
+        if not hasattr(os, 'pread'):
+            raise NotImplementedError('os.pread is not available')
+        self._fd = fd
+        self._offset = offset
+        self._size = _window_size(os.fstat(fd).st_size, offset, length)
+
+    def _read_range(self, start, stop):
+        if start >= stop:
+            return b''
+        data = os.pread(self._fd, stop - start, self._offset + start)
+        # pread may return less than requested (e.g. if interrupted)
+        while len(data) < stop - start:
+            chunk = os.pread(
+                self._fd, stop - start - len(data),
+                self._offset + start + len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+
+class WindowMemoryMap(BaseMemoryMap):
+    """
+    Provides an mmap-style interface for a file descriptor by mapping windows
+    of the file on demand.
+
+    The :class:`WindowMemoryMap` class emulates a memory-mapped file by
+    mapping windows of *window_size* bytes of the file descriptor *fd* (each
+    aligned to a multiple of *window_size* within the file; *window_size* is
+    rounded up to a multiple of :data:`mmap.ALLOCATIONGRANULARITY`) as they
+    are accessed. Up to *max_windows* windows are kept mapped, unmapping the
+    least recently used window when more are required. This consumes far less
+    address space than mapping the entire file (so it can be used when a file
+    is too large to map, e.g. on a 32-bit OS), while slices are still copied
+    from a real mmap rather than read from the file. Slices which span the
+    boundary between windows are assembled from both. See :meth:`cache_info`
+    for statistics.
+
+    If *offset* is specified, the mapping starts *offset* bytes into the
+    file and covers *length* bytes (or the remainder of the file if *length*
+    is ``None``). Unlike real mmap, *offset* needn't be a multiple of the
+    page size.
+
+    The window containing the start of the mapping is mapped on construction
+    so that failure to map (e.g. :data:`~errno.ENOMEM`) is reported
+    immediately. The descriptor is not closed by :meth:`close`; it remains
+    owned by the caller.
+    """
+
+    def __init__(
+            self, fd, window_size=64 * 1024 * 1024, max_windows=4, offset=0,
+            length=None):
+        super(WindowMemoryMap, self).__init__()
+        if window_size < 1:
+            raise ValueError('window_size must be positive')
+        if max_windows < 1:
+            raise ValueError('max_windows must be positive')
+        granularity = mmap.ALLOCATIONGRANULARITY
+        self._lock = threading.Lock()
+        self._fd = fd
+        self._offset = offset
+        self._size = _window_size(os.fstat(fd).st_size, offset, length)
+        self._window_size = (
+            (window_size + granularity - 1) // granularity * granularity)
+        self._windows = OrderedDict()
+        self._max_windows = max_windows
+        self._hits = 0
+        self._misses = 0
+        self._maps = 0
+        self._bytes_mapped = 0
+        if self._size:
+            with self._lock:
+                self._get_window(offset // self._window_size)
+
+    def _get_window(self, index):
+        # Returns the window at index, mapping it if it isn't already mapped.
+        # The caller must hold the lock
+        try:
+            # Re-insert the window to mark it as most recently used
+            window = self._windows.pop(index)
+        except KeyError:
+            self._misses += 1
+            start = index * self._window_size
+            window = mmap.mmap(
+                self._fd,
+                min(self._window_size, self._offset + self._size - start),
+                access=mmap.ACCESS_READ, offset=start)
+            self._maps += 1
+            self._bytes_mapped += len(window)
+        else:
+            self._hits += 1
+        self._windows[index] = window
+        # Evicted windows aren't closed explicitly as another thread may be
+        # slicing them; each is unmapped when its last reference is dropped
+        while len(self._windows) > self._max_windows:
+            self._windows.popitem(last=False)
+        return window
+
+    def _read_range(self, start, stop):
+        size = self._window_size
+        start += self._offset
+        stop += self._offset
+        chunks = []
+        while start < stop:
+            index = start // size
+            with self._lock:
+                window = self._get_window(index)
+            base = index * size
+            end = min(stop, base + size)
+            chunks.append(window[start - base:end - base])
+            start = end
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunks)
+
+    def cache_info(self):
+        """
+        Return statistics about the mapped windows.
+
+        The result is a :func:`~collections.namedtuple` with the fields
+        ``hits``, ``misses``, ``maxsize``, and ``currsize`` (in the same
+        manner as the ``cache_info`` method of :func:`functools.lru_cache`,
+        but counting windows), along with ``reads`` and ``bytes_read`` which
+        count the windows mapped, and the bytes they covered.
+        """
+        with self._lock:
+            return BlockCacheInfo(
+                self._hits, self._misses, self._maps, self._bytes_mapped,
+                self._max_windows, len(self._windows))
+
+    def close(self):
+        with self._lock:
+            for window in self._windows.values():
+                window.close()
+            self._windows.clear()
+
+
+class BufferMemoryMap(BaseMemoryMap):
+    """
+    Provides an mmap-style interface for an object supporting the buffer
+    protocol.
+
+    The :class:`BufferMemoryMap` class emulates a memory-mapped file for
+    content which is already in memory (e.g. :class:`bytes`,
+    :class:`bytearray`, :class:`memoryview`, or the result of
+    :meth:`io.BytesIO.getbuffer`). Slices are copied directly from *buffer*,
+    without a lock, and :attr:`view` provides a read-only :class:`memoryview`
+    of the mapping, so (unlike other emulations) the mapping can be read
+    without copying. *buffer* must be contiguous; multi-byte formats are
+    treated as bytes.
+
+    If *offset* is specified, the mapping starts *offset* bytes into *buffer*
+    and covers *length* bytes (or the remainder of *buffer* if *length* is
+    ``None``).
+
+    A view of *buffer* is held until :meth:`close` is called, which prevents
+    resizable objects (:class:`bytearray`, :class:`io.BytesIO`) from being
+    resized in the meantime. The content of *buffer* must not be modified
+    while it is mapped.
+    """
+
+    def __init__(self, buffer, offset=0, length=None):
+        super(BufferMemoryMap, self).__init__()
+        self._buffer = memoryview(buffer)
+        view = self._buffer
+        if view.ndim != 1 or view.format != 'B':
+            view = view.cast('B')
+        if hasattr(view, 'toreadonly'):
+            view = view.toreadonly()
+        self._size = _window_size(len(view), offset, length)
+        self._view = view[offset:offset + self._size]
+
+    @property
+    def view(self):
+        """
+        A read-only :class:`memoryview` of the mapping.
+        """
+        return self._view
+
+    def _read_range(self, start, stop):
+        return self._view[start:stop].tobytes()
+
+    def close(self):
+        # memoryview.release doesn't exist prior to Python 3.2
+        if hasattr(self._view, 'release'):
+            self._view.release()
+            self._buffer.release()
@@ -33,11 +33,12 @@ str = type('')
 
 
 import io
-import struct as st
+import os
 import warnings
+import threading
 import mmap
 import errno
-from array import array
+from collections import namedtuple, OrderedDict
 
 from .errors import (
     CompoundFileError,
@@ -46,6 +47,7 @@ from .errors import (
     CompoundFileLargeNormalFatError,
     CompoundFileLargeMiniFatError,
     CompoundFileMasterLoopError,
+    CompoundFileNormalLoopError,
     CompoundFileNotFoundError,
     CompoundFileNotStreamError,
     CompoundFileMasterFatWarning,
@@ -58,8 +60,22 @@ from .errors import (
     CompoundFileNormalSectorWarning,
     CompoundFileEmulationWarning,
     )
-from .mmap import FakeMemoryMap
-from .entities import CompoundFileEntity
+from .mmap import (
+    FakeMemoryMap,
+    PreadMemoryMap,
+    WindowMemoryMap,
+    BufferMemoryMap,
+    )
+from .fat import (
+    LazyFatTable,
+    SectorChain,
+    FatAnalysis,
+    fat_array,
+    extend_fat,
+    )
+from .cache import cache_path, load_index, save_index
+from .table import directory_table
+from .entities import CompoundFileEntity, LazyDirectory
 from .streams import (
     CompoundFileNormalStream,
     CompoundFileMiniStream,
@@ -77,6 +93,21 @@ from .const import (
     )
 
 
+Diagnostic = namedtuple('Diagnostic', (
+    'category',
+    'location',
+    'index',
+    'message',
+    ))
+
+ChainCacheInfo = namedtuple('ChainCacheInfo', (
+    'hits',
+    'misses',
+    'maxsize',
+    'currsize',
+    ))
+
+
 # Good grief! Since my last in-source rant it appears someone in MS actually
 # figured out how to write a decent spec! Unfortunately it appears someone in
 # the marketing department also thought that yet another name change was in
@@ -135,7 +166,13 @@ class CompoundFileReader(object):
     The class can be constructed with a filename or a file-like object. In the
     latter case, the object must support the ``read``, ``seek``, and ``tell``
     methods. For optimal usage, it should also provide a valid file descriptor
-    in response to a call to ``fileno``, but this is not mandatory.
+    in response to a call to ``fileno``, but this is not mandatory. The class
+    can also be constructed with content already in memory: an object
+    supporting the buffer protocol (e.g. :class:`bytearray` or
+    :class:`memoryview`), or a :class:`io.BytesIO` instance, which are read
+    without copying. A :class:`bytes` object is treated as a filename unless
+    it contains a NUL byte (which no filename can, but every compound
+    document does).
 
     The :attr:`root` attribute represents the root storage entity in the
     compound document. An :meth:`open` method is provided which (given a
@@ -165,51 +202,222 @@ class CompoundFileReader(object):
         support human-readable representations making it relatively simple to
         browse and extract information from compound documents simply by using
         the interactive Python command line.
+
+    .. attribute:: diagnostics
+
+        A list of every problem found in the document, in the order they were
+        found. Each is a :func:`~collections.namedtuple` with the fields
+        ``category`` (the :exc:`~compoundfiles.CompoundFileWarning` subclass
+        that was, or would have been, issued), ``location`` and ``index`` (see
+        below), and ``message``. The ``location`` is ``'header'`` for
+        problems with the header (``index`` is ``None``), ``'difat'`` for
+        problems with the DIFAT (``index`` is the offending entry of the
+        DIFAT), ``'sector'`` or ``'mini_sector'`` for problems with the
+        marking of FAT sectors or with streams (``index`` is the sector, or
+        the first sector of the stream), and ``'entry'`` for problems with
+        the directory (``index`` is the index of the directory entry). This
+        makes it simple to aggregate problems across many documents, or to
+        attribute them to a document when several are read concurrently.
+
+    If *lazy_fat* is ``True``, the normal-FAT is not read when the document is
+    opened. Instead, each sector of the normal-FAT is decoded the first time a
+    chain that passes through it is followed, and a limited number of decoded
+    sectors are retained (see :class:`~compoundfiles.fat.LazyFatTable`). This
+    can considerably reduce the time taken to open large documents when only
+    a few streams are to be read. Note that in this mode warnings about
+    mis-marked FAT sectors are issued when the affected portion of the FAT is
+    first read, rather than when the document is opened.
+
+    If *index_cache* is specified, the decoded FATs and directory of the
+    document are stored in a "sidecar" index file after the document is read,
+    and are loaded from there by subsequent opens instead of being read from
+    the document. If *index_cache* is ``True`` the index is stored alongside
+    the document (with a ``.cfidx`` suffix, preceded by *offset* if that is
+    non-zero), which requires that the document was opened by filename (or via
+    a file object with a ``name`` attribute). Alternatively, *index_cache* can
+    be the filename of the index. The index is keyed by the offset, size and
+    modification time of the document, and a hash of its header, FATs and
+    directory; a stale or corrupt index is ignored and re-written. Note that
+    warnings about the FATs or directory are only issued when the index is
+    written, not when it is loaded.
+
+    If *lazy_dir* is ``True``, only the root entry of the directory is read
+    when the document is opened. Other entries are decoded when the storage
+    containing them is first iterated or indexed. This can considerably
+    reduce the time taken to open documents with large directories when only a
+    few entries are required. Looking up an entry by name (including via
+    :meth:`open`) binary searches the red-black tree in which the directory is
+    stored, decoding only the entries on the search path, and only falls back
+    to decoding the entire storage if the name isn't found or the tree is
+    found to be out of order. In this mode, warnings about directory entries
+    (and errors about loops in the directory) are raised when the affected
+    entries are first accessed, rather than when the document is opened.
+    Writing an index (see *index_cache*) requires the whole directory, so in
+    this mode an existing index is read but never written.
+
+    If *lazy_chains* is ``True``, streams returned by :meth:`open` don't
+    follow their entire chain of sectors when opened. Instead, the chain is
+    followed only as far as each read requires, and the size of the stream is
+    taken from its directory entry (so seeking relative to the end of the
+    stream doesn't require following the chain either). This can considerably
+    reduce the time taken to read the start of very large streams. In this
+    mode, errors about cyclic chains are raised by the read which encounters
+    the cycle, and a chain which is shorter than the stream's size results in
+    :exc:`CompoundFileTruncatedWarning` when read, rather than a warning
+    about the stream's size when opened.
+
+    The chains of sectors followed by streams are cached so that repeatedly
+    opening the same stream (and opening any stream stored in the mini-FAT,
+    all of which are read from the root entry's stream) doesn't follow the
+    same chain again. The *chain_cache* parameter specifies the maximum
+    number of chains cached; when the limit is exceeded the least recently
+    used chain is evicted. Specify 0 to disable the cache. See
+    :meth:`chain_cache_info` for statistics.
+
+    If *analyze_fat* is ``True``, every chain in the normal-FAT and mini-FAT
+    is analyzed when the document is opened (see
+    :class:`~compoundfiles.fat.FatAnalysis`), and the results are stored in
+    the :attr:`fat_analysis` and :attr:`mini_fat_analysis` attributes. This
+    pass is linear in the size of the FATs (and reads the entire normal-FAT,
+    even if *lazy_fat* is specified), but means that streams no longer need
+    to check their chains for cycles as they're followed; streams starting
+    on a cyclic chain raise :exc:`CompoundFileNormalLoopError` immediately.
+    The analysis also determines which sectors are cross-linked (claimed by
+    more than one chain), which may be useful when validating documents.
+
+    If *mini_buffer* is ``True``, the content of the root entry's stream
+    (which holds the content of all streams stored in the mini-FAT) is read
+    into memory the first time such a stream is opened. Thereafter, reads
+    from streams in the mini-FAT are simple slices of this buffer, rather than
+    reads from the root entry's stream. This can considerably speed up
+    reading documents with many small streams, at the cost of holding a copy
+    of the root entry's stream in memory until the reader is closed.
+
+    The *validation* parameter specifies how thoroughly the document is
+    checked. The default, ``'default'``, issues a
+    :exc:`~compoundfiles.CompoundFileWarning` for each problem found and
+    attempts to correct it. If *validation* is ``'strict'``, each such
+    warning is raised as an exception instead. If *validation* is
+    ``'trusted'``, checks which would merely issue a warning (those of the
+    header's less important fields, the marking of FAT sectors, and each
+    field of every directory entry) are skipped entirely, which can reduce
+    the time taken to open documents from reliable sources. Invalid entry
+    types and stream sizes are still corrected, as these affect how streams
+    are read. The checks which guard against excessive memory use and endless
+    loops (in the DIFAT, the FATs, and the directory), and against streams
+    extending beyond their chains, are always performed. Note that in trusted
+    mode an index cache (see *index_cache*) is read but never written.
+
+    Problems found in the document are always recorded in
+    :attr:`diagnostics`. If *emit_warnings* is ``False``, they are not also
+    issued via the :mod:`warnings` module, which avoids its overhead and its
+    process-wide filters (which, by default, only show the first occurrence
+    of each warning).
+
+    If *budget* is specified, it must be a :class:`CompoundFileBudget`
+    limiting the resources that reading the document may consume (the number
+    of sectors read, the memory used by the FATs, the size of the directory,
+    the length of chains, and the time taken). If any limit is exceeded,
+    :exc:`CompoundFileBudgetError` is raised, either when the document is
+    opened or when a stream is read. The resources used so far are available
+    from the :attr:`budget` attribute (a copy of *budget*, or ``None``).
+
+    The *backend* parameter specifies how the document is read. If it is
+    ``'mmap'``, the document is memory mapped, which is the fastest method
+    but requires a file descriptor and enough address space for the entire
+    document. If it is ``'window'``, windows of the document are memory
+    mapped as required (see :class:`~compoundfiles.mmap.WindowMemoryMap`),
+    which requires a file descriptor but limits the address space used. If it
+    is ``'pread'``, the document is read with :func:`os.pread` (see
+    :class:`~compoundfiles.mmap.PreadMemoryMap`), which also requires a file
+    descriptor but no address space, and permits streams to be read from many
+    threads simultaneously. If it is ``'fake'``, the document is read via the
+    file-like object's ``seek`` and ``read`` methods (see
+    :class:`~compoundfiles.mmap.FakeMemoryMap`). If it is ``'buffer'``, the
+    document is sliced directly from content in memory (see
+    :class:`~compoundfiles.mmap.BufferMemoryMap`). The default, ``None``,
+    selects ``'buffer'`` for content in memory, or ``'mmap'`` if a file
+    descriptor is available, falling back to ``'window'``, then ``'pread'``
+    (or ``'fake'`` where :func:`os.pread` is unavailable) if the document
+    cannot be mapped, and ``'fake'`` otherwise. Fall backs are accompanied by
+    :exc:`CompoundFileEmulationWarning`.
+
+    The *offset* and *length* parameters can be used to read a document
+    embedded within a larger file (e.g. an attachment in a container format).
+    The document is taken to start *offset* bytes into the file, and to be
+    *length* bytes long (or to occupy the remainder of the file if *length* is
+    ``None``). Only that portion of the file is mapped; *offset* needn't be a
+    multiple of the page size. :exc:`ValueError` is raised if the portion lies
+    outside the file.
     """
 
-    def __init__(self, filename_or_obj):
+    def __init__(
+            self, filename_or_obj, lazy_fat=False, index_cache=None,
+            lazy_dir=False, lazy_chains=False, chain_cache=128,
+            analyze_fat=False, mini_buffer=False, validation='default',
+            emit_warnings=True, budget=None, backend=None, offset=0,
+            length=None):
         super(CompoundFileReader, self).__init__()
-        if isinstance(filename_or_obj, (str, bytes)):
+        if backend not in (None, 'mmap', 'window', 'pread', 'fake', 'buffer'):
+            raise ValueError('invalid backend: %r' % backend)
+        if offset < 0:
+            raise ValueError('offset must not be negative')
+        if length is not None and length < 0:
+            raise ValueError('length must not be negative')
+        self.budget = budget.start() if budget is not None else None
+        if validation not in ('strict', 'default', 'trusted'):
+            raise ValueError('invalid validation level: %r' % validation)
+        self._validation = validation
+        self._emit_warnings = emit_warnings
+        self.diagnostics = []
+        self._lazy_fat = lazy_fat
+        self._lazy_dir = lazy_dir
+        self._lazy_chains = lazy_chains
+        self._mini_buffer = mini_buffer
+        self._mini_data = None
+        self._mini_lock = threading.Lock()
+        self._chains = OrderedDict()
+        self._chains_lock = threading.Lock()
+        self._chains_size = chain_cache
+        self._chains_hits = 0
+        self._chains_misses = 0
+        if isinstance(filename_or_obj, str) or (
+                isinstance(filename_or_obj, bytes) and
+                b'\0' not in filename_or_obj):
             self._opened = True
             self._file = io.open(filename_or_obj, 'rb')
+            source = filename_or_obj
         else:
             self._opened = False
             self._file = filename_or_obj
-        try:
-            fd = self._file.fileno()
-        except (IOError, AttributeError):
-            # It's a file-like object without a valid file descriptor; use
-            # our fake mmap class (if it supports seek and tell)
-            try:
-                self._file.seek(0)
-                self._file.tell()
-            except (IOError, AttributeError):
-                raise TypeError(
-                    'filename_or_obj must support fileno(), '
-                    'or seek() and tell()')
-            else:
-                warnings.warn(
-                    CompoundFileEmulationWarning(
-                        'file-like object has no file descriptor; using '
-                        'slower emulated mmap'))
-                self._mmap = FakeMemoryMap(filename_or_obj)
+            # Only name the source in errors if it has a name; the repr of a
+            # buffer could be enormous
+            source = getattr(filename_or_obj, 'name', None)
+            if not isinstance(source, (str, bytes)):
+                source = (
+                    '<file>' if hasattr(filename_or_obj, 'read') else
+                    '<buffer>')
+        # The document starts at _base within the map; this is only non-zero
+        # when a real mmap has been aligned to an earlier page boundary
+        self._mmap, self._base = self._map_file(backend, offset, length)
+        self._offset = offset
+
+        # Where the map supports the buffer protocol (or wraps something that
+        # does), streams copy from (or return views of) this rather than
+        # slicing the map
+        if isinstance(self._mmap, BufferMemoryMap):
+            self._view = self._mmap.view
         else:
             try:
-                self._mmap = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
-            except EnvironmentError as e:
-                if e.errno == errno.ENOMEM:
-                    warnings.warn(
-                        CompoundFileEmulationWarning(
-                            'unable to map all of file into memory; using '
-                            'slower emulated mmap (use a 64-bit Python '
-                            'installation to avoid this)'))
-                    self._mmap = FakeMemoryMap(filename_or_obj)
-                else:
-                    raise
+                self._view = memoryview(self._mmap)
+            except TypeError:
+                self._view = None
 
         self._master_fat = None
         self._normal_fat = None
         self._mini_fat = None
+        self.fat_analysis = None
+        self.mini_fat_analysis = None
         self.root = None
         (
             magic,
@@ -229,86 +437,116 @@ class CompoundFileReader(object):
             self._mini_sector_count,
             self._master_first_sector,
             self._master_sector_count,
-        ) = COMPOUND_HEADER.unpack(self._mmap[:COMPOUND_HEADER.size])
+        ) = COMPOUND_HEADER.unpack(
+            self._mmap[self._base:self._base + COMPOUND_HEADER.size])
 
         # Check the header for basic correctness
         if magic != COMPOUND_MAGIC:
             raise CompoundFileInvalidMagicError(
                     '%s does not appear to be an OLE compound '
-                    'document' % filename_or_obj)
+                    'document' % source)
         if bom == 0xFEFF:
             raise CompoundFileInvalidBomError(
                     '%s uses an unsupported byte ordering (big '
-                    'endian)' % filename_or_obj)
+                    'endian)' % source)
         elif bom != 0xFFFE:
             raise CompoundFileInvalidBomError(
-                    'unable to determine byte ordering of %s' % filename_or_obj)
+                    'unable to determine byte ordering of %s' % source)
         self._normal_sector_size = 1 << normal_sector_size
         self._mini_sector_size = 1 << mini_sector_size
         if not (128 <= self._normal_sector_size <= 1048576):
-            warnings.warn(
+            self._warn(
                 CompoundFileSectorSizeWarning(
                     'FAT sector size is silly (%d bytes), '
                     'assuming 512' % self._normal_sector_size))
             self._normal_sector_size = 512
         if not (8 <= self._mini_sector_size < self._normal_sector_size):
-            warnings.warn(
+            self._warn(
                 CompoundFileSectorSizeWarning(
                     'mini FAT sector size is silly (%d bytes), '
                     'assuming 64' % self._mini_sector_size))
             self._mini_sector_size = 64
-        self._normal_sector_format = st.Struct(
-                native_str('<%dL' % (self._normal_sector_size // 4)))
-        self._mini_sector_format = st.Struct(
-                native_str('<%dL' % (self._mini_sector_size // 4)))
-        assert self._normal_sector_size == self._normal_sector_format.size
-        assert self._mini_sector_size == self._mini_sector_format.size
-
-        # More correctness checks, but mostly warnings at this stage
-        if self._dll_version == 3:
-            if self._normal_sector_size != 512:
-                warnings.warn(
+
+        # More correctness checks, but only warnings at this stage (so they're
+        # skipped entirely for trusted documents)
+        if self._validation != 'trusted':
+            if self._dll_version == 3:
+                if self._normal_sector_size != 512:
+                    self._warn(
+                        CompoundFileSectorSizeWarning(
+                            'unexpected sector size in v3 file '
+                            '(%d)' % self._normal_sector_size))
+                if self._dir_sector_count != 0:
+                    self._warn(
+                        CompoundFileHeaderWarning(
+                            'directory chain sector count is non-zero '
+                            '(%d)' % self._dir_sector_count))
+            elif self._dll_version == 4:
+                if self._normal_sector_size != 4096:
+                    self._warn(
+                        CompoundFileSectorSizeWarning(
+                            'unexpected sector size in v4 file '
+                            '(%d)' % self._normal_sector_size))
+            else:
+                self._warn(
+                    CompoundFileVersionWarning(
+                        'unrecognized DLL version (%d)' % self._dll_version))
+            if self._mini_sector_size != 64:
+                self._warn(
                     CompoundFileSectorSizeWarning(
-                        'unexpected sector size in v3 file '
-                        '(%d)' % self._normal_sector_size))
-            if self._dir_sector_count != 0:
-                warnings.warn(
+                        'unexpected mini sector size '
+                        '(%d)' % self._mini_sector_size))
+            if uuid != (b'\0' * 16):
+                self._warn(
                     CompoundFileHeaderWarning(
-                        'directory chain sector count is non-zero '
-                        '(%d)' % self._dir_sector_count))
-        elif self._dll_version == 4:
-            if self._normal_sector_size != 4096:
-                warnings.warn(
-                    CompoundFileSectorSizeWarning(
-                        'unexpected sector size in v4 file '
-                        '(%d)' % self._normal_sector_size))
-        else:
-            warnings.warn(
-                CompoundFileVersionWarning(
-                    'unrecognized DLL version (%d)' % self._dll_version))
-        if self._mini_sector_size != 64:
-            warnings.warn(
-                CompoundFileSectorSizeWarning(
-                    'unexpected mini sector size '
-                    '(%d)' % self._mini_sector_size))
-        if uuid != (b'\0' * 16):
-            warnings.warn(
-                CompoundFileHeaderWarning(
-                    'CLSID of compound file is non-zero (%r)' % uuid))
-        if txn_signature != 0:
-            warnings.warn(
-                CompoundFileHeaderWarning(
-                    'transaction signature is non-zero (%d)' % txn_signature))
-        if unused != (b'\0' * 6):
-            warnings.warn(
-                CompoundFileHeaderWarning(
-                    'unused header bytes are non-zero (%r)' % unused))
-        self._file_size = self._mmap.size()
+                        'CLSID of compound file is non-zero (%r)' % uuid))
+            if txn_signature != 0:
+                self._warn(
+                    CompoundFileHeaderWarning(
+                        'transaction signature is non-zero (%d)' % txn_signature))
+            if unused != (b'\0' * 6):
+                self._warn(
+                    CompoundFileHeaderWarning(
+                        'unused header bytes are non-zero (%r)' % unused))
+        self._file_size = len(self._mmap) - self._base
         self._header_size = max(self._normal_sector_size, 512)
         self._max_sector = (self._file_size - self._header_size) // self._normal_sector_size
-        self._load_normal_fat(self._load_master_fat())
-        self._load_mini_fat()
-        self._load_directory()
+        if index_cache is True:
+            index_cache = getattr(self._file, 'name', None)
+            if not isinstance(index_cache, (str, bytes)):
+                raise ValueError(
+                    'index_cache=True requires a filename, or a file-like '
+                    'object with a name')
+            index_cache = cache_path(index_cache, offset)
+        # An index doesn't record the warnings issued when it was written, so
+        # strict validation ignores any existing index. Likewise, trusted
+        # validation doesn't correct the directory, and a lazy directory
+        # would have to be read in full, so neither writes one
+        if (
+                not index_cache or self._validation == 'strict' or
+                not load_index(self, index_cache)):
+            self._load_normal_fat(self._load_master_fat())
+            self._load_mini_fat()
+            self._load_directory()
+            if (
+                    index_cache and self._validation != 'trusted' and
+                    not self._lazy_dir):
+                save_index(self, index_cache)
+        elif self.budget is not None:
+            # Tables loaded from the index still count against the budget
+            self.budget._charge_memory(4 * (
+                len(self._master_fat) + len(self._normal_fat) +
+                len(self._mini_fat)))
+        if analyze_fat:
+            if self.budget is not None:
+                # Each analysis holds two arrays and a bytearray, all indexed
+                # by sector
+                self.budget._charge_memory(9 * (
+                    len(self._normal_fat) + len(self._mini_fat)))
+            self.fat_analysis = FatAnalysis(self._normal_fat)
+            self.mini_fat_analysis = FatAnalysis(self._mini_fat)
+            if self.budget is not None:
+                self.budget._check_time()
 
     def open(self, filename_or_entity):
         """
@@ -343,13 +581,113 @@ class CompoundFileReader(object):
                 self, filename_or_entity._start_sector,
                 filename_or_entity.size)
 
+    def directory_table(self, use_numpy=None):
+        """
+        Return the content of every entry in the directory as columns.
+
+        This method decodes the entire directory stream in a single pass,
+        returning each field of each entry (including unused and unreachable
+        entries) as a column, rather than constructing a
+        :class:`CompoundFileEntity` for each entry. This is intended for
+        analysis of large numbers of documents where column-wise filtering
+        and aggregation are more useful than a tree of Python objects.
+
+        The values are returned as stored in the document; none of the
+        corrections or warnings performed by :class:`CompoundFileEntity` are
+        applied. The columns are:
+
+        * ``index`` - the index of the entry in the directory
+        * ``name`` - the decoded name of the entry
+        * ``type`` - the entry type (see :mod:`compoundfiles.const`)
+        * ``color`` - the red-black tree color (0 for red, 1 for black)
+        * ``left``, ``right``, ``child`` - the indexes of the left and right
+          siblings, and the root child of the entry
+        * ``start_sector`` - the first sector of the entry's stream
+        * ``size`` - the size of the entry's stream
+        * ``created``, ``modified`` - the raw FILETIME timestamps of the entry
+          (the number of 100ns intervals since 1601-01-01, or 0 if unset)
+        * ``parent`` - the index of the storage containing the entry, or
+          ``NO_STREAM`` if the entry is the root or is unreachable
+        * ``path`` - the full path of the entry (as accepted by :meth:`open`),
+          an empty string for the root, or ``None`` if the entry is
+          unreachable
+
+        If NumPy is available (or *use_numpy* is ``True``), the result is a
+        NumPy structured array with a field for each column. If NumPy is
+        unavailable (or *use_numpy* is ``False``), the result is a dict
+        mapping each column name to an :class:`~array.array` (or a list for
+        the ``name`` and ``path`` columns).
+        """
+        return directory_table(self, use_numpy)
+
+    def chain_cache_info(self):
+        """
+        Return statistics about the cache of sector chains.
+
+        The result is a :func:`~collections.namedtuple` with the fields
+        ``hits``, ``misses``, ``maxsize``, and ``currsize``, in the same
+        manner as the ``cache_info`` method of :func:`functools.lru_cache`.
+        """
+        with self._chains_lock:
+            return ChainCacheInfo(
+                self._chains_hits, self._chains_misses, self._chains_size,
+                len(self._chains))
+
+    def _get_chain(self, kind, start):
+        # Returns the SectorChain beginning at start in the normal-FAT (if kind
+        # is 'normal') or the mini-FAT (if kind is 'mini'). Chains are
+        # retrieved from (and added to) the LRU chain cache where possible
+        key = (kind, start)
+        with self._chains_lock:
+            try:
+                # Re-insert the chain to mark it as most recently used
+                chain = self._chains.pop(key)
+            except KeyError:
+                self._chains_misses += 1
+                if kind == 'normal':
+                    fat, analysis = self._normal_fat, self.fat_analysis
+                else:
+                    fat, analysis = self._mini_fat, self.mini_fat_analysis
+                acyclic = False
+                if analysis is not None:
+                    if analysis.is_cyclic(start):
+                        raise CompoundFileNormalLoopError(
+                            'cyclic FAT chain found starting at %d' % start)
+                    acyclic = analysis.is_member(start)
+                chain = SectorChain(
+                    fat, start, acyclic,
+                    None if self.budget is None else self.budget.chain_length)
+            else:
+                self._chains_hits += 1
+            if self._chains_size > 0:
+                self._chains[key] = chain
+                while len(self._chains) > self._chains_size:
+                    self._chains.popitem(last=False)
+            return chain
+
+    def _get_mini_buffer(self):
+        # Returns the content of the root entry's stream (the mini stream),
+        # and a memoryview of it, reading it the first time this is called
+        with self._mini_lock:
+            if self._mini_data is None:
+                with CompoundFileNormalStream(
+                        self, self.root._start_sector, self.root.size) as f:
+                    data = f.read()
+                self._mini_data = (data, memoryview(data))
+            return self._mini_data
+
     def close(self):
         try:
+            # memoryview.release doesn't exist prior to Python 3.2
+            if self._view is not None and hasattr(self._view, 'release'):
+                self._view.release()
             self._mmap.close()
             if self._opened:
                 self._file.close()
         finally:
             self._mmap = None
+            self._view = None
+            self._mini_data = None
             self._file = None
 
     def __enter__(self):
@@ -358,11 +696,174 @@ class CompoundFileReader(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+    def _map_file(self, backend, offset=0, length=None):
+        # Returns a memory map (real or emulated) of length bytes of the file
+        # from offset (or the remainder of the file if length is None), using
+        # the specified backend or (if backend is None) the best available,
+        # along with the position of offset within the map
+        if backend in (None, 'buffer'):
+            # Content that is already in memory is sliced directly (BytesIO
+            # supports the buffer protocol only via getbuffer)
+            try:
+                buf = self._file.getbuffer()
+            except AttributeError:
+                try:
+                    buf = memoryview(self._file)
+                except TypeError:
+                    buf = None
+            if buf is not None:
+                return self._map_emulated(BufferMemoryMap, buf, offset, length)
+            if backend == 'buffer':
+                raise ValueError(
+                    'the buffer backend requires an object supporting the '
+                    'buffer protocol')
+        try:
+            fd = self._file.fileno()
+        except (IOError, AttributeError):
+            fd = None
+        if backend == 'fake' or (backend is None and fd is None):
+            # It's a file-like object without a valid file descriptor (or
+            # emulation was requested); use our fake mmap class (if it
+            # supports seek and tell)
+            try:
+                self._file.seek(0)
+                self._file.tell()
+            except (IOError, AttributeError):
+                raise TypeError(
+                    'filename_or_obj must support fileno(), '
+                    'or seek() and tell()')
+            if backend is None:
+                warnings.warn(
+                    CompoundFileEmulationWarning(
+                        'file-like object has no file descriptor; using '
+                        'slower emulated mmap'))
+            return self._map_emulated(FakeMemoryMap, self._file, offset, length)
+        if fd is None:
+            raise ValueError(
+                'the %s backend requires a file descriptor' % backend)
+        if backend == 'window':
+            return self._map_emulated(WindowMemoryMap, fd, offset, length)
+        if backend == 'pread':
+            return self._map_emulated(PreadMemoryMap, fd, offset, length)
+        try:
+            if offset == 0 and length is None:
+                return mmap.mmap(fd, 0, access=mmap.ACCESS_READ), 0
+            # Real mmap offsets must be a multiple of the allocation
+            # granularity, so map from the preceding boundary
+            file_size = os.fstat(fd).st_size
+            if offset > file_size:
+                raise ValueError('offset is beyond the end of the file')
+            if length is None:
+                length = file_size - offset
+            elif offset + length > file_size:
+                raise ValueError('length extends beyond the end of the file')
+            if length == 0:
+                raise ValueError('cannot mmap an empty file')
+            base = offset % mmap.ALLOCATIONGRANULARITY
+            return mmap.mmap(
+                fd, base + length, access=mmap.ACCESS_READ,
+                offset=offset - base), base
+        except EnvironmentError as e:
+            if backend is not None or e.errno != errno.ENOMEM:
+                raise
+        # Mapping a few windows of the file may still succeed; failing that,
+        # we can read the file without mapping it at all
+        try:
+            result = self._map_emulated(WindowMemoryMap, fd, offset, length)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOMEM:
+                raise
+        else:
+            warnings.warn(
+                CompoundFileEmulationWarning(
+                    'unable to map all of file into memory; mapping windows '
+                    'of it as required (use a 64-bit Python installation to '
+                    'avoid this)'))
+            return result
+        # Positional reads are preferred to the fake mmap as they don't
+        # serialize reads from multiple threads
+        if hasattr(os, 'pread'):
+            warnings.warn(
+                CompoundFileEmulationWarning(
+                    'unable to map all of file into memory; using '
+                    'positional reads (use a 64-bit Python installation to '
+                    'avoid this)'))
+            return self._map_emulated(PreadMemoryMap, fd, offset, length)
+        warnings.warn(
+            CompoundFileEmulationWarning(
+                'unable to map all of file into memory; using '
+                'slower emulated mmap (use a 64-bit Python '
+                'installation to avoid this)'))
+        return self._map_emulated(FakeMemoryMap, self._file, offset, length)
+
+    def _map_emulated(self, cls, f, offset, length):
+        # Returns an emulated map of the specified portion of f; emulated maps
+        # have no alignment restrictions, so the document starts at 0 within
+        # them
+        try:
+            return cls(f, offset=offset, length=length), 0
+        except (ValueError, OverflowError):
+            raise ValueError('offset or length lies beyond the end of the file')
+
+    def _warn(self, warning, location='header', index=None):
+        # All warnings about the content of the document are issued via this
+        # method, which records them in diagnostics, and raises them instead
+        # under strict validation. The location is one of 'header', 'difat',
+        # 'sector', 'mini_sector', or 'entry', and index is the index within
+        # that location (if any)
+        self.diagnostics.append(
+            Diagnostic(type(warning), location, index, str(warning)))
+        if self._validation == 'strict':
+            raise warning
+        if self._emit_warnings:
+            warnings.warn(warning, stacklevel=2)
+
     def _read_sector(self, sector):
         if sector > self._max_sector:
             raise CompoundFileError('read from invalid sector (%d)' % sector)
-        offset = self._header_size + (sector * self._normal_sector_size)
-        return self._mmap[offset:offset + self._normal_sector_size]
+        if self.budget is not None:
+            self.budget._charge_reads(1)
+        offset = (
+            self._base + self._header_size +
+            (sector * self._normal_sector_size))
+        result = self._mmap[offset:offset + self._normal_sector_size]
+        if len(result) != self._normal_sector_size:
+            raise CompoundFileError(
+                'read from truncated sector (%d)' % sector)
+        return result
+
+    def _read_sectors(self, sectors, max_bytes=8*1024*1024):
+        # Yields the content of the specified sequence of sectors, coalescing
+        # runs of physically contiguous sectors into a single read (of up to
+        # max_bytes). This is used to load the tables of the normal-FAT which
+        # are typically largely contiguous
+        max_run = max(1, max_bytes // self._normal_sector_size)
+        run_start = run_len = 0
+        for sector in sectors:
+            if run_len and sector == run_start + run_len and run_len < max_run:
+                run_len += 1
+            else:
+                if run_len:
+                    yield self._read_run(run_start, run_len)
+                run_start, run_len = sector, 1
+        if run_len:
+            yield self._read_run(run_start, run_len)
+
+    def _read_run(self, sector, count):
+        if sector + count - 1 > self._max_sector:
+            raise CompoundFileError(
+                'read from invalid sector (%d)' % (sector + count - 1))
+        if self.budget is not None:
+            self.budget._charge_reads(count)
+        offset = (
+            self._base + self._header_size +
+            (sector * self._normal_sector_size))
+        result = self._mmap[offset:offset + count * self._normal_sector_size]
+        if len(result) != count * self._normal_sector_size:
+            raise CompoundFileError(
+                'read from truncated sector (%d)' % (
+                    sector + len(result) // self._normal_sector_size))
+        return result
 
     def _load_master_fat(self):
         # Note: when reading the master-FAT we deliberately disregard the
@@ -372,30 +873,29 @@ class CompoundFileReader(object):
         # In order to avoid infinite loops (in the case of a stupid or
         # malicious file) we keep track of each sector we seek to and quit in
         # the event of a repeat
-        self._master_fat = array(native_str('L'))
         count = self._master_sector_count
         checked = 0
         sectors = set()
 
         # Special case: the first 109 entries are stored at the end of the file
         # header and the next sector of the master-FAT is stored in the header
-        offset = COMPOUND_HEADER.size
-        self._master_fat.extend(
-                st.unpack(native_str('<109L'),
-                    self._mmap[offset:offset + (109 * 4)]))
+        offset = self._base + COMPOUND_HEADER.size
+        if self.budget is not None:
+            self.budget._charge_memory(109 * 4)
+        self._master_fat = fat_array(self._mmap[offset:offset + (109 * 4)])
         sector = self._master_first_sector
         if count == 0 and sector == FREE_SECTOR:
-            warnings.warn(
+            self._warn(
                 CompoundFileMasterFatWarning(
                     'DIFAT extension pointer is FREE_SECTOR, assuming no '
                     'extension'))
             sector = END_OF_CHAIN
         elif count == 0 and sector != END_OF_CHAIN:
-            warnings.warn(
+            self._warn(
                 CompoundFileMasterFatWarning(
                     'DIFAT extension pointer with zero count'))
         elif count != 0 and sector == END_OF_CHAIN:
-            warnings.warn(
+            self._warn(
                 CompoundFileMasterFatWarning(
                     'DIFAT chained from header, or incorrect count'))
             sector = self._master_fat.pop()
@@ -408,15 +908,17 @@ class CompoundFileReader(object):
                     if value in (END_OF_CHAIN, FREE_SECTOR):
                         pass
                     elif value > MAX_NORMAL_SECTOR:
-                        warnings.warn(
+                        self._warn(
                             CompoundFileMasterFatWarning(
                                 'DIFAT terminated by invalid special '
-                                'value (%d)' % value))
+                                'value (%d)' % value),
+                            'difat', index)
                     else:
-                        warnings.warn(
+                        self._warn(
                             CompoundFileMasterFatWarning(
                                 'sector in DIFAT chain beyond file '
-                                'end (%d)' % value))
+                                'end (%d)' % value),
+                            'difat', index)
                     value = END_OF_CHAIN
                     break
             if value == END_OF_CHAIN:
@@ -430,9 +932,9 @@ class CompoundFileReader(object):
             # last value
             count -= 1
             sectors.add(sector)
-            self._master_fat.extend(
-                    self._normal_sector_format.unpack(
-                        self._read_sector(sector)))
+            if self.budget is not None:
+                self.budget._charge_memory(self._normal_sector_size)
+            extend_fat(self._master_fat, self._read_sector(sector))
             # Guard against malicious files which could cause excessive memory
             # allocation when reading the normal-FAT. If the normal-FAT alone
             # would exceed 100Mb of RAM, raise an error
@@ -445,16 +947,16 @@ class CompoundFileReader(object):
                         'DIFAT loop encountered (sector %d)' % sector)
 
         if count > 0:
-            warnings.warn(
+            self._warn(
                 CompoundFileMasterFatWarning(
                     'DIFAT end encountered early (expected %d more sectors)' % count))
         elif count < 0:
-            warnings.warn(
+            self._warn(
                 CompoundFileMasterFatWarning(
                     'DIFAT end encountered late (overran by %d sectors)' % -count))
         self._master_sector_count -= count
         if len(self._master_fat) != self._normal_sector_count:
-            warnings.warn(
+            self._warn(
                 CompoundFileMasterFatWarning(
                     'DIFAT length does not match FAT sector count '
                     '(%d != %d)' % (len(self._master_fat), self._normal_sector_count)))
@@ -468,21 +970,31 @@ class CompoundFileReader(object):
         # to (no need to check for loops or invalid sectors here though - the
         # _load_master_fat method takes of those). After reading the normal-FAT
         # we check the master-FAT and normal-FAT sectors are marked correctly.
-        self._normal_fat = array(native_str('L'))
-        # XXX This is the major cost at the moment - reading the fragmented
-        # sectors of the FAT into an array. Perhaps look at optimizing reads
-        # of contiguous sectors? Or make the array lazy-read whenever a block
-        # needs filling?
-        for sector in self._master_fat:
-            self._normal_fat.extend(
-                    self._normal_sector_format.unpack(
-                        self._read_sector(sector)))
+        if self._lazy_fat:
+            # In lazy mode, the table reads (and verifies) each sector of the
+            # normal-FAT as it's required
+            self._normal_fat = LazyFatTable(self, master_sectors)
+            if self.budget is not None:
+                self.budget._charge_memory(self._normal_sector_size * min(
+                    len(self._master_fat), self._normal_fat._max_pages))
+            return
+        if self.budget is not None:
+            self.budget._charge_memory(
+                len(self._master_fat) * self._normal_sector_size)
+        # Reading the FAT is the major cost of opening a document, so runs of
+        # contiguous FAT sectors (the common case) are read with a single
+        # slice, and copied straight into the array without unpacking
+        self._normal_fat = fat_array()
+        for data in self._read_sectors(self._master_fat):
+            extend_fat(self._normal_fat, data)
 
         # The following simply verifies that all normal-FAT and master-FAT
         # sectors are marked appropriately in the normal-FAT
+        if self._validation == 'trusted':
+            return
         for master_sector in master_sectors:
             if self._normal_fat[master_sector] != MASTER_FAT_SECTOR:
-                warnings.warn(
+                self._warn(
                     CompoundFileMasterSectorWarning(
                         'DIFAT sector %d marked incorrectly in FAT '
                         '(%d != %d)' % (
@@ -490,11 +1002,12 @@ class CompoundFileReader(object):
                             self._normal_fat[master_sector],
                             MASTER_FAT_SECTOR,
                             )
-                        ))
+                        ),
+                    'sector', master_sector)
                 self._normal_fat[master_sector] = MASTER_FAT_SECTOR
         for normal_sector in self._master_fat:
             if self._normal_fat[normal_sector] != NORMAL_FAT_SECTOR:
-                warnings.warn(
+                self._warn(
                     CompoundFileNormalSectorWarning(
                         'FAT sector %d marked incorrectly in FAT '
                         '(%d != %d)' % (
@@ -502,7 +1015,8 @@ class CompoundFileReader(object):
                             self._normal_fat[normal_sector],
                             NORMAL_FAT_SECTOR,
                             )
-                        ))
+                        ),
+                    'sector', normal_sector)
                 self._normal_fat[normal_sector] = NORMAL_FAT_SECTOR
 
     def _load_mini_fat(self):
@@ -512,19 +1026,22 @@ class CompoundFileReader(object):
         if self._mini_sector_count * self._normal_sector_size > 100*1024*1024:
             raise CompoundFileLargeMiniFatError(
                     'excessively large mini-FAT (malicious file?)')
-        self._mini_fat = array(native_str('L'))
+        if self.budget is not None:
+            self.budget._charge_memory(
+                self._mini_sector_count * self._normal_sector_size)
+        self._mini_fat = fat_array()
 
         # Construction of the stream below will construct the list of sectors
         # the mini-FAT occupies, and will constrain the length to the declared
         # mini-FAT sector count, or the number of occupied sectors (whichever
         # is shorter)
         if self._mini_first_sector == FREE_SECTOR:
-            warnings.warn(
+            self._warn(
                 CompoundFileMiniFatWarning(
                     'mini FAT first sector set to FREE_SECTOR'))
             self._mini_first_sector = END_OF_CHAIN
         elif self._max_sector < self._mini_first_sector <= MAX_NORMAL_SECTOR:
-            warnings.warn(
+            self._warn(
                 CompoundFileMiniFatWarning(
                     'mini FAT first sector beyond file end '
                     '(%d)' % self._mini_first_sector))
@@ -533,10 +1050,13 @@ class CompoundFileReader(object):
             with CompoundFileNormalStream(
                     self, self._mini_first_sector,
                     self._mini_sector_count * self._normal_sector_size) as stream:
-                for i in range(stream._length // self._normal_sector_size):
-                    self._mini_fat.extend(
-                            self._normal_sector_format.unpack(
-                                stream.read(self._normal_sector_format.size)))
+                data = stream.read(
+                        (stream._length // self._normal_sector_size) *
+                        self._normal_sector_size)
+                # Ignore any trailing partial sector (in case of truncation)
+                extend_fat(
+                        self._mini_fat,
+                        data[:len(data) - (len(data) % self._normal_sector_size)])
 
     def _load_directory(self):
         # When reading the directory we don't attempt to accurately reconstruct
@@ -550,6 +1070,13 @@ class CompoundFileReader(object):
         # in the directory, so we calculate an upper bound from the directory
         # stream's length
         stream = CompoundFileNormalStream(self, self._dir_first_sector)
+        if self.budget is not None:
+            self.budget._check_dir_entries(stream._length // DIR_HEADER.size)
+        if self._lazy_dir:
+            entries = LazyDirectory(self, stream)
+            self.root = entries[0]
+            entries[0] = None
+            return
         entries = [
                 CompoundFileEntity(self, stream, index)
                 for index in range(stream._length // DIR_HEADER.size)
@@ -558,7 +1085,9 @@ class CompoundFileReader(object):
         # Blank out the root entry; necessary to ensure cycle detection works
         # properly in the _build_tree method
         entries[0] = None
-        self.root._build_tree(entries)
+        self.root._build_tree(entries, self._warn)
+        if self.budget is not None:
+            self.budget._check_time()
 
     def __len__(self):
         return len(self.root)
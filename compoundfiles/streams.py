@@ -33,19 +33,29 @@ str = type('')
 
 
 import io
-import warnings
-from array import array
-from abc import abstractmethod
+from bisect import bisect_right
 
 from compoundfiles.errors import (
     CompoundFileNoMiniFatError,
-    CompoundFileNormalLoopError,
     CompoundFileDirSizeWarning,
     CompoundFileTruncatedWarning,
     )
 from compoundfiles.const import END_OF_CHAIN
 
 
+def _byte_view(b):
+    # Returns a flat, byte-oriented memoryview of the buffer b
+    view = memoryview(b)
+    if view.ndim != 1 or view.format != 'B':
+        try:
+            view = view.cast(native_str('B'))
+        except AttributeError:
+            # Python 2.x memoryviews cannot be cast
+            raise TypeError(
+                'buffers of items other than unsigned bytes require Python 3')
+    return view
+
+
 class CompoundFileStream(io.RawIOBase):
     """
     Abstract base class for streams within an OLE Compound Document.
@@ -57,31 +67,70 @@ class CompoundFileStream(io.RawIOBase):
     """
     def __init__(self):
         super(CompoundFileStream, self).__init__()
-        self._sectors = array(native_str('L'))
-        self._sector_index = None
-        self._sector_offset = None
-
-    def _load_sectors(self, start, fat):
-        # To guard against cyclic FAT chains we use the tortoise'n'hare
-        # algorithm here. If hare is ever equal to tortoise after a step, then
-        # the hare somehow got transported behind the tortoise (via a loop) so
-        # we raise an error
-        hare = start
-        tortoise = start
-        while tortoise != END_OF_CHAIN:
-            self._sectors.append(tortoise)
-            tortoise = fat[tortoise]
-            if hare != END_OF_CHAIN:
-                hare = fat[hare]
-                if hare != END_OF_CHAIN:
-                    hare = fat[hare]
-                    if hare == tortoise:
-                        raise CompoundFileNormalLoopError(
-                                'cyclic FAT chain found starting at %d' % start)
-
-    @abstractmethod
+        self._chain = None
+        self._extent = 0
+        self._pos = 0
+        self._budget = None
+
+    def _load_chain(self, chain, lazy=False):
+        # Unless lazy is True, the entire chain (a SectorChain) is followed
+        # immediately; otherwise it is followed incrementally as reads require
+        # it. The chain's arrays are extended in place, so we can keep
+        # references to them for speed
+        self._chain = chain
+        self._extent_sectors = chain.sectors
+        self._extent_offsets = chain.offsets
+        if not lazy:
+            chain.resolve()
+
     def _set_pos(self, value):
-        raise NotImplementedError
+        # Note that this never follows the chain further; that's left to
+        # _extent_span when the new position is read from
+        self._pos = value
+        index = value // self._sector_size
+        offsets = self._extent_offsets
+        extent = self._extent
+        # Only bisect when the new position lies outside the current extent
+        if not (
+                extent < len(self._extent_sectors) and
+                offsets[extent] <= index < offsets[extent + 1]):
+            self._extent = bisect_right(offsets, index) - 1
+
+    def _extent_span(self, n):
+        # Returns the offset (within the underlying file) of the current
+        # position, and the number of bytes (up to n) that can be read from
+        # there without leaving the current extent. If the current position
+        # lies beyond the end of the chain, returns (None, 0). If the chain
+        # hasn't been followed far enough to cover n bytes from the current
+        # position, it is followed further first
+        if self._chain.next_sector != END_OF_CHAIN:
+            last = (self._pos + max(1, n) - 1) // self._sector_size
+            if last >= self._extent_offsets[-1]:
+                self._chain.resolve(last)
+                self._extent = bisect_right(
+                    self._extent_offsets, self._pos // self._sector_size) - 1
+        extent = self._extent
+        if extent >= len(self._extent_sectors):
+            return None, 0
+        start = self._extent_offsets[extent] * self._sector_size
+        end = self._extent_offsets[extent + 1] * self._sector_size
+        return (
+            self._header_size +
+            (self._extent_sectors[extent] * self._sector_size) +
+            (self._pos - start),
+            min(n, end - self._pos))
+
+    def _advance(self, n):
+        # Moves the current position n bytes forward, within (or to the end
+        # of) the current extent, charging the sectors read to the budget
+        if self._budget is not None and n:
+            self._budget._charge_reads(
+                (self._pos + n - 1) // self._sector_size -
+                self._pos // self._sector_size + 1)
+        self._pos += n
+        if self._pos >= (
+                self._extent_offsets[self._extent + 1] * self._sector_size):
+            self._extent += 1
 
     def readable(self):
         """
@@ -106,7 +155,7 @@ class CompoundFileStream(io.RawIOBase):
         """
         Return the current stream position.
         """
-        return (self._sector_index * self._sector_size) + self._sector_offset
+        return self._pos
 
     def seek(self, offset, whence=io.SEEK_SET):
         """
@@ -135,7 +184,6 @@ class CompoundFileStream(io.RawIOBase):
         self._set_pos(offset)
         return offset
 
-    @abstractmethod
     def read1(self, n=-1):
         """
         Read up to *n* bytes from the stream using only a single call to the
@@ -143,9 +191,100 @@ class CompoundFileStream(io.RawIOBase):
 
         In the case of :class:`CompoundFileStream` this roughly corresponds to
         returning the content from the current position up to the end of the
-        current sector.
+        current extent (run of contiguous sectors).
+        """
+        if n == -1:
+            n = max(0, self._length - self._pos)
+        else:
+            n = max(0, min(n, self._length - self._pos))
+        offset, n = self._extent_span(n)
+        if n == 0:
+            return b''
+        result = self._mmap[offset:offset + n]
+        self._advance(len(result))
+        return result
+
+    def readinto1(self, b):
+        """
+        Read bytes into a pre-allocated, writable bytes-like object *b* using
+        only a single call to the underlying object, and return the number of
+        bytes read.
+
+        As with :meth:`read1`, this reads at most the content from the current
+        position up to the end of the current extent. Where possible, the
+        content is copied directly from the memory mapped document into *b*.
+        Under Python 2, *b* must be byte-oriented (e.g. a :class:`bytearray`);
+        :exc:`TypeError` is raised for other buffers such as arrays.
+        """
+        view = _byte_view(b)
+        offset, n = self._extent_span(
+            max(0, min(len(view), self._length - self._pos)))
+        if n == 0:
+            return 0
+        if self._view is None:
+            data = self._mmap[offset:offset + n]
+        else:
+            data = self._view[offset:offset + n]
+        n = len(data)
+        view[:n] = data
+        self._advance(n)
+        return n
+
+    def read_view(self, n=-1):
+        """
+        Read up to *n* bytes from the stream and return them as a
+        :class:`memoryview` over the memory mapped document, without copying.
+
+        As with :meth:`read1`, this returns at most the content from the
+        current position up to the end of the current extent, so it should be
+        called repeatedly until an empty view is returned to read an entire
+        stream. Note that the reader cannot be closed while any views returned
+        by this method are still alive (:exc:`BufferError` will be raised);
+        call :meth:`~memoryview.release` on each view once it's no longer
+        required. If the document cannot be memory mapped, the views returned
+        are over a copy of the content instead.
+        """
+        if n == -1:
+            n = max(0, self._length - self._pos)
+        else:
+            n = max(0, min(n, self._length - self._pos))
+        offset, n = self._extent_span(n)
+        if n == 0:
+            return memoryview(b'')
+        if self._view is None:
+            result = memoryview(self._mmap[offset:offset + n])
+        else:
+            result = self._view[offset:offset + n]
+        self._advance(len(result))
+        return result
+
+    def readinto(self, b):
+        """
+        Read bytes into a pre-allocated, writable bytes-like object *b*, and
+        return the number of bytes read. Fewer than ``len(b)`` bytes may be
+        read if there are fewer than ``len(b)`` bytes from the current stream
+        position to the end of the stream.
+
+        If 0 is returned, and *b* was not empty, this indicates end of the
+        stream. As with :meth:`readinto1`, *b* must be byte-oriented under
+        Python 2.
         """
-        raise NotImplementedError
+        view = _byte_view(b)
+        n = max(0, min(len(view), self._length - self._pos))
+        i = 0
+        while i < n:
+            count = self.readinto1(view[i:n])
+            if not count:
+                self._warn(
+                    CompoundFileTruncatedWarning(
+                        'compound document appears to be truncated'),
+                    self._location, self._chain.start)
+                # Zero-fill the remainder, as in read()
+                view[i:n] = b'\0' * (n - i)
+                i = n
+                break
+            i += count
+        return i
 
     def read(self, n=-1):
         """
@@ -161,36 +300,53 @@ class CompoundFileStream(io.RawIOBase):
             n = max(0, self._length - self.tell())
         else:
             n = max(0, min(n, self._length - self.tell()))
-        result = bytearray(n)
-        i = 0
-        while i < n:
-            buf = self.read1(n - i)
+        chunks = []
+        while n > 0:
+            buf = self.read1(n)
             if not buf:
-                warnings.warn(
+                self._warn(
                     CompoundFileTruncatedWarning(
-                        'compound document appears to be truncated'))
+                        'compound document appears to be truncated'),
+                    self._location, self._chain.start)
+                # Pad the result to the length requested, as the content of
+                # a truncated stream is still read in fixed size records
+                # (e.g. directory entries)
+                chunks.append(b'\0' * n)
                 break
-            result[i:i + len(buf)] = buf
-            i += len(buf)
-        return bytes(result)
+            chunks.append(buf)
+            n -= len(buf)
+        return b''.join(chunks)
 
 
 class CompoundFileNormalStream(CompoundFileStream):
+    _location = 'sector'
+
     def __init__(self, parent, start, length=None):
         super(CompoundFileNormalStream, self).__init__()
-        self._load_sectors(start, parent._normal_fat)
+        self._warn = parent._warn
+        self._budget = parent.budget
         self._sector_size = parent._normal_sector_size
-        self._header_size = parent._header_size
+        # The offset of sector 0 within the map
+        self._header_size = parent._base + parent._header_size
         self._mmap = parent._mmap
-        min_length = (len(self._sectors) - 1) * self._sector_size
-        max_length = len(self._sectors) * self._sector_size
+        self._view = parent._view
+        if parent._lazy_chains and length is not None:
+            # Trust the length given and follow the chain as required
+            self._load_chain(parent._get_chain('normal', start), lazy=True)
+            self._length = length
+            self._set_pos(0)
+            return
+        self._load_chain(parent._get_chain('normal', start))
+        min_length = (self._extent_offsets[-1] - 1) * self._sector_size
+        max_length = self._extent_offsets[-1] * self._sector_size
         if length is None:
             self._length = max_length
         elif not (min_length <= length <= max_length):
-            warnings.warn(
+            self._warn(
                 CompoundFileDirSizeWarning(
                     'length (%d) of stream at sector %d exceeds bounds '
-                    '(%d-%d)' % (length, start, min_length, max_length)))
+                    '(%d-%d)' % (length, start, min_length, max_length)),
+                'sector', start)
             self._length = max_length
         else:
             self._length = length
@@ -198,76 +354,67 @@ class CompoundFileNormalStream(CompoundFileStream):
 
     def close(self):
         self._mmap = None
-
-    def _set_pos(self, value):
-        self._sector_index = value // self._sector_size
-        self._sector_offset = value % self._sector_size
-
-    def read1(self, n=-1):
-        if n == -1:
-            n = max(0, self._length - self.tell())
-        else:
-            n = max(0, min(n, self._length - self.tell()))
-        n = min(n, self._sector_size - self._sector_offset)
-        if n == 0:
-            return b''
-        offset = (
-                self._header_size + (
-                self._sectors[self._sector_index] * self._sector_size) +
-                self._sector_offset)
-        result = self._mmap[offset:offset + n]
-        self._set_pos(self.tell() + n)
-        return result
+        self._view = None
 
 
 class CompoundFileMiniStream(CompoundFileStream):
+    _location = 'mini_sector'
+
     def __init__(self, parent, start, length=None):
         super(CompoundFileMiniStream, self).__init__()
+        self._warn = parent._warn
+        self._budget = parent.budget
         if not parent._mini_fat:
             raise CompoundFileNoMiniFatError(
                 'no mini FAT in compound document')
-        self._load_sectors(start, parent._mini_fat)
         self._sector_size = parent._mini_sector_size
         self._header_size = 0
-        self._file = CompoundFileNormalStream(
-                parent, parent.root._start_sector, parent.root.size)
-        max_length = len(self._sectors) * self._sector_size
+        if parent._mini_buffer:
+            # Read directly from the reader's copy of the root entry's stream
+            self._file = None
+            self._mmap, self._view = parent._get_mini_buffer()
+        else:
+            # Read directly from the document, using the root entry's stream
+            # to translate offsets (see _extent_span)
+            self._file = CompoundFileNormalStream(
+                    parent, parent.root._start_sector, parent.root.size)
+            self._mmap = parent._mmap
+            self._view = parent._view
+        if parent._lazy_chains and length is not None:
+            # Trust the length given and follow the chain as required
+            self._load_chain(parent._get_chain('mini', start), lazy=True)
+            self._length = length
+            self._set_pos(0)
+            return
+        self._load_chain(parent._get_chain('mini', start))
+        max_length = self._extent_offsets[-1] * self._sector_size
         if length is not None and length > max_length:
-            warnings.warn(
+            self._warn(
                 CompoundFileDirSizeWarning(
                     'length (%d) of stream at sector %d exceeds '
-                    'max (%d)' % (length, start, max_length)))
+                    'max (%d)' % (length, start, max_length)),
+                'mini_sector', start)
         self._length = min(max_length, length or max_length)
         self._set_pos(0)
 
     def close(self):
         try:
-            self._file.close()
+            if self._file is not None:
+                self._file.close()
         finally:
             self._file = None
-
-    def _set_pos(self, value):
-        self._sector_index = value // self._sector_size
-        self._sector_offset = value % self._sector_size
-        if self._sector_index < len(self._sectors):
-            self._file.seek(
-                    self._header_size +
-                    (self._sectors[self._sector_index] * self._sector_size) +
-                    self._sector_offset)
-
-    def read1(self, n=-1):
-        if n == -1:
-            n = max(0, self._length - self.tell())
-        else:
-            n = max(0, min(n, self._length - self.tell()))
-        n = min(n, self._sector_size - self._sector_offset)
-        if n == 0:
-            return b''
-        result = self._file.read1(n)
-        # Only perform a seek to a different sector if we've crossed into one
-        if self._sector_offset + n < self._sector_size:
-            self._sector_offset += n
-        else:
-            self._set_pos(self.tell() + n)
-        return result
-
+            self._mmap = None
+            self._view = None
+
+    def _extent_span(self, n):
+        # The extents of a mini stream are within the root entry's stream. If
+        # we're not reading from a copy of that, translate the span into an
+        # offset within the document, limiting it to the extent of the root
+        # entry's stream that it lies in. Hence runs of mini sectors which are
+        # contiguous in both are read with a single slice of the document
+        offset, n = super(CompoundFileMiniStream, self)._extent_span(n)
+        if self._file is None or n == 0:
+            return offset, n
+        root = self._file
+        root._set_pos(offset)
+        return root._extent_span(max(0, min(n, root._length - offset)))
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# A library for reading Microsoft's OLE Compound Document format
+# Copyright (c) 2014 Dave Jones <dave@waveform.org.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+native_str = str
+str = type('')
+
+
+from array import array
+
+from compoundfiles.fat import FAT_TYPECODE
+from compoundfiles.streams import CompoundFileNormalStream
+from compoundfiles.entities import _decode_name
+from compoundfiles.const import (
+    NO_STREAM,
+    DIR_HEADER,
+    DIR_STORAGE,
+    )
+
+
+# The columns of the directory table, in order, with the NumPy type of each.
+# The created and modified columns are the raw FILETIME values (the number of
+# 100ns intervals since 1601-01-01, or 0 if unset)
+TABLE_COLUMNS = (
+    ('index',        'u4'),
+    ('name',         'U32'),
+    ('type',         'u1'),
+    ('color',        'u1'),
+    ('left',         'u4'),
+    ('right',        'u4'),
+    ('child',        'u4'),
+    ('start_sector', 'u4'),
+    ('size',         'u8'),
+    ('created',      'u8'),
+    ('modified',     'u8'),
+    ('parent',       'u4'),
+    ('path',         'O'),
+    )
+
+# The NumPy equivalent of DIR_HEADER, used to decode the directory stream in
+# a single call with numpy.frombuffer
+NUMPY_DIR_HEADER = [
+    ('name',         'V64'),
+    ('name_len',     '<u2'),
+    ('type',         'u1'),
+    ('color',        'u1'),
+    ('left',         '<u4'),
+    ('right',        '<u4'),
+    ('child',        '<u4'),
+    ('uuid',         'V16'),
+    ('user_flags',   '<u4'),
+    ('created',      '<u8'),
+    ('modified',     '<u8'),
+    ('start_sector', '<u4'),
+    ('size_low',     '<u4'),
+    ('size_high',    '<u4'),
+    ]
+
+
+def _int64_array():
+    # Python 2.x's array doesn't support 64-bit integers; fall back to a list
+    try:
+        return array(native_str('Q'))
+    except ValueError:
+        return []
+
+
+def _parents(count, types, lefts, rights, children, names):
+    # Walk the directory tree from the root entry, determining the parent and
+    # full path of each reachable entry. Each entry is visited at most once so
+    # loops (and entries claimed by more than one storage) are ignored rather
+    # than followed; corrupt indexes are likewise ignored
+    parents = array(FAT_TYPECODE, [NO_STREAM]) * count
+    paths = [None] * count
+    if not count:
+        return parents, paths
+    paths[0] = ''
+    visited = {0}
+    storages = [0]
+    while storages:
+        storage = storages.pop()
+        prefix = paths[storage] + '/' if storage else ''
+        nodes = [children[storage]]
+        while nodes:
+            node = nodes.pop()
+            if node >= count or node in visited:
+                continue
+            visited.add(node)
+            parents[node] = storage
+            paths[node] = prefix + names[node]
+            nodes.append(rights[node])
+            nodes.append(lefts[node])
+            if types[node] == DIR_STORAGE:
+                storages.append(node)
+    return parents, paths
+
+
+def _table_columns(data, count):
+    table = dict(
+        (column, array(FAT_TYPECODE))
+        for column in ('index', 'left', 'right', 'child', 'start_sector'))
+    table.update(dict(
+        (column, array(native_str('B')))
+        for column in ('type', 'color')))
+    table.update(dict(
+        (column, _int64_array())
+        for column in ('size', 'created', 'modified')))
+    table['name'] = []
+    for index in range(count):
+        offset = index * DIR_HEADER.size
+        (
+            name,
+            name_len,
+            entry_type,
+            entry_color,
+            left_index,
+            right_index,
+            child_index,
+            uuid,
+            user_flags,
+            created,
+            modified,
+            start_sector,
+            size_low,
+            size_high,
+        ) = DIR_HEADER.unpack_from(data, offset)
+        table['index'].append(index)
+        table['name'].append(
+            _decode_name(data[offset:offset + DIR_HEADER.size]))
+        table['type'].append(entry_type)
+        table['color'].append(entry_color)
+        table['left'].append(left_index)
+        table['right'].append(right_index)
+        table['child'].append(child_index)
+        table['start_sector'].append(start_sector)
+        table['size'].append((size_high << 32) | size_low)
+        table['created'].append(created)
+        table['modified'].append(modified)
+    table['parent'], table['path'] = _parents(
+        count, table['type'], table['left'], table['right'], table['child'],
+        table['name'])
+    return table
+
+
+def _table_numpy(np, data, count):
+    raw = np.frombuffer(
+        data, dtype=np.dtype(NUMPY_DIR_HEADER), count=count)
+    names = [
+        _decode_name(data[offset:offset + DIR_HEADER.size])
+        for offset in range(0, count * DIR_HEADER.size, DIR_HEADER.size)
+        ]
+    parents, paths = _parents(
+        count, raw['type'].tolist(), raw['left'].tolist(),
+        raw['right'].tolist(), raw['child'].tolist(), names)
+    table = np.empty(count, dtype=np.dtype(list(TABLE_COLUMNS)))
+    table['index'] = np.arange(count)
+    table['name'] = names
+    for column in ('type', 'color', 'left', 'right', 'child', 'start_sector',
+            'created', 'modified'):
+        table[column] = raw[column]
+    table['size'] = (
+        (raw['size_high'].astype('u8') << np.uint64(32)) | raw['size_low'])
+    table['parent'] = parents
+    table['path'] = paths
+    return table
+
+
+def directory_table(reader, use_numpy=None):
+    """
+    Returns the raw content of every entry in the directory of *reader* as
+    columns. See :meth:`CompoundFileReader.directory_table` for details.
+    """
+    if use_numpy or use_numpy is None:
+        try:
+            import numpy as np
+        except ImportError:
+            if use_numpy:
+                raise
+            np = None
+    else:
+        np = None
+    with CompoundFileNormalStream(reader, reader._dir_first_sector) as stream:
+        data = stream.read()
+    count = len(data) // DIR_HEADER.size
+    if np is None:
+        return _table_columns(data, count)
+    else:
+        return _table_numpy(np, data, count)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# A library for reading Microsoft's OLE Compound Document format
+# Copyright (c) 2014 Dave Jones <dave@waveform.org.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Benchmark for the memory used by each directory entry. Compares
+# CompoundFileEntity against a replica of the previous representation (an
+# instance dict holding eagerly decoded names, timestamps, and UUIDs). Requires
+# Python 3.4+ for tracemalloc. Run from the root of the repository with:
+#
+#   python tests/bench_entities.py [entries]
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+native_str = str
+str = type('')
+
+
+import io
+import os
+import sys
+import gc
+import warnings
+import datetime as dt
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import compoundfiles as cf
+from compoundfiles.const import DIR_HEADER
+import synthetic
+
+
+class DictEntity(object):
+    # The attributes stored by CompoundFileEntity prior to the use of
+    # __slots__ and lazily decoded fields
+    def __init__(self, parent, stream, index):
+        self._index = index
+        self._children = None
+        (
+            name,
+            name_len,
+            self._entry_type,
+            self._entry_color,
+            self._left_index,
+            self._right_index,
+            self._child_index,
+            self.uuid,
+            user_flags,
+            created,
+            modified,
+            self._start_sector,
+            size_low,
+            size_high,
+        ) = DIR_HEADER.unpack(stream.read(DIR_HEADER.size))
+        self.name = name.decode('utf-16le')
+        self.name = self.name[:self.name.index('\0')]
+        self.size = (size_high << 32) | size_low
+        epoch = dt.datetime(1601, 1, 1)
+        self.created = (
+                epoch + dt.timedelta(microseconds=created // 10)
+                if created != 0 else None)
+        self.modified = (
+                epoch + dt.timedelta(microseconds=modified // 10)
+                if modified != 0 else None)
+
+
+def measure(cls, doc, count):
+    stream = io.BytesIO(doc._dir_data)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        entities = [cls(doc, stream, index) for index in range(count)]
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (after - before) / count
+
+
+def main(count=20000):
+    warnings.simplefilter('ignore')
+    data = synthetic.build(synthetic.flat_entries(
+        ['Stream %d' % i for i in range(count - 1)], b'Data'))
+    with cf.CompoundFileReader(io.BytesIO(data)) as doc:
+        with cf.streams.CompoundFileNormalStream(doc, doc._dir_first_sector) as f:
+            doc._dir_data = f.read()
+        old = measure(DictEntity, doc, count)
+        new = measure(cf.CompoundFileEntity, doc, count)
+    print('entries:                 %d' % count)
+    print('dict-based entity:       %.0f bytes/entry' % old)
+    print('slotted lazy entity:     %.0f bytes/entry (%.0f%%)' % (new, new * 100 / old))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
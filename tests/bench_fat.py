@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# A library for reading Microsoft's OLE Compound Document format
+# Copyright (c) 2014 Dave Jones <dave@waveform.org.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Benchmark for loading the normal-FAT of a document with a huge FAT (50,000
+# sectors by default). Compares the bulk decode used by CompoundFileReader
+# against the old sector-by-sector struct.unpack decode, and reports the time
+# taken to open the document eagerly and with lazy_fat. Run from the root of
+# the repository with:
+#
+#   python tests/bench_fat.py [fat-sectors]
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+native_str = str
+str = type('')
+
+
+import os
+import sys
+import timeit
+import tempfile
+import struct as st
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import compoundfiles as cf
+import synthetic
+
+
+def unpack_fat(doc):
+    # The decode used before bulk loading: one struct.unpack per sector
+    fmt = st.Struct(native_str('<%dL' % (doc._normal_sector_size // 4)))
+    result = array(native_str('L'))
+    for sector in doc._master_fat:
+        result.extend(fmt.unpack(doc._read_sector(sector)))
+    return result
+
+
+def main(fat_sectors=50000, repeat=5):
+    fd, filename = tempfile.mkstemp(suffix='.dat')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(synthetic.build(
+                synthetic.flat_entries(['Stream']), min_fat_sectors=fat_sectors))
+        with cf.CompoundFileReader(filename) as doc:
+            assert len(doc._master_fat) >= fat_sectors
+            old = min(timeit.repeat(
+                lambda: unpack_fat(doc), number=1, repeat=repeat))
+            new = min(timeit.repeat(
+                lambda: doc._load_normal_fat(set()), number=1, repeat=repeat))
+            print('FAT sectors:          %d' % len(doc._master_fat))
+            print('per-sector unpack:    %.4fs' % old)
+            print('bulk decode:          %.4fs (%.1fx)' % (new, old / new))
+        for lazy_fat in (False, True):
+            t = min(timeit.repeat(
+                lambda: cf.CompoundFileReader(filename, lazy_fat=lazy_fat).close(),
+                number=1, repeat=repeat))
+            print('open (lazy_fat=%-5s): %.4fs' % (lazy_fat, t))
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
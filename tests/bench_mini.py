@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# A library for reading Microsoft's OLE Compound Document format
+# Copyright (c) 2014 Dave Jones <dave@waveform.org.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Microbenchmark for reading streams stored in the mini-FAT. Reads every mini
+# stream in the tests/sample* files, and in a synthetic document containing
+# many small streams (2,000 by default), comparing one read per mini sector
+# (as streams did before reads were coalesced), coalesced reads, and reads
+# from a mini_buffer. Run from the root of the repository with:
+#
+#   python tests/bench_mini.py [streams]
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+native_str = str
+str = type('')
+
+
+import os
+import sys
+import glob
+import timeit
+import tempfile
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import compoundfiles as cf
+import synthetic
+
+
+def mini_streams(doc, entity=None):
+    for child in (doc.root if entity is None else entity):
+        if child.isdir:
+            for result in mini_streams(doc, child):
+                yield result
+        elif child.isfile and child.size < doc._mini_size_limit:
+            yield child
+
+
+def read_per_sector(doc, entities):
+    # Read each stream one mini sector at a time
+    for entity in entities:
+        with doc.open(entity) as f:
+            while f.read1(doc._mini_sector_size):
+                pass
+
+
+def read_coalesced(doc, entities):
+    for entity in entities:
+        with doc.open(entity) as f:
+            f.read()
+
+
+def bench(filename, repeat=5):
+    results = []
+    for mini_buffer, method in (
+            (False, read_per_sector),
+            (False, read_coalesced),
+            (True, read_coalesced),
+            ):
+        with cf.CompoundFileReader(filename, mini_buffer=mini_buffer) as doc:
+            entities = list(mini_streams(doc))
+            results.append(min(timeit.repeat(
+                lambda: method(doc, entities), number=1, repeat=repeat)))
+    print('%-24s %6d %10.2fms %10.2fms %10.2fms' % (
+        os.path.basename(filename), len(entities),
+        results[0] * 1000, results[1] * 1000, results[2] * 1000))
+
+
+def main(streams=2000):
+    warnings.simplefilter('ignore')
+    print('%-24s %6s %12s %12s %12s' % (
+        'document', 'mini', 'per-sector', 'coalesced', 'mini_buffer'))
+    for filename in sorted(glob.glob(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'sample*'))):
+        bench(filename)
+    fd, filename = tempfile.mkstemp(suffix='.dat')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            # Streams of a few hundred bytes, like property set streams
+            f.write(synthetic.build(synthetic.flat_entries(
+                ['Property %d' % i for i in range(streams)], b'Prop' * 100)))
+        bench(filename)
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
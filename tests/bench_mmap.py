@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# A library for reading Microsoft's OLE Compound Document format
+# Copyright (c) 2014 Dave Jones <dave@waveform.org.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# Benchmark for FakeMemoryMap, which is used to read documents from file-like
+# objects without a file descriptor. Opens each of the tests/sample* files (and
+# a synthetic document with many streams) and reads every stream, comparing a
+# real mmap of the file, a replica of the previous emulation (which saved,
+# moved, and restored the file position for every slice), the emulation
+# without its block cache, and with it. The number of calls made to the
+# underlying file object (read, seek, and tell) is shown as this dominates
+# the cost for file objects backed by anything slower than memory (e.g.
+# network storage). Run from the root of the repository with:
+#
+#   python tests/bench_mmap.py [streams]
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+native_str = str
+str = type('')
+
+
+import io
+import os
+import sys
+import glob
+import timeit
+import tempfile
+import warnings
+import functools
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import compoundfiles as cf
+import synthetic
+
+
+class CountingFile(io.BytesIO):
+    # A BytesIO counting the calls made to it, without a file descriptor
+    calls = 0
+
+    def read(self, n=-1):
+        CountingFile.calls += 1
+        return super(CountingFile, self).read(n)
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        CountingFile.calls += 1
+        return super(CountingFile, self).seek(pos, whence)
+
+    def tell(self):
+        CountingFile.calls += 1
+        return super(CountingFile, self).tell()
+
+
+class LegacyMemoryMap(cf.mmap.FakeMemoryMap):
+    # The previous emulation, which didn't cache anything
+    def _read_range(self, start, stop):
+        save_pos = self._file.tell()
+        try:
+            self._file.seek(start)
+            return self._file.read(stop - start)
+        finally:
+            self._file.seek(save_pos)
+
+
+def read_all(doc, entity=None):
+    for child in (doc.root if entity is None else entity):
+        if child.isdir:
+            read_all(doc, child)
+        elif child.isfile:
+            with doc.open(child) as f:
+                f.read()
+
+
+def run(source, fake_map=None):
+    saved = cf.reader.FakeMemoryMap
+    if fake_map is not None:
+        cf.reader.FakeMemoryMap = fake_map
+    try:
+        # BytesIO sources would otherwise be read via the buffer backend
+        with cf.CompoundFileReader(
+                source, backend=None if fake_map is None else 'fake') as doc:
+            read_all(doc)
+    finally:
+        cf.reader.FakeMemoryMap = saved
+
+
+def bench(filename, label=None, repeat=5):
+    with io.open(filename, 'rb') as f:
+        data = f.read()
+    print('%-24s' % (label or os.path.basename(filename)), end='')
+    for fake_map in (
+            None,
+            LegacyMemoryMap,
+            functools.partial(cf.mmap.FakeMemoryMap, cache_size=0),
+            cf.mmap.FakeMemoryMap,
+            ):
+        if fake_map is None:
+            source = lambda: filename
+        else:
+            source = lambda: CountingFile(data)
+        CountingFile.calls = 0
+        run(source(), fake_map)
+        calls = CountingFile.calls
+        elapsed = min(timeit.repeat(
+            lambda: run(source(), fake_map), number=1, repeat=repeat))
+        if fake_map is None:
+            print(' %9.2fms' % (elapsed * 1000), end='')
+        else:
+            print(' %9.2fms %6d' % (elapsed * 1000, calls), end='')
+    print()
+
+
+def main(streams=2000):
+    warnings.simplefilter('ignore')
+    print('%-24s %11s %18s %18s %18s' % (
+        'document', 'mmap', 'legacy (calls)', 'uncached (calls)',
+        'cached (calls)'))
+    for filename in sorted(glob.glob(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'sample*'))):
+        bench(filename)
+    fd, filename = tempfile.mkstemp(suffix='.dat')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(synthetic.build(synthetic.flat_entries(
+                ['Stream %d' % i for i in range(streams)], b'Data' * 256)))
+        bench(filename, 'synthetic (%d streams)' % streams)
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+#
+# A library for reading Microsoft's OLE Compound Document format
+# Copyright (c) 2014 Dave Jones <dave@waveform.org.uk>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# A minimal writer for (valid) compound documents, used to construct synthetic
+# documents with properties that are impractical to ship as test data (huge
+# FATs, enormous directories, degenerate sibling trees, and so on)
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+native_str = str
+str = type('')
+
+
+import struct as st
+
+from compoundfiles.const import (
+    COMPOUND_MAGIC,
+    COMPOUND_HEADER,
+    DIR_HEADER,
+    FREE_SECTOR,
+    END_OF_CHAIN,
+    NORMAL_FAT_SECTOR,
+    MASTER_FAT_SECTOR,
+    NO_STREAM,
+    DIR_INVALID,
+    DIR_STREAM,
+    DIR_ROOT,
+    )
+
+
+SECTOR_SIZE = 512
+MINI_SECTOR_SIZE = 64
+MINI_LIMIT = 4096
+
+
+class Entry(object):
+    """
+    A directory entry for :func:`build`. The *left*, *right*, and *child*
+    attributes are indexes into the list of entries passed to :func:`build`.
+    """
+    def __init__(self, name, kind=DIR_STREAM, data=b'', left=NO_STREAM,
+            right=NO_STREAM, child=NO_STREAM):
+        self.name = name
+        self.kind = kind
+        self.data = data
+        self.left = left
+        self.right = right
+        self.child = child
+
+
+def _chain(fat, start, count):
+    for i in range(start, start + count - 1):
+        fat[i] = i + 1
+    if count:
+        fat[start + count - 1] = END_OF_CHAIN
+    return start if count else END_OF_CHAIN
+
+
+def _pad(data, size):
+    return data + b'\0' * (-len(data) % size)
+
+
+def build(entries, min_fat_sectors=0):
+    """
+    Construct a compound document containing the directory *entries* (a list
+    of :class:`Entry` instances, the first of which must be the root). Returns
+    the content of the document as a byte-string. If *min_fat_sectors* is
+    specified, the FAT is padded with free sectors to at least that many
+    sectors (which will require a DIFAT extension beyond 109 sectors).
+    """
+    per_sector = SECTOR_SIZE // 4
+    sectors = []
+    fat = {}
+    starts = {}
+    # Allocate normal streams
+    for index, entry in enumerate(entries):
+        if entry.kind == DIR_STREAM and len(entry.data) >= MINI_LIMIT:
+            data = _pad(entry.data, SECTOR_SIZE)
+            count = len(data) // SECTOR_SIZE
+            starts[index] = _chain(fat, len(sectors), count)
+            sectors.extend(
+                data[i:i + SECTOR_SIZE]
+                for i in range(0, len(data), SECTOR_SIZE))
+    # Allocate the mini stream and mini FAT
+    mini_data = b''
+    mini_fat = []
+    for index, entry in enumerate(entries):
+        if entry.kind == DIR_STREAM and 0 < len(entry.data) < MINI_LIMIT:
+            data = _pad(entry.data, MINI_SECTOR_SIZE)
+            count = len(data) // MINI_SECTOR_SIZE
+            first = len(mini_fat)
+            mini_fat.extend(range(first + 1, first + count))
+            mini_fat.append(END_OF_CHAIN)
+            starts[index] = first
+            mini_data += data
+    mini_data = _pad(mini_data, SECTOR_SIZE)
+    mini_start = _chain(fat, len(sectors), len(mini_data) // SECTOR_SIZE)
+    sectors.extend(
+        mini_data[i:i + SECTOR_SIZE]
+        for i in range(0, len(mini_data), SECTOR_SIZE))
+    mini_fat_data = _pad(st.pack(
+        native_str('<%dL' % len(mini_fat)), *mini_fat), SECTOR_SIZE)
+    mini_fat_count = len(mini_fat_data) // SECTOR_SIZE
+    mini_fat_start = _chain(fat, len(sectors), mini_fat_count)
+    sectors.extend(
+        mini_fat_data[i:i + SECTOR_SIZE]
+        for i in range(0, len(mini_fat_data), SECTOR_SIZE))
+    # Construct the directory
+    directory = []
+    for index, entry in enumerate(entries):
+        kind = DIR_ROOT if index == 0 else entry.kind
+        name = entry.name.encode('utf-16le')
+        if kind == DIR_INVALID:
+            name_len = 0
+        else:
+            name_len = len(name) + 2
+        if kind == DIR_ROOT:
+            start, size = mini_start, len(mini_data)
+        elif kind == DIR_STREAM:
+            start, size = starts.get(index, END_OF_CHAIN), len(entry.data)
+        else:
+            start, size = 0, 0
+        directory.append(DIR_HEADER.pack(
+            name, name_len, kind, 1,
+            entry.left, entry.right, entry.child,
+            b'\0' * 16, 0, 0, 0, start, size, 0))
+    per_dir_sector = SECTOR_SIZE // DIR_HEADER.size
+    directory.extend(
+        DIR_HEADER.pack(
+            b'', 0, DIR_INVALID, 0, NO_STREAM, NO_STREAM, NO_STREAM,
+            b'\0' * 16, 0, 0, 0, 0, 0, 0)
+        for i in range(-len(directory) % per_dir_sector))
+    dir_data = b''.join(directory)
+    dir_start = _chain(fat, len(sectors), len(dir_data) // SECTOR_SIZE)
+    sectors.extend(
+        dir_data[i:i + SECTOR_SIZE]
+        for i in range(0, len(dir_data), SECTOR_SIZE))
+    # Size the FAT and DIFAT
+    fat_count = max(1, min_fat_sectors)
+    while True:
+        master_count = max(0, -(-(fat_count - 109) // (per_sector - 1)))
+        if fat_count * per_sector >= len(sectors) + fat_count + master_count:
+            break
+        fat_count += 1
+    fat_start = len(sectors)
+    master_start = fat_start + fat_count
+    for i in range(fat_start, master_start):
+        fat[i] = NORMAL_FAT_SECTOR
+    for i in range(master_start, master_start + master_count):
+        fat[i] = MASTER_FAT_SECTOR
+    fat_values = [fat.get(i, FREE_SECTOR) for i in range(fat_count * per_sector)]
+    fat_data = st.pack(native_str('<%dL' % len(fat_values)), *fat_values)
+    sectors.extend(
+        fat_data[i:i + SECTOR_SIZE]
+        for i in range(0, len(fat_data), SECTOR_SIZE))
+    master = list(range(fat_start, master_start))
+    for i in range(master_count):
+        chunk = master[109 + i * (per_sector - 1):109 + (i + 1) * (per_sector - 1)]
+        chunk += [FREE_SECTOR] * (per_sector - 1 - len(chunk))
+        chunk.append(
+            master_start + i + 1 if i + 1 < master_count else END_OF_CHAIN)
+        sectors.append(st.pack(native_str('<%dL' % per_sector), *chunk))
+    header_master = master[:109]
+    header_master += [FREE_SECTOR] * (109 - len(header_master))
+    header = COMPOUND_HEADER.pack(
+        COMPOUND_MAGIC, b'\0' * 16, 0x3E, 3, 0xFFFE, 9, 6, b'\0' * 6,
+        0, fat_count, dir_start, 0, MINI_LIMIT,
+        mini_fat_start, mini_fat_count,
+        master_start if master_count else END_OF_CHAIN, master_count)
+    header += st.pack(native_str('<109L'), *header_master)
+    return header + b''.join(sectors)
+
+
+def flat_entries(names, data=b'', balanced=True):
+    """
+    Returns a list of :class:`Entry` instances with a root storage containing
+    a stream for each of *names* (each containing *data*). If *balanced* is
+    ``True`` the sibling tree is balanced, otherwise it is a degenerate chain
+    of right siblings (which is legal, but unusual).
+    """
+    def key(name):
+        return (len(name), name.upper())
+
+    ordered = sorted(names, key=key)
+    entries = [Entry('Root Entry', DIR_ROOT)]
+    entries.extend(Entry(name, DIR_STREAM, data) for name in ordered)
+    if not ordered:
+        return entries
+    if balanced:
+        def link(lo, hi):
+            if lo > hi:
+                return NO_STREAM
+            mid = (lo + hi) // 2
+            entries[mid].left = link(lo, mid - 1)
+            entries[mid].right = link(mid + 1, hi)
+            return mid
+        entries[0].child = link(1, len(ordered))
+    else:
+        for index in range(1, len(ordered)):
+            entries[index].right = index + 1
+        entries[0].child = 1
+    return entries
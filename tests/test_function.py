@@ -32,14 +32,27 @@ str = type('')
 
 
 import io
+import os
+import errno
+import gc
+import hashlib
+import struct
+import tempfile
+import threading
 import compoundfiles as cf
+import synthetic
 import pytest
 import warnings
+from array import array
 from collections import namedtuple
+from datetime import datetime
 
 DirEntry = namedtuple('DirEntry', ('name', 'isfile', 'size'))
 
 def setup_function(fn):
+    # Collect any files leaked by prior tests now, so their ResourceWarnings
+    # aren't caught by tests which count warnings
+    gc.collect()
     warnings.simplefilter('always')
 
 def verify_contents(doc, contents):
@@ -127,9 +140,69 @@ def test_sample_from_fake_mmap(sample):
     stream = io.BytesIO()
     with io.open(filename, 'rb') as source:
         stream.write(source.read())
-    with cf.CompoundFileReader(stream) as doc:
+    with cf.CompoundFileReader(stream, backend='fake') as doc:
+        assert isinstance(doc._mmap, cf.mmap.FakeMemoryMap)
         verify_contents(doc, contents)
 
+@pytest.mark.parametrize('kind', ['bytes', 'bytearray', 'memoryview', 'bytesio'])
+def test_sample_from_buffer(sample, kind):
+    filename, contents = sample
+    with io.open(filename, 'rb') as f:
+        data = f.read()
+    source = {
+        'bytes': lambda: data,
+        'bytearray': lambda: bytearray(data),
+        'memoryview': lambda: memoryview(data),
+        'bytesio': lambda: io.BytesIO(data),
+        }[kind]()
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader(source) as doc:
+            assert isinstance(doc._mmap, cf.mmap.BufferMemoryMap)
+            assert doc._view is not None
+            verify_contents(doc, contents)
+            assert_same_streams(doc, filename)
+        assert not any(
+            issubclass(warning.category, cf.CompoundFileEmulationWarning)
+            for warning in w)
+
+def test_buffer_source():
+    with io.open('tests/example.dat', 'rb') as f:
+        data = f.read()
+    # Bytes without a NUL are still a filename
+    with cf.CompoundFileReader(b'tests/example.dat') as doc:
+        assert not isinstance(doc._mmap, cf.mmap.BufferMemoryMap)
+        verify_example(doc)
+    # The buffer can't be resized while it's in use
+    source = bytearray(data)
+    with cf.CompoundFileReader(source) as doc:
+        with pytest.raises(BufferError):
+            source.extend(b'foo')
+        verify_example(doc)
+    source.extend(b'foo')
+    stream = io.BytesIO(data)
+    with cf.CompoundFileReader(stream) as doc:
+        with doc.open('Storage 1/Stream 1') as f:
+            view = f.read_view(4)
+            assert view.readonly
+            assert view.tobytes() == b'Data'
+    view.release()
+    stream.write(b'foo')
+    # Embedded documents
+    with cf.CompoundFileReader(
+            b'\xff' * 100 + data + b'\xff' * 100, offset=100,
+            length=len(data)) as doc:
+        verify_example(doc)
+    with pytest.raises(ValueError):
+        cf.CompoundFileReader(data, offset=len(data) + 1)
+    # Other backends can still be used with BytesIO
+    with cf.CompoundFileReader(io.BytesIO(data), backend='fake') as doc:
+        assert isinstance(doc._mmap, cf.mmap.FakeMemoryMap)
+    with io.open('tests/example.dat', 'rb') as f:
+        with pytest.raises(ValueError):
+            cf.CompoundFileReader(f, backend='buffer')
+    with pytest.raises(ValueError):
+        cf.CompoundFileReader(data, backend='mmap')
+
 def test_reader_invalid_source():
     with pytest.raises(TypeError):
         cf.CompoundFileReader(object())
@@ -280,6 +353,15 @@ def test_invalid_magic():
     with pytest.raises(cf.CompoundFileInvalidMagicError):
         # Same as example.dat with corrupted magic block at the start
         cf.CompoundFileReader('tests/invalid_magic.dat')
+    # Buffers aren't included in the message
+    for source in (b'\x01' * 100000 + b'\0', bytearray(b'\x01' * 100000)):
+        with pytest.raises(cf.CompoundFileInvalidMagicError) as exc:
+            cf.CompoundFileReader(source)
+        assert str(exc.value).startswith('<buffer> ')
+    with io.open('tests/invalid_magic.dat', 'rb') as f:
+        with pytest.raises(cf.CompoundFileInvalidMagicError) as exc:
+            cf.CompoundFileReader(io.BytesIO(f.read()))
+        assert str(exc.value).startswith('<file> ')
 
 def test_invalid_bom():
     with pytest.raises(cf.CompoundFileInvalidBomError):
@@ -504,14 +586,18 @@ def test_stream_read():
             assert len(f.read()) == 544
             f.seek(0)
             assert len(f.read(1024)) == 544
+            # read1 returns the content of an entire extent; both streams
+            # are physically contiguous
             f.seek(0)
-            assert len(f.read1()) == 64
+            assert len(f.read1()) == 544
+            f.seek(100)
+            assert len(f.read1()) == 444
             f.seek(0, io.SEEK_END)
             assert f.read1() == b''
         with doc.open('Storage 1/Stream 2') as f:
             assert len(f.read()) == 4112
             f.seek(0)
-            assert len(f.read1()) == 512
+            assert len(f.read1()) == 4112
             f.seek(0, io.SEEK_END)
             assert f.read1() == b''
 
@@ -539,3 +625,1289 @@ def test_stream_truncated():
                 DirEntry('Storage 1', False, 1),
                 DirEntry('Storage 1/Stream 1', True, 1500),
                 ), test_contents=False)
+
+@pytest.mark.parametrize('cut', (1, 100, 512))
+def test_document_truncated(cut):
+    # Directory entries read past the end of a truncated document are padded
+    # with zeros, so the document can still be opened
+    with io.open('tests/sample2.doc', 'rb') as f:
+        data = f.read()[:-cut]
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader(data) as doc:
+            assert doc.root['WordDocument'].size == 25657
+            for path in sample_streams(doc):
+                with doc.open(path) as f:
+                    assert len(f.read()) == doc.root[path].size
+        assert any(
+            issubclass(warning.category, cf.CompoundFileTruncatedWarning)
+            for warning in w)
+
+def test_fat_truncated(tmpdir):
+    # Short reads of FAT sectors at the end of a truncated document must not
+    # be accepted as a short (and misaligned) FAT
+    with io.open('tests/invalid_master_overrun.dat', 'rb') as f:
+        data = f.read()
+    index = str(tmpdir.join('truncated.cfidx'))
+    for cut in (2, 100):
+        with warnings.catch_warnings(record=True) as w:
+            with pytest.raises(cf.CompoundFileError):
+                cf.CompoundFileReader(data[:-cut])
+            with cf.CompoundFileReader(data[:-cut], lazy_fat=True) as doc:
+                with pytest.raises(cf.CompoundFileError):
+                    doc._normal_fat.to_array()
+    # Truncated documents aren't indexed
+    with io.open('tests/sample2.doc', 'rb') as f:
+        data = f.read()[:-100]
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader(io.BytesIO(data), index_cache=index) as doc:
+            assert doc.root['WordDocument'].size == 25657
+    assert not os.path.exists(index)
+
+def test_lazy_fat(sample):
+    filename, contents = sample
+    with cf.CompoundFileReader(filename, lazy_fat=True) as doc:
+        verify_contents(doc, contents)
+        for entry in contents:
+            if entry.isfile:
+                with doc.open(entry.name) as f:
+                    assert len(f.read()) == entry.size
+        with cf.CompoundFileReader(filename) as eager:
+            assert len(doc._normal_fat) == len(eager._normal_fat)
+            assert list(doc._normal_fat[i] for i in range(len(eager._normal_fat))) == list(eager._normal_fat)
+
+def test_lazy_fat_eviction():
+    with cf.CompoundFileReader('tests/strange_master_ext.dat', lazy_fat=True) as doc:
+        doc._normal_fat._max_pages = 1
+        verify_example(doc)
+        assert doc._normal_fat.loaded_pages == 1
+        with pytest.raises(IndexError):
+            doc._normal_fat[len(doc._normal_fat)]
+
+def test_lazy_fat_invalid_types():
+    with warnings.catch_warnings(record=True) as w:
+        # Same as test_invalid_fat_types, but the mis-marked sectors are only
+        # detected as the relevant page of the FAT is read
+        with cf.CompoundFileReader('tests/invalid_fat_types.dat', lazy_fat=True) as doc:
+            verify_example(doc)
+            assert issubclass(w[0].category, cf.CompoundFileMasterSectorWarning)
+            assert issubclass(w[1].category, cf.CompoundFileNormalSectorWarning)
+            assert len(w) == 2
+
+def test_lazy_fat_invalid_types_strict():
+    # A page failing validation must be re-validated when it's read again
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader('tests/invalid_fat_types.dat') as doc:
+            fat = cf.fat.LazyFatTable(doc, set())
+            doc._validation = 'strict'
+            for attempt in range(2):
+                with pytest.raises(cf.CompoundFileNormalSectorWarning):
+                    fat[0]
+
+def test_lazy_fat_loop():
+    with pytest.raises(cf.CompoundFileNormalLoopError):
+        cf.CompoundFileReader('tests/invalid_fat_loop.dat', lazy_fat=True)
+
+def test_fat_bulk_decode(sample):
+    filename, contents = sample
+    with cf.CompoundFileReader(filename) as doc:
+        fmt = struct.Struct(str('<%dL' % (doc._normal_sector_size // 4)))
+        expected = []
+        for sector in doc._master_fat:
+            expected.extend(fmt.unpack(doc._read_sector(sector)))
+        assert doc._normal_fat.itemsize == 4
+        assert list(doc._normal_fat) == expected
+        assert b''.join(doc._read_sectors(doc._master_fat, max_bytes=1)) == b''.join(
+            doc._read_sector(sector) for sector in doc._master_fat)
+
+def test_index_cache(sample, tmpdir, monkeypatch):
+    filename, contents = sample
+    target = str(tmpdir.join('doc.dat'))
+    with io.open(filename, 'rb') as source, io.open(target, 'wb') as output:
+        output.write(source.read())
+    with cf.CompoundFileReader(target, index_cache=True) as doc:
+        verify_contents(doc, contents)
+        expected = (list(doc._normal_fat), list(doc._mini_fat), repr(doc.root))
+    assert tmpdir.join('doc.dat.cfidx').check()
+    def fail(self, *args):
+        assert False, 'index cache not used'
+    with monkeypatch.context() as m:
+        m.setattr(cf.CompoundFileReader, '_load_normal_fat', fail)
+        m.setattr(cf.CompoundFileReader, '_load_directory', fail)
+        with cf.CompoundFileReader(target, index_cache=True) as doc:
+            verify_contents(doc, contents)
+            assert (list(doc._normal_fat), list(doc._mini_fat), repr(doc.root)) == expected
+            for entry in contents:
+                if entry.isfile:
+                    assert len(doc.open(entry.name).read()) == entry.size
+
+def test_index_cache_invalid(tmpdir):
+    target = str(tmpdir.join('example.dat'))
+    index = str(tmpdir.join('example.idx'))
+    with io.open('tests/example.dat', 'rb') as source, io.open(target, 'wb') as output:
+        output.write(source.read())
+    with cf.CompoundFileReader(target, index_cache=index) as doc:
+        verify_example(doc)
+    # Corrupt the index; the reader should ignore and re-write it
+    with io.open(index, 'r+b') as f:
+        f.seek(100)
+        f.write(b'\xff\xff')
+    with cf.CompoundFileReader(target, index_cache=index) as doc:
+        verify_example(doc)
+    with io.open(index, 'rb') as f:
+        data = f.read()
+    assert hashlib.sha1(data[:-20]).digest() == data[-20:]
+    # Truncate the index
+    with io.open(index, 'wb') as f:
+        f.write(data[:50])
+    with cf.CompoundFileReader(target, index_cache=index) as doc:
+        verify_example(doc)
+    # Make the index stale by touching the document
+    stat = os.stat(target)
+    os.utime(target, (stat.st_atime, stat.st_mtime + 10))
+    with cf.CompoundFileReader(target, index_cache=index) as doc:
+        verify_example(doc)
+    with io.open(index, 'rb') as f:
+        assert f.read() != data
+
+def test_index_cache_same_fat(tmpdir):
+    index = str(tmpdir.join('example.cfidx'))
+    with io.open('tests/example.dat', 'rb') as source:
+        data = source.read()
+    # Rename the stream; the header, FAT and size are all unchanged, and
+    # BytesIO provides no modification time, so only the directory differs
+    entry = data.find('Stream 1\0'.encode('utf-16le'))
+    renamed = data[:entry] + 'Stream 2'.encode('utf-16le') + data[entry + 16:]
+    with cf.CompoundFileReader(io.BytesIO(data), index_cache=index) as doc:
+        assert 'Stream 1' in doc.root['Storage 1']
+    with cf.CompoundFileReader(io.BytesIO(renamed), index_cache=index) as doc:
+        assert 'Stream 2' in doc.root['Storage 1']
+        assert 'Stream 1' not in doc.root['Storage 1']
+
+def test_index_cache_lazy_dir(tmpdir, monkeypatch):
+    index = str(tmpdir.join('example.cfidx'))
+    with cf.CompoundFileReader(
+            'tests/example.dat', index_cache=index, lazy_dir=True) as doc:
+        # Writing the index would decode the whole directory
+        assert doc.root._children is None
+        verify_example(doc)
+    assert not os.path.exists(index)
+    # Loop errors are still deferred until the entries are accessed
+    with cf.CompoundFileReader(
+            'tests/invalid_dir_loop.dat', index_cache=index,
+            lazy_dir=True) as doc:
+        with pytest.raises(cf.CompoundFileDirLoopError):
+            list(doc.root['Storage 1'])
+    assert not os.path.exists(index)
+    # An existing index is still used
+    with cf.CompoundFileReader('tests/example.dat', index_cache=index) as doc:
+        verify_example(doc)
+    assert os.path.exists(index)
+    def fail(self, *args):
+        assert False, 'index cache not used'
+    with monkeypatch.context() as m:
+        m.setattr(cf.CompoundFileReader, '_load_directory', fail)
+        with cf.CompoundFileReader(
+                'tests/example.dat', index_cache=index, lazy_dir=True) as doc:
+            verify_example(doc)
+
+def test_index_cache_no_name():
+    with io.open('tests/example.dat', 'rb') as source:
+        stream = io.BytesIO(source.read())
+    with pytest.raises(ValueError):
+        cf.CompoundFileReader(stream, index_cache=True)
+
+def nested_entries(storages=10, streams=100):
+    # Construct a directory with a root containing several storages, each
+    # containing many small streams
+    entries = synthetic.flat_entries(
+        ['Storage %d' % i for i in range(storages)])
+    for storage in entries[1:]:
+        storage.kind = cf.const.DIR_STORAGE
+        children = synthetic.flat_entries(
+            ['Stream %d' % i for i in range(streams)], b'Data' * 16)[1:]
+        base = len(entries) - 1
+        for child in children:
+            for attr in ('left', 'right'):
+                if getattr(child, attr) != synthetic.NO_STREAM:
+                    setattr(child, attr, getattr(child, attr) + base)
+        storage.child = (streams + 1) // 2 + base
+        entries.extend(children)
+    return entries
+
+def test_lazy_dir(sample):
+    filename, contents = sample
+    with cf.CompoundFileReader(filename, lazy_dir=True) as doc:
+        verify_contents(doc, contents)
+        with cf.CompoundFileReader(filename) as eager:
+            assert repr(doc.root) == repr(eager.root)
+
+def test_lazy_dir_partial():
+    data = synthetic.build(nested_entries())
+    with cf.CompoundFileReader(io.BytesIO(data), lazy_dir=True) as doc:
+        entries = doc.root._entries
+        assert len(entries._entities) == 1
+        assert doc.root[3].name == 'Storage 3'
+        # Only the root and its children have been decoded
+        assert len(entries._entities) == 1 + 10
+        assert [e.name for e in doc.root['Storage 3']][42] == 'Stream 42'
+        assert len(doc.root['Storage 5']) == 100
+        assert len(entries._entities) == 1 + 10 + 200
+        assert doc.root['Storage 3'] is doc.root[3]
+    with cf.CompoundFileReader(io.BytesIO(data)) as doc:
+        assert len(doc.root['Storage 3']) == 100
+
+def test_lazy_dir_errors():
+    with cf.CompoundFileReader('tests/invalid_dir_loop.dat', lazy_dir=True) as doc:
+        with pytest.raises(cf.CompoundFileDirLoopError):
+            len(doc.root['Storage 1'])
+        with pytest.raises(cf.CompoundFileDirLoopError):
+            list(doc.root['Storage 1'])
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader('tests/invalid_dir_indexes2.dat', lazy_dir=True) as doc:
+            assert len(w) == 0
+            verify_example(doc)
+            assert issubclass(w[0].category, cf.CompoundFileDirIndexWarning)
+            assert issubclass(w[1].category, cf.CompoundFileDirIndexWarning)
+            assert len(w) == 2
+
+def test_lazy_dir_threads():
+    data = synthetic.build(synthetic.flat_entries(
+        ['Stream %d' % i for i in range(5000)]))
+    for trial in range(20):
+        with cf.CompoundFileReader(data, lazy_dir=True) as doc:
+            start = threading.Event()
+            counts = []
+            def count():
+                start.wait()
+                counts.append(len(list(doc.root)))
+            threads = [threading.Thread(target=count) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+            assert counts == [5000] * 4
+
+def test_lazy_dir_search():
+    data = synthetic.build(nested_entries(streams=1000))
+    with cf.CompoundFileReader(io.BytesIO(data), lazy_dir=True) as doc:
+        entries = doc.root._entries
+        with doc.open('storage 3/STREAM 42') as f:
+            assert f.read() == b'Data' * 16
+        # Only the entries on the search paths have been decoded; the
+        # sibling trees are balanced so this is log2(n) per level
+        assert len(entries._entities) <= 1 + 4 + 10
+        stream = doc.root['Storage 3']['Stream 42']
+        assert b'Stream 999' in doc.root['Storage 3']
+        assert len(entries._entities) <= 1 + 4 + 20
+        # A miss falls back to a full scan of the storage
+        assert 'Stream 1000' not in doc.root['Storage 3']
+        assert len(entries._entities) == 1 + 4 + 1000
+        # Entities found by searching are the same as those found by scanning
+        assert doc.root['Storage 3'][
+            [e.name for e in doc.root['Storage 3']].index('Stream 42')] is stream
+
+def test_lazy_dir_search_unordered():
+    # A degenerate (but legal) sibling chain which is out of order
+    entries = synthetic.flat_entries(['Stream %d' % i for i in range(100)], balanced=False)
+    entries[1:] = entries[:0:-1]
+    for index, entry in enumerate(entries[1:], start=1):
+        entry.right = index + 1 if index < 100 else synthetic.NO_STREAM
+    data = synthetic.build(entries)
+    with cf.CompoundFileReader(io.BytesIO(data), lazy_dir=True) as doc:
+        assert doc.root['Stream 5'].name == 'Stream 5'
+        assert doc.root[0].name == 'Stream 99'
+
+def test_entries_name_index():
+    data = synthetic.build(synthetic.flat_entries(
+        ['Stream %d' % i for i in range(2000)], b'Data'))
+    with cf.CompoundFileReader(io.BytesIO(data)) as doc:
+        assert doc.root._names is None
+        names = [e.name for e in doc.root]
+        for name in names:
+            assert doc.root[name.upper()] is doc.root[names.index(name)]
+        assert len(doc.root._names) == 2000
+        assert 'stream 1999' in doc.root
+        assert 'Stream 2000' not in doc.root
+        with pytest.raises(KeyError):
+            doc.root['Stream 2000']
+
+def test_entity_attributes():
+    with cf.CompoundFileReader('tests/sample1.doc') as doc:
+        assert not hasattr(doc.root, '__dict__')
+        assert doc.root.created is None
+        assert doc.root.modified == datetime(2001, 3, 2, 18, 14, 4, 865000)
+        assert doc.root.uuid == b'\x06\x09\x02\x00\x00\x00\x00\x00\xc0\x00\x00\x00\x00\x00\x00F'
+        assert doc.root['ObjectPool'].created == datetime(2001, 3, 2, 18, 14, 4, 865000)
+        assert doc.root['WordDocument'].modified is None
+        assert doc.root['WordDocument'].uuid == b'\0' * 16
+
+def test_entity_corrected_attributes():
+    with warnings.catch_warnings(record=True) as w:
+        # Same file as example.dat with UUID and timestamps corrupted in
+        # Stream 1; the lazily decoded attributes reflect the corrections
+        with cf.CompoundFileReader('tests/invalid_dir_misc.dat') as doc:
+            entity = doc.root['Storage 1']['Stream 1']
+            assert entity.uuid == b'\0' * 16
+            assert entity.created is None
+            assert entity.modified is None
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader('tests/invalid_name1.dat') as doc:
+            assert doc.root['Storage 1'].name == 'Storage 1'
+
+def walk_paths(entity, prefix=''):
+    for child in entity:
+        path = prefix + child.name
+        yield path, child
+        if child.isdir:
+            for result in walk_paths(child, path + '/'):
+                yield result
+
+def test_directory_table():
+    with cf.CompoundFileReader('tests/sample1.doc') as doc:
+        table = doc.directory_table(use_numpy=False)
+        assert set(table) == {
+            'index', 'name', 'type', 'color', 'left', 'right', 'child',
+            'start_sector', 'size', 'created', 'modified', 'parent', 'path'}
+        count = len(table['index'])
+        assert all(len(column) == count for column in table.values())
+        assert list(table['index']) == list(range(count))
+        assert table['path'][0] == ''
+        assert table['parent'][0] == synthetic.NO_STREAM
+        paths = dict(walk_paths(doc.root))
+        assert sorted(p for p in table['path'] if p) == sorted(paths)
+        for i in range(count):
+            path = table['path'][i]
+            if path:
+                entity = paths[path]
+                assert table['name'][i] == entity.name
+                assert table['size'][i] == entity.size
+                assert table['start_sector'][i] == entity._start_sector
+                assert table['type'][i] == entity._entry_type
+                parent = table['parent'][i]
+                assert table['path'][parent] == path.rpartition('/')[0]
+        assert table['size'][table['path'].index('WordDocument')] == 9280
+
+def test_directory_table_unreachable():
+    with warnings.catch_warnings(record=True) as w:
+        # Loops in the directory don't prevent the table from being built;
+        # each entry is only visited once
+        with cf.CompoundFileReader('tests/invalid_dir_loop.dat', lazy_dir=True) as doc:
+            table = doc.directory_table(use_numpy=False)
+            assert table['path'][:3] == ['', 'Storage 1', 'Storage 1/Stream 1']
+            assert list(table['parent']) == [
+                synthetic.NO_STREAM, 0, 1, synthetic.NO_STREAM]
+            assert table['path'][3] is None
+            assert table['left'][2] == 0
+
+def test_directory_table_numpy():
+    np = pytest.importorskip('numpy')
+    with cf.CompoundFileReader('tests/sample1.doc') as doc:
+        columns = doc.directory_table(use_numpy=False)
+        table = doc.directory_table(use_numpy=True)
+        assert isinstance(table, np.ndarray)
+        for name in columns:
+            assert list(table[name]) == list(columns[name])
+        assert table[table['path'] == 'WordDocument']['size'][0] == 9280
+
+def chain_entries(count, kind):
+    # A root storage containing a degenerate chain of count entries linked
+    # via their right siblings, left siblings, or (for nested storages) their
+    # children
+    entries = synthetic.flat_entries(
+        ['S%d' % i for i in range(count)], balanced=False)
+    if kind == 'left':
+        for index in range(1, count + 1):
+            entries[index].right = synthetic.NO_STREAM
+            entries[index].left = index - 1 if index > 1 else synthetic.NO_STREAM
+        entries[0].child = count
+    elif kind == 'nested':
+        for index in range(1, count + 1):
+            entries[index].right = synthetic.NO_STREAM
+            entries[index].kind = cf.const.DIR_STORAGE
+            entries[index].child = index + 1 if index < count else synthetic.NO_STREAM
+    return entries
+
+@pytest.mark.parametrize('kind', ['right', 'left', 'nested'])
+def test_build_tree_linear_chains(kind):
+    count = 100000
+    data = synthetic.build(chain_entries(count, kind))
+    with cf.CompoundFileReader(io.BytesIO(data)) as doc:
+        if kind == 'nested':
+            entity = doc.root
+            for index in range(count):
+                assert len(entity) == 1
+                entity = entity[0]
+            assert len(entity) == 0
+        else:
+            assert len(doc.root) == count
+            names = [entity.name for entity in doc.root]
+            assert len(set(names)) == count
+            assert names == sorted(names, key=lambda n: (len(n), n.upper()))
+            assert doc.root['S%d' % (count - 1)].name == 'S%d' % (count - 1)
+
+def test_build_tree_scaling():
+    # Building the tree must be linear in the length of a sibling chain; count
+    # the entries looked up rather than timing the build, as a quadratic
+    # builder would look up each entry more than a constant number of times
+    class CountingList(list):
+        lookups = 0
+        def __getitem__(self, index):
+            CountingList.lookups += 1
+            return super(CountingList, self).__getitem__(index)
+    def build_lookups(count):
+        data = synthetic.build(chain_entries(count, 'right'))
+        with cf.CompoundFileReader(io.BytesIO(data)) as doc:
+            stream = cf.streams.CompoundFileNormalStream(doc, doc._dir_first_sector)
+            entries = [
+                cf.CompoundFileEntity(doc, stream, index)
+                for index in range(count + 1)]
+            root = entries[0]
+            CountingList.lookups = 0
+            root._build_tree(CountingList([None] + entries[1:]), doc._warn)
+            assert len(root._children) == count
+            return CountingList.lookups
+    small = build_lookups(25000)
+    large = build_lookups(100000)
+    assert small >= 25000
+    assert large <= small * 4 + 10
+
+class FakeReader(object):
+    # Just enough of CompoundFileReader to construct a stream
+    def __init__(
+            self, data, fat, sector_size=512, header_size=512,
+            lazy_chains=False, mini_fat=None, root=None):
+        self._mmap = data
+        self._view = None
+        self._base = 0
+        self._lazy_chains = lazy_chains
+        self._normal_fat = fat
+        self._normal_sector_size = sector_size
+        self._header_size = header_size
+        self._mini_fat = mini_fat
+        self._mini_sector_size = 64
+        self._mini_buffer = False
+        self._validation = 'default'
+        self.budget = None
+        self.root = root
+
+    def _get_chain(self, kind, start):
+        return cf.fat.SectorChain(
+            self._normal_fat if kind == 'normal' else self._mini_fat, start)
+
+    def _warn(self, warning, location='header', index=None):
+        warnings.warn(warning)
+
+class FakeRoot(object):
+    def __init__(self, start_sector, size):
+        self._start_sector = start_sector
+        self.size = size
+
+def make_fat(chain, size):
+    fat = [cf.const.FREE_SECTOR] * size
+    for sector, next_sector in zip(chain, chain[1:] + [cf.const.END_OF_CHAIN]):
+        fat[sector] = next_sector
+    return fat
+
+@pytest.mark.parametrize('lazy_chains', [False, True])
+def test_stream_extents(lazy_chains):
+    # A chain of 20 sectors in 7 extents: 3-6, 11, 10 (reversed, so not one
+    # extent), 14-19, 0-2, 7-9, and 12-13
+    chain = [3, 4, 5, 6, 11, 10, 14, 15, 16, 17, 18, 19, 0, 1, 2, 7, 8, 9, 12, 13]
+    fat = make_fat(chain, 20)
+    data = b'\0' * 512 + b''.join(
+        bytes(bytearray([sector, 0])) * 256 for sector in range(20))
+    expected = b''.join(data[512 + s * 512:1024 + s * 512] for s in chain)
+    f = cf.streams.CompoundFileNormalStream(
+        FakeReader(data, fat, lazy_chains=lazy_chains), chain[0],
+        len(expected) - 100)
+    expected = expected[:-100]
+    if lazy_chains:
+        assert list(f._extent_sectors) == []
+        assert f.seek(0, io.SEEK_END) == len(expected)
+        assert list(f._extent_sectors) == []
+        f.seek(0)
+        assert f.read(1) == expected[:1]
+        assert list(f._extent_sectors) == [3]
+        assert list(f._extent_offsets) == [0, 1]
+        f.seek(6000)
+        assert f.read(1) == expected[6000:6001]
+        assert list(f._extent_sectors) == [3, 11, 10, 14]
+        assert list(f._extent_offsets) == [0, 4, 5, 6, 12]
+        f.seek(0)
+    assert f.read() == expected
+    assert list(f._extent_sectors) == [3, 11, 10, 14, 0, 7, 12]
+    assert list(f._extent_offsets) == [0, 4, 5, 6, 12, 15, 18, 20]
+    f.seek(0)
+    assert f.read1() == expected[:4 * 512]
+    assert f.read1(10) == expected[4 * 512:4 * 512 + 10]
+    for pos in (0, 1, 511, 512, 2047, 2048, 2560, 6143, 6144, 9000, 10000):
+        for n in (1, 100, 512, 3000):
+            f.seek(pos)
+            assert f.read(n) == expected[pos:pos + n]
+            assert f.tell() == min(len(expected), pos + n)
+    f.seek(len(expected) + 1000)
+    assert f.read() == b''
+
+def sample_streams(doc):
+    for path, entity in walk_paths(doc.root):
+        if entity.isfile:
+            yield path
+
+def read_streams(doc):
+    # Returns a dict mapping the path of each stream in "doc" to its content
+    result = {}
+    for path in sample_streams(doc):
+        with doc.open(path) as f:
+            result[path] = f.read()
+    return result
+
+def assert_same_streams(doc, filename):
+    # Checks that the streams of "doc" match those of "filename" when read
+    # with the default options
+    with cf.CompoundFileReader(filename) as expected:
+        assert read_streams(doc) == read_streams(expected)
+
+@pytest.mark.parametrize('emulated', [False, True])
+def test_stream_readinto(sample, emulated):
+    filename, contents = sample
+    with io.open(filename, 'rb') as f:
+        source = io.BytesIO(f.read()) if emulated else f
+        with warnings.catch_warnings(record=True) as w:
+            doc = cf.CompoundFileReader(
+                source, backend='fake' if emulated else None)
+        with doc:
+            assert (doc._view is None) == emulated
+            for path in sample_streams(doc):
+                with doc.open(path) as f:
+                    expected = f.read()
+                    f.seek(0)
+                    buf = bytearray(len(expected) + 10)
+                    assert f.readinto(buf) == len(expected)
+                    assert buf[:len(expected)] == expected
+                    assert f.readinto(buf) == 0
+                    f.seek(1)
+                    buf = bytearray(100)
+                    n = f.readinto1(buf)
+                    assert 0 < n <= 100
+                    assert buf[:n] == expected[1:1 + n]
+                    assert f.tell() == 1 + n
+                    # Non-byte buffers are filled byte-wise
+                    f.seek(0)
+                    buf = array(str('H'), [0]) * 8
+                    assert f.readinto(buf) == min(16, len(expected))
+                    assert buf.tobytes()[:len(expected)] == expected[:16]
+                    f.seek(0)
+                    buf = array(str('b'), [0]) * 10
+                    assert f.readinto(buf) == min(10, len(expected))
+                    assert buf.tobytes()[:len(expected)] == expected[:10]
+
+def test_stream_buffered_reader(sample):
+    filename, contents = sample
+    with cf.CompoundFileReader(filename) as doc:
+        for path in sample_streams(doc):
+            with doc.open(path) as f:
+                expected = f.read()
+            with io.BufferedReader(doc.open(path), buffer_size=100) as f:
+                assert f.read(10) == expected[:10]
+                assert f.read() == expected[10:]
+
+def test_stream_read_view(sample):
+    filename, contents = sample
+    with cf.CompoundFileReader(filename) as doc:
+        for path in sample_streams(doc):
+            with doc.open(path) as f:
+                expected = f.read()
+                f.seek(0)
+                views = []
+                while True:
+                    view = f.read_view()
+                    if not len(view):
+                        break
+                    assert isinstance(view, memoryview)
+                    views.append(view)
+                assert b''.join(views) == expected
+                for view in views:
+                    view.release()
+
+def test_stream_read_view_blocks_close():
+    doc = cf.CompoundFileReader('tests/example2.dat')
+    with doc.open('Storage 1/Stream 2') as f:
+        view = f.read_view(100)
+        assert view.tobytes() == b'Blah' * 25
+    with pytest.raises(BufferError):
+        doc.close()
+    view.release()
+    doc = cf.CompoundFileReader('tests/example2.dat')
+    with doc.open('Storage 1/Stream 2') as f:
+        view = f.read_view(100)
+    view.release()
+    doc.close()
+
+def test_stream_lazy_chains_loop():
+    # A chain of 3 sectors which loops back to the second sector
+    fat = [1, 2, 1]
+    data = b'\0' * 512 * 4
+    with pytest.raises(cf.CompoundFileNormalLoopError):
+        cf.streams.CompoundFileNormalStream(FakeReader(data, fat), 0, 512 * 10)
+    f = cf.streams.CompoundFileNormalStream(
+        FakeReader(data, fat, lazy_chains=True), 0, 512 * 10)
+    assert f.read(1024) == b'\0' * 1024
+    with pytest.raises(cf.CompoundFileNormalLoopError):
+        f.read()
+
+def test_stream_lazy_chains(sample):
+    filename, contents = sample
+    with cf.CompoundFileReader(filename) as eager_doc:
+        with cf.CompoundFileReader(filename, lazy_chains=True) as lazy_doc:
+            for path in sample_streams(eager_doc):
+                with eager_doc.open(path) as eager:
+                    with lazy_doc.open(path) as lazy:
+                        assert lazy.seek(0, io.SEEK_END) == eager.seek(0, io.SEEK_END)
+                        for pos in (100, 0, 5000):
+                            eager.seek(pos)
+                            lazy.seek(pos)
+                            assert lazy.read(700) == eager.read(700)
+                        lazy.seek(0)
+                        eager.seek(0)
+                        assert lazy.read() == eager.read()
+                        assert list(lazy._extent_sectors) == list(eager._extent_sectors)
+
+def test_stream_lazy_chains_partial():
+    data = synthetic.build(synthetic.flat_entries(['Big'], b'x' * 1048576))
+    with warnings.catch_warnings(record=True) as w:
+        doc = cf.CompoundFileReader(io.BytesIO(data), lazy_chains=True)
+    with doc:
+        with doc.open('Big') as f:
+            assert f.read(10) == b'x' * 10
+            assert f._extent_offsets[-1] == 1
+            assert f.seek(0, io.SEEK_END) == 1048576
+            assert f._extent_offsets[-1] == 1
+            f.seek(-10, io.SEEK_END)
+            assert f.read() == b'x' * 10
+            assert f._extent_offsets[-1] == 2048
+
+def test_chain_cache():
+    with cf.CompoundFileReader('tests/example2.dat') as doc:
+        info = doc.chain_cache_info()
+        assert info.maxsize == 128
+        with doc.open('Storage 1/Stream 2') as f:
+            chain = f._chain
+        after = doc.chain_cache_info()
+        assert after.misses == info.misses + 1
+        assert after.currsize == info.currsize + 1
+        with doc.open('Storage 1/Stream 2') as f:
+            assert f._chain is chain
+            assert f.read() == b'Blah' * 1024 + b'TheEndOfTheFile!'
+        assert doc.chain_cache_info().hits == after.hits + 1
+        # Each mini stream reads from the root entry's stream; only the first
+        # open of a mini stream should miss on the root's chain
+        info = doc.chain_cache_info()
+        with doc.open('Storage 1/Stream 1') as f:
+            assert f._file._chain is doc._chains[('normal', doc.root._start_sector)]
+        with doc.open('Storage 1/Stream 1') as f:
+            assert f.read() == b'Data' * 136
+        after = doc.chain_cache_info()
+        assert after.hits + after.misses == info.hits + info.misses + 4
+        assert after.hits >= info.hits + 2
+
+def test_chain_cache_eviction():
+    with cf.CompoundFileReader('tests/example2.dat', chain_cache=2) as doc:
+        assert doc.chain_cache_info().currsize <= 2
+        with doc.open('Storage 1/Stream 2') as f:
+            chain = f._chain
+        with doc.open('Storage 1/Stream 1') as f:
+            pass
+        # Stream 1's chain and the root entry's chain have evicted Stream 2's
+        assert doc.chain_cache_info().currsize == 2
+        misses = doc.chain_cache_info().misses
+        with doc.open('Storage 1/Stream 2') as f:
+            assert f._chain is not chain
+        assert doc.chain_cache_info().misses == misses + 1
+    with cf.CompoundFileReader('tests/example2.dat', chain_cache=0) as doc:
+        with doc.open('Storage 1/Stream 2') as f:
+            chain = f._chain
+        with doc.open('Storage 1/Stream 2') as f:
+            assert f._chain is not chain
+        info = doc.chain_cache_info()
+        assert info.hits == 0
+        assert info.currsize == 0
+
+def test_chain_cache_lazy_chains():
+    data = synthetic.build(synthetic.flat_entries(['Big'], b'x' * 1048576))
+    with warnings.catch_warnings(record=True) as w:
+        doc = cf.CompoundFileReader(io.BytesIO(data), lazy_chains=True)
+    with doc:
+        with doc.open('Big') as f1, doc.open('Big') as f2:
+            assert f1._chain is f2._chain
+            f1.seek(-10, io.SEEK_END)
+            assert f1.read() == b'x' * 10
+            # The chain followed by f1 is available to f2
+            assert f2._extent_offsets[-1] == 2048
+            assert f2.read() == b'x' * 1048576
+
+def test_fat_analysis():
+    FREE, END = cf.const.FREE_SECTOR, cf.const.END_OF_CHAIN
+    fat = cf.fat.fat_array()
+    fat.extend([
+        1, 2, END,      # 0-2: a simple chain
+        4, 3,           # 3-4: a cycle with no head
+        6, 7, 6,        # 5-7: a chain which ends in a cycle
+        2,              # 8: cross-linked into the chain at 0
+        FREE,           # 9: unused
+        END,            # 10: a single sector chain
+        7,              # 11: cross-linked into the cycle at 5
+        cf.const.NORMAL_FAT_SECTOR,
+        100,            # 13: an invalid pointer
+        ])
+    analysis = cf.fat.FatAnalysis(fat)
+    assert len(analysis) == 14
+    assert list(analysis.heads) == [
+        0, 0, 0, 3, 3, 5, 5, 5, 8, FREE, 10, 11, FREE, FREE]
+    assert list(analysis.positions) == [
+        0, 1, 2, 0, 1, 0, 1, 2, 0, 0, 0, 0, 0, 0]
+    assert [s for s in range(14) if analysis.is_member(s)] == [
+        0, 1, 2, 3, 4, 5, 6, 7, 8, 10, 11]
+    assert [s for s in range(14) if analysis.is_cyclic(s)] == [
+        3, 4, 5, 6, 7, 11]
+    assert [s for s in range(14) if analysis.is_cross_linked(s)] == [2, 6, 7]
+    assert not analysis.is_member(14)
+    assert not analysis.is_cyclic(-1)
+
+def test_fat_analysis_reader(sample):
+    filename, contents = sample
+    with cf.CompoundFileReader(filename) as doc:
+        assert doc.fat_analysis is None
+        expected = read_streams(doc)
+    with cf.CompoundFileReader(filename, analyze_fat=True) as doc:
+        assert len(doc.fat_analysis) == len(doc._normal_fat)
+        assert len(doc.mini_fat_analysis) == len(doc._mini_fat)
+        for path in sample_streams(doc):
+            with doc.open(path) as f:
+                assert f._chain._acyclic
+                assert f.read() == expected[path]
+                fat = doc._normal_fat if f._chain._fat is doc._normal_fat else doc._mini_fat
+                analysis = doc.fat_analysis if fat is doc._normal_fat else doc.mini_fat_analysis
+                sectors = [f._chain.start]
+                while fat[sectors[-1]] != cf.const.END_OF_CHAIN:
+                    sectors.append(fat[sectors[-1]])
+                assert [analysis.heads[s] for s in sectors] == [sectors[0]] * len(sectors)
+                assert [analysis.positions[s] for s in sectors] == list(range(len(sectors)))
+                assert not any(analysis.is_cross_linked(s) for s in sectors)
+
+def test_fat_analysis_loop():
+    with pytest.raises(cf.CompoundFileNormalLoopError):
+        cf.CompoundFileReader('tests/invalid_fat_loop.dat', analyze_fat=True)
+    data = synthetic.build(synthetic.flat_entries(['Big'], b'x' * 8192))
+    with warnings.catch_warnings(record=True) as w:
+        doc = cf.CompoundFileReader(io.BytesIO(data), analyze_fat=True)
+    with doc:
+        # Corrupt the last sector of Big's chain to point back to its start;
+        # this is detected when the stream is opened rather than as it's read
+        start = doc.root['Big']._start_sector
+        fat = doc._normal_fat
+        sector = start
+        while fat[sector] != cf.const.END_OF_CHAIN:
+            sector = fat[sector]
+        fat[sector] = start
+        doc.fat_analysis = cf.fat.FatAnalysis(fat)
+        assert doc.fat_analysis.is_cyclic(start)
+        with pytest.raises(cf.CompoundFileNormalLoopError):
+            doc.open('Big')
+
+def test_mini_buffer(sample):
+    filename, contents = sample
+    with cf.CompoundFileReader(filename) as doc:
+        expected = read_streams(doc)
+    with cf.CompoundFileReader(filename, mini_buffer=True) as doc:
+        assert doc._mini_data is None
+        for path in sample_streams(doc):
+            with doc.open(path) as f:
+                if isinstance(f, cf.streams.CompoundFileMiniStream):
+                    assert f._file is None
+                    assert f._mmap is doc._mini_data[0]
+                assert f.read() == expected[path]
+                f.seek(3)
+                buf = bytearray(len(expected[path]))
+                assert f.readinto(buf) == len(expected[path]) - 3
+                assert buf[:len(buf) - 3] == expected[path][3:]
+                f.seek(0)
+                view = f.read_view()
+                assert view.tobytes() == expected[path][:len(view)]
+                view.release()
+
+def test_mini_buffer_truncated():
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader('tests/invalid_truncated.dat', mini_buffer=True) as doc:
+            with doc.open('Storage 1/Stream 1') as f:
+                assert len(f.read()) == 1500
+            # The truncation is found when the mini stream is buffered, which
+            # pads it to its full length
+            assert all(
+                issubclass(warning.category, cf.CompoundFileTruncatedWarning)
+                for warning in w)
+            assert len(w) == 1
+
+@pytest.mark.parametrize('lazy_chains', [False, True])
+def test_mini_stream_extents(lazy_chains):
+    # The root entry's stream occupies sectors 2, 3, 0, and 1 (in that order)
+    # giving 32 mini sectors in two extents: 0-15 in sectors 2-3, and 16-31 in
+    # sectors 0-1. The mini stream occupies mini sectors 4-20 (crossing from
+    # one extent of the root stream to the other) and 30-31
+    root_chain = [2, 3, 0, 1]
+    mini_chain = list(range(4, 21)) + [30, 31]
+    data = b'\0' * 512 + b''.join(
+        bytes(bytearray(range(s * 64, s * 64 + 64))) * 8 for s in range(4))
+    root_data = b''.join(data[512 + s * 512:1024 + s * 512] for s in root_chain)
+    expected = b''.join(root_data[s * 64:s * 64 + 64] for s in mini_chain)[:-10]
+    reader = FakeReader(
+        data, make_fat(root_chain, 4), lazy_chains=lazy_chains,
+        mini_fat=make_fat(mini_chain, 32), root=FakeRoot(2, 2048))
+    f = cf.streams.CompoundFileMiniStream(reader, 4, len(expected))
+    assert f.read() == expected
+    f.seek(0)
+    # Each read1 returns a run which is contiguous in both the mini stream
+    # and the document: mini sectors 4-15, 16-20, then 30-31
+    assert f.read1() == expected[:12 * 64]
+    assert f.read1() == expected[12 * 64:17 * 64]
+    assert f.read1() == expected[17 * 64:]
+    assert f.read1() == b''
+    for pos in (0, 100, 511, 512, 767, 768, 1000, 1100):
+        f.seek(pos)
+        assert f.read(300) == expected[pos:pos + 300]
+
+def test_validation_invalid():
+    with pytest.raises(ValueError):
+        cf.CompoundFileReader('tests/example.dat', validation='foo')
+
+@pytest.mark.parametrize('filename,category', [
+    ('tests/invalid_root_type.dat', cf.CompoundFileDirTypeWarning),
+    ('tests/invalid_dir_indexes3.dat', cf.CompoundFileDirIndexWarning),
+    ('tests/invalid_fat_types.dat', cf.CompoundFileMasterSectorWarning),
+    ('tests/invalid_header_misc.dat', cf.CompoundFileHeaderWarning),
+    ('tests/invalid_master_ext_free.dat', cf.CompoundFileMasterFatWarning),
+    ('tests/invalid_mini_eof.dat', cf.CompoundFileMiniFatWarning),
+    ])
+def test_validation_strict(filename, category):
+    with pytest.raises(category):
+        cf.CompoundFileReader(filename, validation='strict')
+
+def test_validation_strict_stream():
+    with cf.CompoundFileReader(
+            'tests/invalid_truncated.dat', validation='strict') as doc:
+        with doc.open('Storage 1/Stream 1') as f:
+            with pytest.raises(cf.CompoundFileTruncatedWarning):
+                f.read()
+
+def test_validation_strict_clean(sample):
+    filename, contents = sample
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader(filename) as doc:
+            expected = len(w)
+    if expected:
+        with pytest.raises(cf.CompoundFileWarning):
+            cf.CompoundFileReader(filename, validation='strict')
+    else:
+        with cf.CompoundFileReader(filename, validation='strict') as doc:
+            verify_contents(doc, contents)
+
+def test_validation_trusted(sample):
+    filename, contents = sample
+    with cf.CompoundFileReader(filename, validation='trusted') as doc:
+        verify_contents(doc, contents)
+
+def test_validation_trusted_skips_checks():
+    for filename in (
+            'tests/invalid_dir_misc.dat',
+            'tests/invalid_fat_types.dat',
+            'tests/invalid_header_misc.dat',
+            'tests/invalid_root_type.dat',
+            ):
+        with warnings.catch_warnings(record=True) as w:
+            with cf.CompoundFileReader(filename, validation='trusted') as doc:
+                verify_example(doc)
+            assert len(w) == 0
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader(
+                'tests/invalid_fat_types.dat', lazy_fat=True,
+                validation='trusted') as doc:
+            verify_example(doc)
+        assert len(w) == 0
+
+def test_validation_trusted_decodes():
+    with io.open('tests/sample1.doc', 'rb') as f:
+        data = bytearray(f.read())
+    with cf.CompoundFileReader(bytes(data)) as doc:
+        expected = doc.open('\x01CompObj').read()
+    # Set the (invalid) high dword of CompObj's size, and an invalid type on
+    # ObjectPool; both must still be corrected in trusted mode
+    for name, offset, value in (
+            ('\x01CompObj', 124, b'\x01\0\0\0'),
+            ('ObjectPool', 66, b'\x05'),
+            ):
+        entry = data.find((name + '\0').encode('utf-16le'))
+        assert entry != -1 and entry % 128 == 0
+        data[entry + offset:entry + offset + len(value)] = value
+    for validation in ('default', 'trusted'):
+        with warnings.catch_warnings(record=True) as w:
+            with cf.CompoundFileReader(
+                    bytes(data), validation=validation) as doc:
+                assert doc.root['\x01CompObj'].size == 106
+                assert doc.open('\x01CompObj').read() == expected
+                assert not doc.root['ObjectPool'].isdir
+                assert not doc.root['ObjectPool'].isfile
+
+def test_validation_trusted_guards():
+    with pytest.raises(cf.CompoundFileDirLoopError):
+        cf.CompoundFileReader('tests/invalid_dir_loop.dat', validation='trusted')
+    with pytest.raises(cf.CompoundFileNormalLoopError):
+        cf.CompoundFileReader('tests/invalid_fat_loop.dat', validation='trusted')
+    with pytest.raises(cf.CompoundFileMasterLoopError):
+        cf.CompoundFileReader('tests/invalid_master_loop.dat', validation='trusted')
+    with cf.CompoundFileReader(
+            'tests/invalid_dir_size2.dat', validation='trusted') as doc:
+        # Streams are still limited to the length of their chains
+        with doc.open('Storage 1/Stream 1') as f:
+            assert f.seek(0, io.SEEK_END) == 576
+        with doc.open('Storage 1/Stream 2') as f:
+            assert f.seek(0, io.SEEK_END) == 512
+
+def test_validation_index_cache(tmpdir):
+    index = str(tmpdir.join('example.cfidx'))
+    with cf.CompoundFileReader(
+            'tests/invalid_dir_misc.dat', index_cache=index,
+            validation='trusted') as doc:
+        verify_example(doc)
+    assert not os.path.exists(index)
+    with cf.CompoundFileReader(
+            'tests/invalid_dir_misc.dat', index_cache=index) as doc:
+        verify_example(doc)
+    assert os.path.exists(index)
+    with pytest.raises(cf.CompoundFileDirEntryWarning):
+        cf.CompoundFileReader(
+            'tests/invalid_dir_misc.dat', index_cache=index,
+            validation='strict')
+
+def test_diagnostics():
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader('tests/invalid_dir_misc.dat') as doc:
+            assert [d.category for d in doc.diagnostics] == [
+                cf.CompoundFileDirEntryWarning,
+                cf.CompoundFileDirTimeWarning,
+                cf.CompoundFileDirTimeWarning,
+                ]
+            assert [str(warning.message) for warning in w] == [
+                d.message for d in doc.diagnostics]
+            stream = doc.root['Storage 1']['Stream 1']
+            assert all(
+                (d.location, d.index) == ('entry', stream._index)
+                for d in doc.diagnostics)
+    with cf.CompoundFileReader('tests/invalid_fat_types.dat') as doc:
+        assert [(d.category, d.location) for d in doc.diagnostics] == [
+            (cf.CompoundFileMasterSectorWarning, 'sector'),
+            (cf.CompoundFileNormalSectorWarning, 'sector'),
+            ]
+    with cf.CompoundFileReader('tests/invalid_header_misc.dat') as doc:
+        assert doc.diagnostics
+        assert all(
+            (d.location, d.index) == ('header', None)
+            for d in doc.diagnostics)
+    with cf.CompoundFileReader('tests/example.dat') as doc:
+        assert doc.diagnostics == []
+
+def test_diagnostics_streams():
+    with cf.CompoundFileReader('tests/invalid_truncated.dat') as doc:
+        del doc.diagnostics[:]
+        entity = doc.root['Storage 1']['Stream 1']
+        with doc.open(entity) as f:
+            f.read()
+        assert doc.diagnostics
+        assert all(
+            d.category == cf.CompoundFileTruncatedWarning and
+            (d.location, d.index) == ('mini_sector', entity._start_sector)
+            for d in doc.diagnostics)
+
+def test_diagnostics_no_warnings():
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader(
+                'tests/invalid_dir_misc.dat', emit_warnings=False) as doc:
+            verify_example(doc)
+            assert len(doc.diagnostics) == 3
+        assert len(w) == 0
+    with pytest.raises(cf.CompoundFileDirEntryWarning):
+        cf.CompoundFileReader(
+            'tests/invalid_dir_misc.dat', emit_warnings=False,
+            validation='strict')
+
+def test_budget_unlimited(sample):
+    filename, contents = sample
+    budget = cf.CompoundFileBudget()
+    with cf.CompoundFileReader(filename, budget=budget) as doc:
+        verify_contents(doc, contents)
+        assert doc.budget is not budget
+        assert doc.budget.sector_reads_used > 0
+        assert doc.budget.table_memory_used >= len(doc._normal_fat) * 4
+    assert budget.sector_reads_used == 0
+    assert budget.table_memory_used == 0
+
+def test_budget_sector_reads():
+    with pytest.raises(cf.CompoundFileBudgetError):
+        cf.CompoundFileReader(
+            'tests/example2.dat',
+            budget=cf.CompoundFileBudget(sector_reads=2))
+    with cf.CompoundFileReader(
+            'tests/example2.dat',
+            budget=cf.CompoundFileBudget(sector_reads=10)) as doc:
+        used = doc.budget.sector_reads_used
+        with doc.open('Storage 1/Stream 2') as f:
+            with pytest.raises(cf.CompoundFileBudgetError):
+                f.read()
+        assert doc.budget.sector_reads_used > used
+
+def test_budget_table_memory():
+    data = synthetic.build(synthetic.flat_entries(
+        ['Stream %d' % i for i in range(10)], b'Data' * 1024))
+    with cf.CompoundFileReader(io.BytesIO(data)) as doc:
+        fat_size = len(doc._normal_fat) * 4
+    for lazy_fat in (False, True):
+        with pytest.raises(cf.CompoundFileBudgetError):
+            cf.CompoundFileReader(
+                io.BytesIO(data), lazy_fat=lazy_fat,
+                budget=cf.CompoundFileBudget(table_memory=fat_size // 2))
+    with cf.CompoundFileReader(
+            io.BytesIO(data),
+            budget=cf.CompoundFileBudget(table_memory=fat_size * 4)) as doc:
+        with pytest.raises(cf.CompoundFileBudgetError):
+            cf.CompoundFileReader(
+                io.BytesIO(data), analyze_fat=True,
+                budget=cf.CompoundFileBudget(
+                    table_memory=doc.budget.table_memory_used))
+
+def test_budget_dir_entries():
+    data = synthetic.build(synthetic.flat_entries(
+        ['Stream %d' % i for i in range(20)], b'Data'))
+    for lazy_dir in (False, True):
+        with pytest.raises(cf.CompoundFileBudgetError):
+            cf.CompoundFileReader(
+                io.BytesIO(data), lazy_dir=lazy_dir,
+                budget=cf.CompoundFileBudget(dir_entries=20))
+    with cf.CompoundFileReader(
+            io.BytesIO(data),
+            budget=cf.CompoundFileBudget(dir_entries=24)) as doc:
+        assert len(doc.root) == 20
+
+def test_budget_chain_length():
+    with cf.CompoundFileReader(
+            'tests/example2.dat',
+            budget=cf.CompoundFileBudget(chain_length=4)) as doc:
+        with pytest.raises(cf.CompoundFileBudgetError):
+            doc.open('Storage 1/Stream 2')
+    with cf.CompoundFileReader(
+            'tests/example2.dat', lazy_chains=True,
+            budget=cf.CompoundFileBudget(chain_length=4)) as doc:
+        with doc.open('Storage 1/Stream 2') as f:
+            assert f.read(4 * 512) == b'Blah' * 512
+            with pytest.raises(cf.CompoundFileBudgetError):
+                f.read(1)
+
+def test_budget_time(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(cf.budget, '_clock', lambda: now[0])
+    with cf.CompoundFileReader(
+            'tests/example2.dat',
+            budget=cf.CompoundFileBudget(time=10)) as doc:
+        now[0] = 11.0
+        with doc.open('Storage 1/Stream 2') as f:
+            with pytest.raises(cf.CompoundFileBudgetError):
+                f.read()
+
+requires_pread = pytest.mark.skipif(
+    not hasattr(os, 'pread'), reason='os.pread is not available')
+
+@requires_pread
+def test_backend_pread(sample):
+    filename, contents = sample
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader(filename, backend='pread') as doc:
+            assert isinstance(doc._mmap, cf.mmap.PreadMemoryMap)
+            assert doc._view is None
+            verify_contents(doc, contents)
+        assert not any(
+            issubclass(warning.category, cf.CompoundFileEmulationWarning)
+            for warning in w)
+
+def test_backend_window(sample):
+    filename, contents = sample
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader(filename, backend='window') as doc:
+            assert isinstance(doc._mmap, cf.mmap.WindowMemoryMap)
+            assert doc._view is None
+            verify_contents(doc, contents)
+            assert_same_streams(doc, filename)
+        assert not any(
+            issubclass(warning.category, cf.CompoundFileEmulationWarning)
+            for warning in w)
+
+def test_backend_fake(sample):
+    filename, contents = sample
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader(filename, backend='fake') as doc:
+            assert isinstance(doc._mmap, cf.mmap.FakeMemoryMap)
+            verify_contents(doc, contents)
+        assert not any(
+            issubclass(warning.category, cf.CompoundFileEmulationWarning)
+            for warning in w)
+
+def test_backend_invalid():
+    with pytest.raises(ValueError):
+        cf.CompoundFileReader('tests/example.dat', backend='foo')
+    with io.open('tests/example.dat', 'rb') as f:
+        data = io.BytesIO(f.read())
+    for backend in ('mmap', 'pread'):
+        with pytest.raises(ValueError):
+            cf.CompoundFileReader(data, backend=backend)
+
+def test_backend_fallback(monkeypatch):
+    real_mmap = cf.reader.mmap.mmap
+    def whole_file(fd, length, *args, **kwargs):
+        if length == 0:
+            raise EnvironmentError(errno.ENOMEM, 'Cannot allocate memory')
+        return real_mmap(fd, length, *args, **kwargs)
+    def no_memory(*args, **kwargs):
+        raise EnvironmentError(errno.ENOMEM, 'Cannot allocate memory')
+    monkeypatch.setattr(cf.reader.mmap, 'mmap', whole_file)
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader('tests/example.dat') as doc:
+            assert isinstance(doc._mmap, cf.mmap.WindowMemoryMap)
+            verify_example(doc)
+        assert issubclass(w[0].category, cf.CompoundFileEmulationWarning)
+    monkeypatch.setattr(cf.reader.mmap, 'mmap', no_memory)
+    if hasattr(os, 'pread'):
+        with warnings.catch_warnings(record=True) as w:
+            with cf.CompoundFileReader('tests/example.dat') as doc:
+                assert isinstance(doc._mmap, cf.mmap.PreadMemoryMap)
+                verify_example(doc)
+            assert issubclass(w[0].category, cf.CompoundFileEmulationWarning)
+        monkeypatch.delattr(os, 'pread')
+    with warnings.catch_warnings(record=True) as w:
+        with cf.CompoundFileReader('tests/example.dat') as doc:
+            assert isinstance(doc._mmap, cf.mmap.FakeMemoryMap)
+            verify_example(doc)
+        assert issubclass(w[0].category, cf.CompoundFileEmulationWarning)
+    with pytest.raises(EnvironmentError):
+        cf.CompoundFileReader('tests/example.dat', backend='mmap')
+
+@requires_pread
+def test_backend_pread_threads():
+    data = synthetic.build(synthetic.flat_entries(
+        ['Stream %d' % i for i in range(8)], b'Data' * 4096))
+    fd, filename = tempfile.mkstemp(suffix='.dat')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        with cf.CompoundFileReader(filename) as doc:
+            expected = read_streams(doc)
+        with cf.CompoundFileReader(filename, backend='pread') as doc:
+            errors = []
+            def read_all():
+                try:
+                    for attempt in range(10):
+                        for path in sorted(expected):
+                            with doc.open(path) as f:
+                                assert f.read() == expected[path]
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=read_all) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert not errors
+    finally:
+        os.unlink(filename)
+
+@pytest.mark.parametrize('backend', (None, 'window', 'pread', 'fake'))
+@pytest.mark.parametrize('prefix', (0, 1234, 70000))
+def test_embedded(sample, backend, prefix):
+    if backend == 'pread' and not hasattr(os, 'pread'):
+        pytest.skip('os.pread is not available')
+    filename, contents = sample
+    with io.open(filename, 'rb') as f:
+        data = f.read()
+    fd, container = tempfile.mkstemp(suffix='.dat')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'\xff' * prefix + data + b'\xff' * 777)
+        with io.open(container, 'rb') as f:
+            with cf.CompoundFileReader(
+                    f, backend=backend, offset=prefix,
+                    length=len(data)) as doc:
+                assert doc._file_size == len(data)
+                verify_contents(doc, contents)
+                assert_same_streams(doc, filename)
+    finally:
+        os.unlink(container)
+
+def test_embedded_remainder():
+    with io.open('tests/example.dat', 'rb') as f:
+        data = f.read()
+    for backend in (None, 'fake'):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'\0' * 100 + data)
+            f.flush()
+            with cf.CompoundFileReader(f, backend=backend, offset=100) as doc:
+                verify_example(doc)
+
+def test_embedded_index_cache(tmpdir, monkeypatch):
+    with io.open('tests/example.dat', 'rb') as f:
+        data = f.read()
+    entry = data.find('Stream 1\0'.encode('utf-16le'))
+    renamed = data[:entry] + 'Stream 2'.encode('utf-16le') + data[entry + 16:]
+    container = str(tmpdir.join('container.dat'))
+    with io.open(container, 'wb') as f:
+        f.write(data + renamed)
+    documents = ((0, 'Stream 1'), (len(data), 'Stream 2'))
+    for offset, name in documents:
+        with cf.CompoundFileReader(
+                container, index_cache=True, offset=offset,
+                length=len(data)) as doc:
+            assert name in doc.root['Storage 1']
+    assert tmpdir.join('container.dat.cfidx').check()
+    assert tmpdir.join('container.dat.%d.cfidx' % len(data)).check()
+    def fail(self, *args):
+        assert False, 'index cache not used'
+    with monkeypatch.context() as m:
+        m.setattr(cf.CompoundFileReader, '_load_directory', fail)
+        for offset, name in documents:
+            with cf.CompoundFileReader(
+                    container, index_cache=True, offset=offset,
+                    length=len(data)) as doc:
+                assert name in doc.root['Storage 1']
+    # An explicit index is keyed on the offset, so an identical document at
+    # another offset doesn't use it
+    index = str(tmpdir.join('shared.cfidx'))
+    with io.open(container, 'wb') as f:
+        f.write(data + data)
+    with cf.CompoundFileReader(container, index_cache=index) as doc:
+        verify_example(doc)
+    with monkeypatch.context() as m:
+        m.setattr(cf.CompoundFileReader, '_load_directory', fail)
+        with pytest.raises(AssertionError):
+            cf.CompoundFileReader(
+                container, index_cache=index, offset=len(data))
+
+def test_embedded_invalid():
+    size = os.stat('tests/example.dat').st_size
+    for backend in (None, 'window', 'pread', 'fake'):
+        if backend == 'pread' and not hasattr(os, 'pread'):
+            continue
+        for offset, length in (
+                (-1, None), (0, -1), (size + 1, None), (1, size),
+                (0, size + 1)):
+            with io.open('tests/example.dat', 'rb') as f:
+                with pytest.raises(ValueError):
+                    cf.CompoundFileReader(
+                        f, backend=backend, offset=offset, length=length)
+    with io.open('tests/example.dat', 'rb') as f:
+        with pytest.raises(ValueError):
+            cf.CompoundFileReader(f, offset=size, length=0)
@@ -31,6 +31,7 @@ from __future__ import (
 str = type('')
 
 
+import os
 import sys
 import io
 import mmap
@@ -42,13 +43,31 @@ import pytest
 def source():
     return io.open('tests/mmap.dat', 'rb')
 
-@pytest.fixture(params=(False, True))
+@pytest.fixture(params=(
+    'real', 'fake', 'fake-blocks', 'fake-uncached', 'pread', 'window',
+    'buffer'))
 def test_map(request, source):
-    # Run all tests against a real memory map, and our fake memory map, both
-    # covering the same underlying file (which just contains a..z), to ensure
-    # that the emulated behaviour matches the real implementation
-    if request.param:
+    # Run all tests against a real memory map, our fake memory map (with its
+    # default cache, a cache of tiny blocks, and without a cache), our
+    # positional read map, our windowed map, and our buffer map, all covering
+    # the same underlying file (which just contains a..z), to ensure that the
+    # emulated behaviour matches the real implementation
+    if request.param == 'buffer':
+        with io.open('tests/mmap.dat', 'rb') as f:
+            return fake_mmap.BufferMemoryMap(bytearray(f.read()))
+    elif request.param == 'window':
+        return fake_mmap.WindowMemoryMap(source.fileno())
+    elif request.param == 'pread':
+        if not hasattr(os, 'pread'):
+            pytest.skip('os.pread is not available')
+        return fake_mmap.PreadMemoryMap(source.fileno())
+    elif request.param == 'fake':
         return fake_mmap.FakeMemoryMap(source)
+    elif request.param == 'fake-blocks':
+        return fake_mmap.FakeMemoryMap(
+            source, block_size=4, cache_size=3, readahead=1)
+    elif request.param == 'fake-uncached':
+        return fake_mmap.FakeMemoryMap(source, cache_size=0)
     else:
         return mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
 
@@ -125,6 +144,9 @@ def test_contains(test_map):
     assert b'def' not in test_map
     assert b'vwxyz' not in test_map
     assert b'blah' not in test_map
+    assert b'' not in test_map
+    assert b'z' in test_map
+    assert b'!' not in test_map
 
 def test_find(test_map):
     assert test_map.find(b'abc') == 0
@@ -132,6 +154,13 @@ def test_find(test_map):
     assert test_map.find(b'xyz') == 23
     assert test_map.find(b'xyz', 0, -1) == -1
     assert test_map.find(b'foobar') == -1
+    assert test_map.find(b'') == 0
+    assert test_map.find(b'', 30) == 26
+    assert test_map.find(b'', -3) == 23
+    assert test_map.find(b'', 5, 3) == -1
+    assert test_map.find(b'xyz', -30) == 23
+    assert test_map.find(b'abc', 0, 2) == -1
+    assert test_map.find(b'c', 5, 3) == -1
 
 def test_rfind(test_map):
     assert test_map.rfind(b'abc') == 0
@@ -139,6 +168,13 @@ def test_rfind(test_map):
     assert test_map.rfind(b'xyz') == 23
     assert test_map.rfind(b'xyz', 0, -1) == -1
     assert test_map.rfind(b'foobar') == -1
+    assert test_map.rfind(b'') == 26
+    assert test_map.rfind(b'', 30) == 26
+    assert test_map.rfind(b'', -3) == 26
+    assert test_map.rfind(b'', 5, 3) == -1
+    assert test_map.rfind(b'xyz', -30) == 23
+    assert test_map.rfind(b'abc', 0, 2) == -1
+    assert test_map.rfind(b'c', 5, 3) == -1
 
 @pytest.mark.skipif(sys.version_info[0] == 3,
         reason="py2 read_byte returns bytes")
@@ -177,3 +213,196 @@ def test_seek_n_tell(test_map):
     assert test_map.tell() == 23
     test_map.seek(0, io.SEEK_SET)
     assert test_map.tell() == 0
+
+
+class CountingFile(io.BytesIO):
+    # A BytesIO which counts the calls made to read it
+    def __init__(self, data):
+        super(CountingFile, self).__init__(data)
+        self.reads = 0
+
+    def read(self, n=-1):
+        self.reads += 1
+        return super(CountingFile, self).read(n)
+
+def test_block_cache():
+    f = CountingFile(bytes(bytearray(range(256))) * 16)
+    m = fake_mmap.FakeMemoryMap(f, block_size=512, cache_size=4, readahead=1)
+    assert m.cache_info() == (0, 0, 0, 0, 4, 0)
+    # A miss reads the block and the next one
+    assert m[0:16] == bytes(bytearray(range(16)))
+    assert m[600:610] == bytes(bytearray(range(88, 98)))
+    assert m.cache_info() == (1, 1, 1, 1024, 4, 2)
+    assert f.reads == 1
+    # Reads spanning two blocks are served from the cache
+    assert m[1000:1100] == (bytes(bytearray(range(256))) * 16)[1000:1100]
+    assert m.cache_info().reads == 2
+    assert m.cache_info().currsize == 4
+    # The least recently used blocks are evicted
+    m[2048:2049]
+    assert m.cache_info().currsize == 4
+    assert 0 not in m._blocks
+    # Large reads bypass the cache
+    hits, misses = m.cache_info()[:2]
+    assert m[0:4096] == bytes(bytearray(range(256))) * 16
+    info = m.cache_info()
+    assert info[:2] == (hits, misses)
+    assert info.bytes_read == 3072 + 4096
+
+def test_block_cache_readahead_eof():
+    f = CountingFile(b'x' * 1000)
+    m = fake_mmap.FakeMemoryMap(f, block_size=256, readahead=8)
+    assert m[900:1000] == b'x' * 100
+    assert m.cache_info().bytes_read == 1000 - 768
+    assert m[:] == b'x' * 1000
+
+def test_block_cache_position():
+    f = CountingFile(b'abcdefghijklmnopqrstuvwxyz')
+    f.seek(10)
+    m = fake_mmap.FakeMemoryMap(f, block_size=4, cache_size=2)
+    assert m.tell() == 0
+    assert m.read(3) == b'abc'
+    assert m[20:23] == b'uvw'
+    assert m.read(3) == b'def'
+    with pytest.raises(ValueError):
+        m.seek(27)
+
+def test_block_cache_short_reads():
+    class ShortReads(io.BytesIO):
+        def read(self, n=-1):
+            return super(ShortReads, self).read(min(n, 3) if n >= 0 else n)
+    m = fake_mmap.FakeMemoryMap(ShortReads(b'abcdefghijklmnopqrstuvwxyz'))
+    assert m[:] == b'abcdefghijklmnopqrstuvwxyz'
+
+def test_find_chunks(tmpdir):
+    # Compare searches which span the boundaries of the chunks used by the
+    # emulation with the results of a real mmap
+    filename = str(tmpdir.join('find.dat'))
+    with io.open(filename, 'wb') as f:
+        f.write(b''.join(
+            ('%05d' % i).encode('ascii') + b'.' * (i % 7) for i in range(2000)))
+    with io.open(filename, 'rb') as f:
+        real = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for search_size in (7, 64, 1000, None):
+                fake = fake_mmap.FakeMemoryMap(f)
+                if search_size is not None:
+                    fake._search_size = search_size
+                for string in (b'00000', b'01999', b'0.....0', b'.0', b'',
+                               b'1234', b'x'):
+                    for args in ((), (3,), (100, 5000), (-5000, -3),
+                                 (5000, 100), (0, 9)):
+                        assert fake.find(string, *args) == real.find(
+                            string, *args)
+                        assert fake.rfind(string, *args) == real.rfind(
+                            string, *args)
+        finally:
+            real.close()
+
+def test_find_reads():
+    # Searching a large document takes a handful of reads, not one per byte
+    f = io.BytesIO(b'\0' * (4 * 1024 * 1024) + b'needle')
+    m = fake_mmap.FakeMemoryMap(f)
+    assert m.find(b'needle') == 4 * 1024 * 1024
+    assert m.rfind(b'\0\0') == 4 * 1024 * 1024 - 2
+    assert m.find(b'haystack') == -1
+    assert m.cache_info().reads < 50
+
+def test_window(source):
+    maps = [
+        fake_mmap.FakeMemoryMap(source, offset=3, length=20),
+        fake_mmap.FakeMemoryMap(
+            source, block_size=4, cache_size=3, readahead=1, offset=3,
+            length=20),
+        fake_mmap.WindowMemoryMap(source.fileno(), offset=3, length=20),
+        fake_mmap.BufferMemoryMap(b'abcdefghijklmnopqrstuvwxyz', 3, 20),
+        ]
+    if hasattr(os, 'pread'):
+        maps.append(fake_mmap.PreadMemoryMap(source.fileno(), 3, 20))
+    for m in maps:
+        assert len(m) == 20
+        assert m[:] == b'defghijklmnopqrstuvw'
+        assert m[-2:] == b'vw'
+        assert m.find(b'w') == 19
+        assert m.find(b'x') == -1
+        m.seek(5)
+        assert m.read(3) == b'ijk'
+    assert fake_mmap.FakeMemoryMap(source, offset=20)[:] == b'uvwxyz'
+    assert len(fake_mmap.FakeMemoryMap(source, offset=26)) == 0
+
+def test_window_invalid(source):
+    # The same exceptions as real mmap raises for each window
+    for offset, length, expected in (
+            (-1, None, OverflowError), (0, -1, OverflowError),
+            (27, None, ValueError), (20, 7, ValueError)):
+        with pytest.raises(expected):
+            fake_mmap.FakeMemoryMap(source, offset=offset, length=length)
+        with pytest.raises(expected):
+            fake_mmap.WindowMemoryMap(
+                source.fileno(), offset=offset, length=length)
+        with pytest.raises(expected):
+            fake_mmap.BufferMemoryMap(
+                b'abcdefghijklmnopqrstuvwxyz', offset, length)
+        if hasattr(os, 'pread'):
+            with pytest.raises(expected):
+                fake_mmap.PreadMemoryMap(source.fileno(), offset, length)
+
+def test_windows(tmpdir):
+    # Compare slices within and across the windows of a map of several
+    # windows with the results of a real mmap
+    granularity = mmap.ALLOCATIONGRANULARITY
+    filename = str(tmpdir.join('windows.dat'))
+    with io.open(filename, 'wb') as f:
+        f.write(bytes(bytearray(range(256))) * (granularity * 5 // 256 + 3))
+    with io.open(filename, 'rb') as f:
+        real = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            m = fake_mmap.WindowMemoryMap(
+                f.fileno(), window_size=1, max_windows=2)
+            assert m._window_size == granularity
+            assert m.cache_info() == (0, 1, 1, granularity, 2, 1)
+            assert len(m) == len(real)
+            for start, stop in (
+                    (0, 10), (granularity - 10, granularity + 10),
+                    (granularity * 3 + 5, granularity * 3 + 700),
+                    (granularity - 1, granularity * 4 + 1), (None, None),
+                    (-100, None)):
+                assert m[start:stop] == real[start:stop]
+            info = m.cache_info()
+            assert info.currsize == 2
+            assert info.reads == info.misses
+            assert 5 in m._windows and 0 not in m._windows
+            # Hits don't map anything further
+            m[-10:]
+            assert m.cache_info().reads == info.reads
+            assert m.cache_info().hits == info.hits + 1
+            m.close()
+            assert not m._windows
+            # Windows are aligned within the file, not to the offset
+            m = fake_mmap.WindowMemoryMap(
+                f.fileno(), window_size=1, offset=granularity - 3, length=6)
+            assert m[:] == real[granularity - 3:granularity + 3]
+            assert sorted(m._windows) == [0, 1]
+        finally:
+            real.close()
+
+def test_windows_invalid(source):
+    with pytest.raises(ValueError):
+        fake_mmap.WindowMemoryMap(source.fileno(), window_size=0)
+    with pytest.raises(ValueError):
+        fake_mmap.WindowMemoryMap(source.fileno(), max_windows=0)
+
+def test_buffer():
+    source = bytearray(b'abcdefghijklmnopqrstuvwxyz')
+    m = fake_mmap.BufferMemoryMap(source, offset=1)
+    assert m.view.readonly
+    assert m.view.tobytes() == b'bcdefghijklmnopqrstuvwxyz'
+    with pytest.raises(BufferError):
+        source.append(0)
+    m.close()
+    source.append(0)
+    # Multi-byte formats are treated as bytes
+    if hasattr(memoryview, 'cast'):
+        m = fake_mmap.BufferMemoryMap(memoryview(b'abcdef').cast('H'))
+        assert len(m) == 6
+        assert m[2:4] == b'cd'